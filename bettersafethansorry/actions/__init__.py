@@ -1,12 +1,22 @@
+import bettersafethansorry.resources as bsts_resources
+import bettersafethansorry.utilities as bsts_utils
+
+
 class Action:
 
     required_keys = []
     optional_keys = {
-        'all-or-nothing': False
+        'all-or-nothing': False,
+        'stderr-lines': None,
+        'nice': None,
+        'ionice': None,
+        'bandwidth-limit': None
     }
 
     def __init__(self, action_config, logger, extra_required_keys=[], extra_optional_keys={}):
         self.logger = logger
+        self.cancellation = None
+        self.statistics = None
         self.logger.log_debug(
             "Initialising '{}' action".format(self.__class__.__name__))
         self.config = {}
@@ -30,6 +40,35 @@ class Action:
         for key in action_config:
             logger.log_warning(
                 "Ignoring unrecognised parameter '{}' in '{}' config".format(key, self.__class__.__name__))
+        # CPU, I/O and bandwidth limits of the subprocesses.
+        try:
+            self.resource_limits = bsts_resources.get_limits(
+                self.config['nice'], self.config['ionice'], self.config['bandwidth-limit'])
+        except ValueError as error:
+            self.logger.log_error(str(error))
+            raise
+
+    def set_cancellation(self, cancellation):
+        """Terminate the subprocesses of this action when `cancellation` is cancelled."""
+        self.cancellation = cancellation
+
+    def _run_processes(self, commands, stdout_filename=None, cwd=None, statistics=None, digests=None,
+                       capture_stdout=False, stdout_callback=None):
+        return bsts_utils.run_processes(
+            commands, stdout_filename, self.logger, cwd=cwd, cancellation=self.cancellation,
+            stderr_lines=self.config['stderr-lines'], statistics=statistics, digests=digests,
+            capture_stdout=capture_stdout, resource_limits=self.resource_limits,
+            stdout_callback=stdout_callback)
+
+    def _report_progress(self, progress):
+        """Pass the progress (a dictionary) of a long running action to the loggers, if supported."""
+        report_progress = getattr(self.logger, 'report_progress', None)
+        if report_progress is not None:
+            report_progress(progress)
+
+    def get_statistics(self):
+        """Return the statistics collected while running the action (or None)."""
+        return self.statistics
 
     def has_do(self):
         return False
@@ -64,5 +103,18 @@ class Action:
     def has_verify(self):
         return False
 
-    def verify(self, dry_run):
+    def get_verify_identity(self):
+        """Return the identity of the artifact checked by verify() (None if results can't be cached)."""
+        return None
+
+    def get_verify_fingerprint(self):
+        """Return the current fingerprint of the artifact checked by verify() (or None).
+
+        The fingerprint is a dictionary; if it didn't change since the last successful
+        verification, the artifact doesn't need to be verified again.
+        """
+        return None
+
+    def verify(self, dry_run, mode='deep'):
+        """Verify the backup; mode is 'deep' (check all data) or 'quick' (if supported)."""
         return ['Not implemented']
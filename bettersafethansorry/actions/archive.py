@@ -1,5 +1,11 @@
+import hashlib
+import os.path
+import re
+import tempfile
 import time
 from bettersafethansorry.actions import Action
+from bettersafethansorry.compression import CompressionProfile
+import bettersafethansorry.state as bsts_state
 import bettersafethansorry.utilities as bsts_utils
 
 
@@ -17,13 +23,58 @@ class ArchiveStuff(Action):
         'destination-host': None,
         'destination-compression': None,
         'keep': 0,
-        'retry': 1
+        'retry': 1,
+        'metering': False,
+        'checksum': None,
+        'chunk-size': None,
+        'spool-directory': None
+    }
+
+    # Checksum algorithms: hashlib name, program and suffix of the checksum file.
+    checksum_algorithms = {
+        'sha256': ('sha256', 'sha256sum', '.sha256'),
+        'blake2b': ('blake2b', 'b2sum', '.b2')
     }
 
     def __init__(self, action_config, logger, extra_required_keys=[], extra_optional_keys={}):
         required_keys = [*ArchiveStuff.required_keys, *extra_required_keys]
         optional_keys = {**ArchiveStuff.optional_keys, **extra_optional_keys}
         super().__init__(action_config, logger, required_keys, optional_keys)
+        # Checksum of the archive, computed in flight.
+        self.checksum = None
+        # Parse compression profiles.
+        self.compression_profiles = {}
+        for key in ('source-compression', 'compression', 'destination-compression'):
+            if self.config[key]:
+                try:
+                    self.compression_profiles[key] = CompressionProfile(self.config[key])
+                except ValueError as error:
+                    self.logger.log_error(str(error))
+                    raise
+        if self.config['checksum'] is not None and \
+                self.config['checksum'] not in ArchiveStuff.checksum_algorithms:
+            self.logger.log_error("Unknown checksum algorithm '{}' (expected one of: {})".format(
+                self.config['checksum'], ', '.join(ArchiveStuff.checksum_algorithms)))
+            raise ValueError("Unknown checksum algorithm '{}'".format(self.config['checksum']))
+        # Chunked (resumable) transfer to the destination host, see _do_chunked_archive_prepare().
+        self.chunk_size = None
+        if self.config['chunk-size'] is not None:
+            if self.config['destination-host'] is None:
+                self.logger.log_error("'chunk-size' requires a 'destination-host'")
+                raise ValueError("'chunk-size' requires a 'destination-host'")
+            try:
+                self.chunk_size = bsts_utils.parse_size(self.config['chunk-size'])
+            except ValueError as error:
+                self.logger.log_error(str(error))
+                raise
+        # Set when the spool of an earlier attempt (of this run) may be reused.
+        self.staging_started = False
+        self.keep_staging = False
+
+    def _get_compression_command(self, key, host):
+        """Return the compress command of a compression setting for the host executing it."""
+        profile = self.compression_profiles.get(key, None)
+        return profile.compress_command(host) if profile is not None else None
 
     def _convert_command_to_string(self, command):
         if isinstance(command, list):
@@ -85,7 +136,7 @@ class ArchiveStuff(Action):
                 full_source_cmd = self._convert_command_to_string(full_source_cmd)
                 ssh_command = self._compose_source_ssh_command(source_host)
                 if is_archive_function:
-                    source_compression = self.config['source-compression']
+                    source_compression = self._get_compression_command('source-compression', source_host)
                 else:
                     source_compression = None
                 source_compression_cmd = self._compose_source_compression_command(source_compression)
@@ -95,22 +146,46 @@ class ArchiveStuff(Action):
 
     def _compose_compression_command(self):
         if self.config['compression']:
-            compression_cmd = self.config['compression'].split(' ')
+            compression_cmd = self._get_compression_command('compression', None).split(' ')
         elif self.config['source-host'] is None and self.config['source-compression']:
-            compression_cmd = self.config['source-compression'].split(' ')
+            compression_cmd = self._get_compression_command('source-compression', None).split(' ')
         elif self.config['destination-host'] is None and self.config['destination-compression']:
-            compression_cmd = self.config['destination-compression'].split(' ')
+            compression_cmd = self._get_compression_command('destination-compression', None).split(' ')
         else:
             compression_cmd = None
         return compression_cmd
 
+    def _get_checksum_suffix(self):
+        """Return the suffix of the checksum files (or None if no checksums are computed)."""
+        if self.config['checksum'] is None:
+            return None
+        return ArchiveStuff.checksum_algorithms[self.config['checksum']][2]
+
+    def _get_rotation_companions(self):
+        """Return the suffixes of the files rotated together with the destination file."""
+        suffix = self._get_checksum_suffix()
+        return [suffix] if suffix is not None else []
+
+    def _hashes_remotely(self):
+        # Data compressed on the destination host can't be hashed in flight by this process.
+        return self.config['checksum'] is not None and \
+            self.config['destination-host'] is not None and \
+            self.config['destination-compression'] is not None
+
     def _compose_destination_command(self):
         if self.config['destination-host']:
             cmd_string = 'cat'
             if self.config['destination-compression']:
-                cmd_string += ' | {}'.format(
-                    self.config['destination-compression'])
+                cmd_string += ' | {}'.format(self._get_compression_command(
+                    'destination-compression', self.config['destination-host']))
             cmd_string += ' > {}.tmp'.format(self.config['destination-file'])
+            if self._hashes_remotely():
+                # Hash the archive right after writing it (while it's still cached).
+                cmd_string += " && {} {}.tmp | cut -d' ' -f1 > {}{}.tmp".format(
+                    ArchiveStuff.checksum_algorithms[self.config['checksum']][1],
+                    self.config['destination-file'],
+                    self.config['destination-file'],
+                    self._get_checksum_suffix())
             destination_cmd = [
                 'ssh',
                 self.config['destination-host'],
@@ -127,10 +202,10 @@ class ArchiveStuff(Action):
         else:
             return []
 
-    def _compose_archive_commands(self):
+    def _compose_archive_commands(self, with_destination=True):
         source_cmd = self._compose_source_commands(self._compose_base_archive_command, True)[0]
         compression_cmd = self._compose_compression_command()
-        destination_cmd = self._compose_destination_command()
+        destination_cmd = self._compose_destination_command() if with_destination else None
         commands = [
             source_cmd,
             *([compression_cmd] if compression_cmd is not None else []),
@@ -156,13 +231,184 @@ class ArchiveStuff(Action):
     def _do_pre_post_commands(self, commands, dry_run):
         errors = []
         if not dry_run:
-            exit_codes, stdouts, stderrs = bsts_utils.run_processes(commands, None, self.logger)
+            exit_codes, stdouts, stderrs = self._run_processes(commands)
             errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
         else:
             # Show command that would be executed
             self.logger.log_info('Would run: {}'.format(' | '.join(map(' '.join, commands))))
         return errors
 
+    def _run_archive_processes(self, commands, destination_filename, hashed_stage=None):
+        """Run the archive pipeline, collecting and logging statistics if metering is enabled.
+
+        If checksums are enabled (and the data isn't compressed on the destination host),
+        the data written to the destination file is hashed in flight and the checksum is
+        stored in a temporary checksum file.
+        """
+        statistics = {} if self.config['metering'] else None
+        digests = {}
+        if self.config['checksum'] is not None and not self._hashes_remotely():
+            # Hash the output of the last subprocess or, if it writes to the destination host,
+            # its input.
+            stage = len(commands) - 1 if self.config['destination-host'] is None else len(commands) - 2
+            if hashed_stage is not None:
+                stage = hashed_stage
+            digests[stage] = hashlib.new(ArchiveStuff.checksum_algorithms[self.config['checksum']][0])
+        exit_codes, stdouts, stderrs = self._run_processes(
+            commands, destination_filename, statistics=statistics, digests=digests)
+        if statistics is not None:
+            bsts_utils.log_pipeline_statistics(statistics, self.logger)
+            self.statistics = statistics
+        self.checksum = next(iter(digests.values())).hexdigest() if len(digests) > 0 else None
+        return exit_codes, stdouts, stderrs
+
+    def _write_checksum_file(self):
+        """Store the checksum computed in flight in the temporary checksum file."""
+        if self.checksum is None:
+            return []
+        checksum_filename = '{}{}.tmp'.format(self.config['destination-file'], self._get_checksum_suffix())
+        self.logger.log_debug('Checksum ({}): {}'.format(self.config['checksum'], self.checksum))
+        errors = []
+        if self.config['destination-host'] is not None:
+            commands = [['ssh', self.config['destination-host'],
+                         'echo {} > {}'.format(self.checksum, checksum_filename)]]
+            exit_codes, stdouts, stderrs = self._run_processes(commands)
+            errors.extend(bsts_utils.log_subprocess_errors(
+                commands, exit_codes, stdouts, stderrs, self.logger))
+        else:
+            try:
+                with open(checksum_filename, 'w') as checksum_file:
+                    checksum_file.write(self.checksum + '\n')
+            except OSError as error:
+                errors.append("Unable to write checksum file '{}': {}".format(checksum_filename, error))
+                self.logger.log_error(errors[-1])
+        return errors
+
+    def _get_spool_filename(self):
+        """Return the local file spooling the archive of a chunked transfer."""
+        directory = self.config['spool-directory'] or os.path.join(bsts_state.get_state_directory(), 'spool')
+        key = '{}:{}'.format(self.config['destination-host'], self.config['destination-file'])
+        return os.path.join(directory, 'bsts-{}.spool'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+    def _get_chunk_directory(self):
+        """Return the directory staging the chunks of a chunked transfer on the destination host."""
+        return '{}.chunks'.format(self.config['destination-file'])
+
+    def _get_chunk_filename(self, number):
+        return '{}/chunk.{:06d}'.format(self._get_chunk_directory(), number)
+
+    def _discard_spool(self):
+        """Remove the local spool of a chunked transfer."""
+        spool_filename = self._get_spool_filename()
+        for filename in (spool_filename, '{}.tmp'.format(spool_filename)):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _read_chunk_manifest(self):
+        """Return the errors and the (chunk name, digest) entries of the manifest on the destination host.
+
+        The manifest starts with the chunk size; entries of another chunk size are ignored.
+        """
+        chunk_directory = self._get_chunk_directory()
+        commands = [['ssh', self.config['destination-host'],
+                     'cat {}/manifest 2>/dev/null || true'.format(chunk_directory)]]
+        exit_codes, stdouts, stderrs = self._run_processes(commands, capture_stdout=True)
+        errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
+        lines = (stdouts[-1] or '').splitlines()
+        if len(errors) > 0 or len(lines) == 0 or lines[0] != 'chunk-size {}'.format(self.chunk_size):
+            return errors, []
+        entries = []
+        for line in lines[1:]:
+            digest, _, name = line.partition('  ')
+            entries.append((name, digest))
+        return errors, entries
+
+    def _count_reusable_chunks(self, spool_filename, entries):
+        """Return the number of leading (full) chunks of the spool that are on the destination already."""
+        count = 0
+        with open(spool_filename, 'rb') as spool:
+            for name, digest in entries:
+                chunk_digest = hashlib.sha256()
+                size = 0
+                while size < self.chunk_size:
+                    data = spool.read(min(bsts_utils.RELAY_BUFFER_SIZE, self.chunk_size - size))
+                    if len(data) == 0:
+                        break
+                    chunk_digest.update(data)
+                    size += len(data)
+                if size < self.chunk_size or name != 'chunk.{:06d}'.format(count) or \
+                        chunk_digest.hexdigest() != digest:
+                    break
+                count += 1
+        return count
+
+    def _do_chunked_archive_prepare(self):
+        """Spool the archive locally, upload it in chunks and concatenate them into the .tmp file.
+
+        The archive is written to a local spool file first, so the spool directory needs free
+        space for the whole (compressed) archive. The spool is sent to a chunk directory next
+        to the destination file, where every chunk appears only once it's complete and is
+        recorded, with its SHA-256 digest, in a manifest. Chunks of an interrupted or failed
+        transfer, of this run or of an earlier one, are kept: the next attempt only sends the
+        chunks after the leading chunks whose digests match the spool. Attempts of the same
+        run reuse the spool too, without reading the source again.
+        """
+        errors = []
+        destination_host = self.config['destination-host']
+        spool_filename = self._get_spool_filename()
+        chunk_directory = self._get_chunk_directory()
+        if not self.staging_started:
+            # A spool of another run may contain an outdated archive.
+            self._discard_spool()
+            self.staging_started = True
+        if not os.path.isfile(spool_filename):
+            commands = self._compose_archive_commands(False)
+            os.makedirs(os.path.dirname(spool_filename), exist_ok=True)
+            self.logger.log_info('Spooling archive to {}'.format(spool_filename))
+            exit_codes, stdouts, stderrs = self._run_archive_processes(
+                commands, '{}.tmp'.format(spool_filename), len(commands) - 1)
+            errors.extend(bsts_utils.log_subprocess_errors(
+                commands, exit_codes, stdouts, stderrs, self.logger))
+            if len(errors) == 0:
+                os.rename('{}.tmp'.format(spool_filename), spool_filename)
+        if len(errors) > 0:
+            return errors
+        # Resume after the last chunk on the destination that matches the spool.
+        manifest_errors, entries = self._read_chunk_manifest()
+        if len(manifest_errors) > 0:
+            return manifest_errors
+        completed = self._count_reusable_chunks(spool_filename, entries)
+        offset = completed * self.chunk_size
+        spool_size = os.path.getsize(spool_filename)
+        if completed > 0:
+            self.logger.log_info('Resuming transfer at chunk {} ({} of {} already on destination)'.format(
+                completed, bsts_utils.format_size(offset), bsts_utils.format_size(spool_size)))
+        # Keep the manifest entries of the reused chunks and append the entries of the new ones.
+        commands = [
+            ['tail', '-c', '+{}'.format(offset + 1), spool_filename],
+            ['ssh', destination_host,
+             "mkdir -p {0} && rm -f {0}/*.tmp && "
+             "{{ echo 'chunk-size {1}'; head -n {3} {0}/manifest 2>/dev/null | tail -n +2; }} > {0}/manifest.tmp && "
+             "mv {0}/manifest.tmp {0}/manifest && cd {0} && split -b {1} -a 6 --numeric-suffixes={2} "
+             "--filter='cat > $FILE.tmp && mv $FILE.tmp $FILE && sha256sum $FILE >> manifest' - chunk.".format(
+                 chunk_directory, self.chunk_size, completed, completed + 1)]
+        ]
+        exit_codes, stdouts, stderrs = self._run_processes(commands)
+        errors.extend(bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger))
+        if len(errors) > 0:
+            return errors
+        # Concatenate the chunks of the manifest (compressing and hashing them on the destination
+        # host if needed) and remove them.
+        destination_cmd = self._compose_destination_command()
+        commands = [['ssh', destination_host,
+                     "cat /dev/null $(awk 'NR > 1 {{ print \"{0}/\" $2 }}' {0}/manifest) | {1} && rm -r {0}".format(
+                         chunk_directory, destination_cmd[2])]]
+        exit_codes, stdouts, stderrs = self._run_processes(commands)
+        errors.extend(bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger))
+        if len(errors) == 0:
+            os.remove(spool_filename)
+        return errors
+
     def _do_archive_prepare(self, dry_run):
         """Execute archive commands to create .tmp file without rotating backups."""
         self.logger.log_debug(
@@ -173,10 +419,21 @@ class ArchiveStuff(Action):
             "Executing '{}' action (prepare phase)".format(self.__class__.__name__))
         errors = []
         if not dry_run:
-            exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                commands, destination_filename, self.logger)
-            errors.extend(bsts_utils.log_subprocess_errors(
-                commands, exit_codes, stdouts, stderrs, self.logger))
+            if self.chunk_size is not None:
+                errors.extend(self._do_chunked_archive_prepare())
+            else:
+                exit_codes, stdouts, stderrs = self._run_archive_processes(
+                    commands, destination_filename)
+                errors.extend(bsts_utils.log_subprocess_errors(
+                    commands, exit_codes, stdouts, stderrs, self.logger))
+            if len(errors) == 0:
+                errors.extend(self._write_checksum_file())
+        elif self.chunk_size is not None:
+            self.logger.log_info('Would run: {} > {}'.format(
+                ' | '.join(map(' '.join, self._compose_archive_commands(False))), self._get_spool_filename()))
+            self.logger.log_info('Would upload {} in chunks of {} to {}:{} and concatenate them into {}.tmp'.format(
+                self._get_spool_filename(), bsts_utils.format_size(self.chunk_size),
+                self.config['destination-host'], self._get_chunk_directory(), self.config['destination-file']))
         else:
             # Show command that would be executed
             if destination_filename:
@@ -185,6 +442,9 @@ class ArchiveStuff(Action):
             else:
                 self.logger.log_info('Would run: {}'.format(
                     ' | '.join(map(' '.join, commands))))
+            if self.config['checksum'] is not None and not self._hashes_remotely():
+                self.logger.log_info('Would store {} checksum in {}{}.tmp'.format(
+                    self.config['checksum'], self.config['destination-file'], self._get_checksum_suffix()))
         return errors
 
     def _do_archive_commit(self, dry_run):
@@ -198,7 +458,8 @@ class ArchiveStuff(Action):
                 self.config['destination-file'],
                 '.tmp',
                 self.config['keep'],
-                self.logger)
+                self.logger,
+                self._get_rotation_companions())
             for error in rotate_errors:
                 self.logger.log_error(error)
             errors.extend(rotate_errors)
@@ -215,14 +476,21 @@ class ArchiveStuff(Action):
         self.logger.log_debug(
             "Rolling back '{}' action".format(self.__class__.__name__))
         errors = []
-        if not dry_run:
-            bsts_utils.remove_file(
-                self.config['destination-host'],
-                '{}.tmp'.format(self.config['destination-file']))
-        else:
-            # Show what would be rolled back
-            self.logger.log_info('Would remove: {}.tmp'.format(
-                self.config['destination-file']))
+        filenames = ['{}.tmp'.format(self.config['destination-file'])]
+        if self.config['checksum'] is not None:
+            filenames.append('{}{}.tmp'.format(self.config['destination-file'], self._get_checksum_suffix()))
+        for filename in filenames:
+            if not dry_run:
+                bsts_utils.remove_file(self.config['destination-host'], filename)
+            else:
+                # Show what would be rolled back
+                self.logger.log_info('Would remove: {}'.format(filename))
+        if self.chunk_size is not None and not dry_run:
+            # The chunks on the destination are kept for the next attempt (or run).
+            self.logger.log_info('Keeping {} chunks on destination for the next attempt'.format(
+                self._get_chunk_directory()))
+            if not self.keep_staging:
+                self._discard_spool()
         return errors
 
     def _do_archive_commands(self, dry_run):
@@ -234,14 +502,15 @@ class ArchiveStuff(Action):
             "Executing '{}' action".format(self.__class__.__name__))
         errors = []
         if not dry_run:
-            exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                commands, destination_filename, self.logger)
+            exit_codes, stdouts, stderrs = self._run_archive_processes(
+                commands, destination_filename)
             errors.extend(bsts_utils.log_subprocess_errors(
                 commands, exit_codes, stdouts, stderrs, self.logger))
+            if len(errors) == 0:
+                errors.extend(self._write_checksum_file())
             if len(errors) > 0:
-                # Remove temporary file.
-                bsts_utils.remove_file(
-                    self.config['destination-host'], '{}.tmp'.format(self.config['destination-file']))
+                # Remove temporary files.
+                self._do_archive_rollback(dry_run)
             else:
                 # Rotate backup files.
                 rotate_errors = bsts_utils.rotate_file(
@@ -249,7 +518,8 @@ class ArchiveStuff(Action):
                     self.config['destination-file'],
                     '.tmp',
                     self.config['keep'],
-                    self.logger)
+                    self.logger,
+                    self._get_rotation_companions())
                 for error in rotate_errors:
                     self.logger.log_error(error)
                 errors.extend(rotate_errors)
@@ -278,7 +548,10 @@ class ArchiveStuff(Action):
                 commit_errors = self.commit(dry_run)
                 errors.extend(commit_errors)
             else:
+                # Keep the spool of a chunked transfer if the action will be retried.
+                self.keep_staging = retry > 1
                 rollback_errors = self.rollback(dry_run)
+                self.keep_staging = False
                 errors.extend(rollback_errors)
 
             retry -= 1
@@ -339,55 +612,124 @@ class ArchiveStuff(Action):
     def _get_decompression_command(self):
         """Get the decompression command based on config.
 
-        Returns the decompression command (e.g., 'gunzip -c', 'bunzip2 -c')
-        or None if no compression is used.
+        Returns the decompression command (e.g., 'gzip -dc', 'zstd -dc') for the
+        destination host, or None if no (known) compression is used.
         """
         # Use the same logic as backup to determine compression
-        compression = None
-        if self.config['destination-compression']:
-            compression = self.config['destination-compression']
-        elif self.config['compression']:
-            compression = self.config['compression']
-        elif self.config['source-compression']:
-            compression = self.config['source-compression']
-
-        if compression is None:
-            return None
+        profile = None
+        for key in ('destination-compression', 'compression', 'source-compression'):
+            if key in self.compression_profiles:
+                profile = self.compression_profiles[key]
+                break
 
-        # Map compression commands to decompression commands
-        compression_lower = compression.lower()
-        if 'gzip' in compression_lower or compression_lower.startswith('gz'):
-            return 'gunzip -c'
-        elif 'bzip2' in compression_lower or 'bz2' in compression_lower:
-            return 'bunzip2 -c'
-        elif 'xz' in compression_lower:
-            return 'xz -dc'
-        else:
-            # Unknown compression, try to infer from the command
+        if profile is None:
             return None
 
-    def _compose_file_exists_command(self):
-        """Compose a command to check if backup file exists."""
-        destination_file = self.config['destination-file']
-        return 'test -f {}'.format(destination_file)
+        return profile.decompress_command(self.config['destination-host'])
+
+    def _get_verify_patterns(self):
+        """Return the files (or shell patterns) read by verify()."""
+        return [self.config['destination-file']]
 
-    def _compose_verify_commands(self):
+    def get_verify_identity(self):
+        return '{}:{}'.format(self.config['destination-host'] or 'localhost', self.config['destination-file'])
+
+    def get_verify_fingerprint(self):
+        """Return the size, mtime, inode and device of the archive (and of the other files it needs)."""
+        destination_file = self.config['destination-file']
+        files = bsts_utils.stat_files(self.config['destination-host'], self._get_verify_patterns())
+        if destination_file not in files:
+            return None
+        size, mtime, inode, device = files.pop(destination_file)
+        fingerprint = {'size': size, 'mtime': mtime, 'inode': inode, 'device': device}
+        if len(files) > 0:
+            fingerprint['members'] = {os.path.basename(filename): list(attributes)
+                                      for filename, attributes in files.items()}
+        return fingerprint
+
+    def _compose_checksum_verify_command(self, filename):
+        """Compose a command comparing the checksum of a file with its checksum file."""
+        program = ArchiveStuff.checksum_algorithms[self.config['checksum']][1]
+        checksum_filename = filename + self._get_checksum_suffix()
+        return 'test "$({} {} | cut -d\' \' -f1)" = "$(cat {})" || {{ echo "Checksum mismatch: {}" >&2; false; }}'.format(
+            program, filename, checksum_filename, filename)
+
+    def _compose_file_verify_command(self, filename, mode):
+        """Compose the verify command of one archive.
+
+        In quick mode, only the checksum of the archive is compared with its checksum file;
+        archives without checksum file are checked completely.
+        """
+        deep_verify_cmd = self._compose_base_verify_command(filename)
+        if mode != 'quick' or self.config['checksum'] is None:
+            return deep_verify_cmd
+        checksum_filename = filename + self._get_checksum_suffix()
+        return 'if test -f {0}; then {1}; else echo "No checksum file {0}, checking archive" >&2; {2}; fi'.format(
+            checksum_filename, self._compose_checksum_verify_command(filename), deep_verify_cmd)
+
+    def _compose_file_verify_block(self, filename, mode):
+        """Compose the part of the verify script checking one archive.
+
+        The existence, size, mtime, inode and device and integrity of the archive are
+        reported on stdout as tab separated 'exists', 'stat' and 'integrity' lines; failures
+        are described on stderr and set rc to 1.
+        """
+        destination_host = self.config['destination-host']
+        location = '{}:{}'.format(destination_host, filename) if destination_host else filename
+        return (
+            "if test -f {0}; then "
+            "printf 'exists\\t%s\\t1\\n' {0}; "
+            "printf 'stat\\t%s\\t%s\\n' {0} \"$(stat -c '%s %Y %i %d' {0})\"; "
+            "if {1}; then printf 'integrity\\t%s\\tok\\n' {0}; "
+            "else printf 'integrity\\t%s\\tfailed\\n' {0}; echo \"Integrity check failed: {2}\" >&2; rc=1; fi; "
+            "else printf 'exists\\t%s\\t0\\n' {0}; echo \"Backup file does not exist: {2}\" >&2; rc=1; fi"
+        ).format(filename, self._compose_file_verify_command(filename, mode), location)
+
+    def _compose_verify_script(self, mode):
+        """Compose the shell script verifying the backup."""
+        return 'rc=0; {}; exit $rc'.format(
+            self._compose_file_verify_block(self.config['destination-file'], mode))
+
+    def _compose_verify_commands(self, mode='deep'):
         """Compose verify commands, wrapping with SSH if needed.
 
         Returns list of command lists suitable for run_processes.
         """
         destination_host = self.config['destination-host']
 
-        # Get the base verify command from subclass
-        verify_cmd = self._compose_base_verify_command()
+        # Get the verify script (of the subclass)
+        verify_cmd = self._compose_verify_script(mode)
 
         if destination_host:
             return [['ssh', destination_host, verify_cmd]]
         else:
             return [['sh', '-c', verify_cmd]]
 
-    def verify(self, dry_run):
-        """Verify backup integrity by checking file exists and validating compression."""
+    @staticmethod
+    def _parse_verify_report(stdout):
+        """Parse the report of a verify script into a {filename: {key: value}} dictionary."""
+        report = {}
+        for line in (stdout or '').splitlines():
+            fields = line.split('\t')
+            if len(fields) != 3:
+                continue
+            kind, filename, value = fields
+            entry = report.setdefault(filename, {})
+            if kind == 'exists':
+                entry['exists'] = value == '1'
+            elif kind == 'stat' and len(value.split()) == 4:
+                entry['size'], entry['mtime'], entry['inode'], entry['device'] = map(int, value.split())
+            elif kind == 'integrity':
+                entry['integrity'] = value
+        return report
+
+    def verify(self, dry_run, mode='deep'):
+        """Verify backup integrity by checking file exists and validating compression.
+
+        Existence and integrity of all archives are checked by a single script (and thus a
+        single SSH connection for remote destinations). In quick mode, the checksums of the
+        archives are compared with their checksum files instead (if checksums are enabled).
+        """
         self.logger.log_debug(
             "Verifying '{}' action".format(self.__class__.__name__))
         errors = []
@@ -395,29 +737,19 @@ class ArchiveStuff(Action):
         destination_host = self.config['destination-host']
         location = '{}:{}'.format(destination_host, destination_file) if destination_host else destination_file
 
+        verify_commands = self._compose_verify_commands(mode)
         if not dry_run:
-            # Step 1: Check if file exists
-            exists_cmd = self._compose_file_exists_command()
-            if destination_host:
-                exists_command = ['ssh', destination_host, exists_cmd]
+            if mode == 'quick' and self.config['checksum'] is not None:
+                self.logger.log_info('Verifying {} checksum of {}'.format(self.config['checksum'], location))
             else:
-                exists_command = ['sh', '-c', exists_cmd]
-
-            exit_codes, _, _ = bsts_utils.run_processes(
-                [exists_command], None, self.logger)
-            if exit_codes[0] != 0:
-                error_msg = 'Backup file does not exist: {}'.format(location)
-                self.logger.log_error(error_msg)
-                errors.append(error_msg)
-                return errors
-
-            self.logger.log_info('Backup file exists: {}'.format(location))
-
-            # Step 2: Verify archive integrity
-            verify_commands = self._compose_verify_commands()
-            self.logger.log_info('Verifying integrity of {}'.format(location))
-            exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                verify_commands, None, self.logger)
+                self.logger.log_info('Verifying integrity of {}'.format(location))
+            exit_codes, stdouts, stderrs = self._run_processes(
+                verify_commands, capture_stdout=True)
+            for filename, entry in self._parse_verify_report(stdouts[0]).items():
+                if entry.get('exists', False) and 'size' in entry:
+                    self.logger.log_info('Backup file exists: {} ({})'.format(
+                        '{}:{}'.format(destination_host, filename) if destination_host else filename,
+                        bsts_utils.format_size(entry['size'])))
             errors.extend(bsts_utils.log_subprocess_errors(
                 verify_commands, exit_codes, stdouts, stderrs, self.logger))
 
@@ -425,13 +757,6 @@ class ArchiveStuff(Action):
                 self.logger.log_info('Archive integrity verified: {}'.format(location))
         else:
             # Show commands that would be executed
-            exists_cmd = self._compose_file_exists_command()
-            if destination_host:
-                self.logger.log_info('Would run: ssh {} {}'.format(destination_host, exists_cmd))
-            else:
-                self.logger.log_info('Would run: {}'.format(exists_cmd))
-
-            verify_commands = self._compose_verify_commands()
             self.logger.log_info('Would run: {}'.format(' '.join(verify_commands[0])))
 
         return errors
@@ -447,17 +772,186 @@ class ArchiveFiles(ArchiveStuff):
         'one-file-system': False,
         'follow-symlinks': False,
         'excludes': [],
-        'minimalistic-tar': False
+        'minimalistic-tar': False,
+        'incremental': None,
+        'full-every': 7
     }
 
+    incremental_modes = ['incremental', 'differential']
+
     def __init__(self, action_config, logger, extra_required_keys=[], extra_optional_keys={}):
         required_keys = [*ArchiveFiles.required_keys, *extra_required_keys]
         optional_keys = {**ArchiveFiles.optional_keys, **extra_optional_keys}
         super().__init__(action_config, logger, required_keys, optional_keys)
+        if self.config['incremental'] is not None:
+            if self.config['incremental'] not in ArchiveFiles.incremental_modes:
+                self.logger.log_error("Unknown incremental mode '{}' (expected one of: {})".format(
+                    self.config['incremental'], ', '.join(ArchiveFiles.incremental_modes)))
+                raise ValueError("Unknown incremental mode '{}'".format(self.config['incremental']))
+            if self.config['source-container'] is not None or self.config['minimalistic-tar']:
+                self.logger.log_error(
+                    "Incremental backups are not supported with 'source-container' or 'minimalistic-tar'")
+                raise ValueError("Incremental backups are not supported with 'source-container' or 'minimalistic-tar'")
+            if self.config['chunk-size'] is not None:
+                self.logger.log_error("Incremental backups are not supported with 'chunk-size'")
+                raise ValueError("Incremental backups are not supported with 'chunk-size'")
+        # Level (0 for a full backup) and chain members of the next backup, see _plan_chain().
+        self.level = 0
+        self.chain_length = 0
+        self.max_chain_length = 0
 
     def has_do(self):
         return True
 
+    def _is_incremental(self):
+        return self.config['incremental'] is not None
+
+    def _get_snapshot_filename(self):
+        """Return the filename of the tar snapshot (listed-incremental) file of the chain."""
+        return '{}.snar'.format(self.config['destination-file'])
+
+    def _get_source_snapshot_filename(self):
+        """Return the filename used by tar for the snapshot file on the source host."""
+        key = '{}:{}'.format(self.config['destination-host'], self.config['destination-file'])
+        basename = 'bsts-{}.snar'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+        directory = tempfile.gettempdir() if self.config['source-host'] is None else '/tmp'
+        return os.path.join(directory, basename)
+
+    def _get_increment_filename(self, number):
+        return '{}.incr.{}'.format(self.config['destination-file'], number)
+
+    def _get_rotation_companions(self):
+        companions = super()._get_rotation_companions()
+        if not self._is_incremental():
+            return companions
+        increments = ['.incr.{}'.format(number) for number in range(1, self.max_chain_length + 1)]
+        return ['.snar', *companions,
+                *[increment + suffix for increment in increments for suffix in ['', *companions]]]
+
+    def _plan_chain(self):
+        """Inspect the chain on the destination and decide on the level of the next backup.
+
+        A new chain (full backup) is started if there's no complete chain yet or if the
+        chain reached `full-every` backups.
+        """
+        destination_host = self.config['destination-host']
+        directory, basename = os.path.split(self.config['destination-file'])
+        existing_files = bsts_utils.list_files(destination_host, directory)
+        # Number of consecutive increments of the current chain.
+        self.chain_length = 0
+        while os.path.basename(self._get_increment_filename(
+                self.chain_length + 1)) in existing_files:
+            self.chain_length += 1
+        # Longest chain of all rotated backups, to rotate all their increments.
+        pattern = re.compile(r'{}(\.\d+)?\.incr\.(\d+)$'.format(re.escape(basename)))
+        self.max_chain_length = max(
+            [int(match.group(2)) for match in map(pattern.match, existing_files) if match is not None],
+            default=0)
+        chain_is_complete = basename in existing_files and \
+            os.path.basename(self._get_snapshot_filename()) in existing_files
+        if not chain_is_complete or self.chain_length + 1 >= int(self.config['full-every']):
+            self.level = 0
+            self.logger.log_info('Creating full backup (level 0, new chain)')
+        else:
+            self.level = 1 if self.config['incremental'] == 'differential' else self.chain_length + 1
+            self.logger.log_info('Creating {} backup (level {}, backup {} of {} in chain)'.format(
+                self.config['incremental'], self.level, self.chain_length + 2, self.config['full-every']))
+
+    def _copy_file(self, source_host, source_file, destination_host, destination_file, dry_run):
+        """Copy a (small) file between hosts (None for localhost) using a pipeline."""
+        if source_host is not None:
+            commands = [['ssh', source_host, 'cat {}'.format(source_file)]]
+        else:
+            commands = [['cat', source_file]]
+        if destination_host is not None:
+            commands.append(['ssh', destination_host, 'cat > {}'.format(destination_file)])
+            stdout_filename = None
+        else:
+            stdout_filename = destination_file
+        errors = []
+        if not dry_run:
+            exit_codes, stdouts, stderrs = self._run_processes(commands, stdout_filename)
+            errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
+        else:
+            self.logger.log_info('Would run: {}{}'.format(
+                ' | '.join(map(' '.join, commands)),
+                ' > {}'.format(stdout_filename) if stdout_filename is not None else ''))
+        return errors
+
+    def prepare(self, dry_run):
+        """Prepare phase: create archive .tmp file, for incremental backups with its snapshot."""
+        if not self._is_incremental():
+            return super().prepare(dry_run)
+        self._plan_chain()
+        source_host = self.config['source-host']
+        destination_host = self.config['destination-host']
+        errors = []
+        if self.level > 0:
+            # Restore the snapshot of the chain on the source host.
+            errors.extend(self._copy_file(
+                destination_host, self._get_snapshot_filename(),
+                source_host, self._get_source_snapshot_filename(), dry_run))
+        if len(errors) == 0:
+            errors.extend(super().prepare(dry_run))
+        if len(errors) == 0 and (self.level == 0 or self.config['incremental'] == 'incremental'):
+            # Store the updated snapshot next to the archive; differential backups keep
+            # the snapshot of the full backup.
+            errors.extend(self._copy_file(
+                source_host, self._get_source_snapshot_filename(),
+                destination_host, '{}.tmp'.format(self._get_snapshot_filename()), dry_run))
+        if not dry_run:
+            bsts_utils.remove_file(source_host, self._get_source_snapshot_filename())
+        return errors
+
+    def _do_archive_commit(self, dry_run):
+        """Rotate backup chains (full backup) or add the increment to the chain."""
+        if not self._is_incremental():
+            return super()._do_archive_commit(dry_run)
+        destination_host = self.config['destination-host']
+        destination_file = self.config['destination-file']
+        self.logger.log_debug(
+            "Committing '{}' action".format(self.__class__.__name__))
+        errors = []
+        if self.level == 0:
+            # Rotate whole chains: the snapshot and increments follow their full backup.
+            if not dry_run:
+                errors.extend(bsts_utils.rotate_file(
+                    destination_host, destination_file, '.tmp', self.config['keep'], self.logger,
+                    self._get_rotation_companions()))
+            else:
+                self.logger.log_info('Would rotate: {}.tmp -> {} (with its chain, keeping {} old chains)'.format(
+                    destination_file, destination_file, self.config['keep']))
+        else:
+            renames = [('{}.tmp'.format(destination_file),
+                        self._get_increment_filename(self.chain_length + 1))]
+            if self.config['checksum'] is not None:
+                renames.append(('{}{}.tmp'.format(destination_file, self._get_checksum_suffix()),
+                                self._get_increment_filename(self.chain_length + 1) + self._get_checksum_suffix()))
+            if self.config['incremental'] == 'incremental':
+                renames.append(('{}.tmp'.format(self._get_snapshot_filename()),
+                                self._get_snapshot_filename()))
+            for filename_old, filename_new in renames:
+                if not dry_run:
+                    self.logger.log_debug("Renaming {} to {}".format(filename_old, filename_new))
+                    if not bsts_utils.rename_file(destination_host, filename_old, filename_new):
+                        errors.append("Unable to rename '{}' to '{}'".format(filename_old, filename_new))
+                        self.logger.log_error(errors[-1])
+                else:
+                    self.logger.log_info('Would rename: {} -> {}'.format(filename_old, filename_new))
+        return errors
+
+    def _do_archive_rollback(self, dry_run):
+        """Remove temporary archive and snapshot files after failed prepare."""
+        errors = super()._do_archive_rollback(dry_run)
+        if self._is_incremental():
+            if not dry_run:
+                bsts_utils.remove_file(
+                    self.config['destination-host'],
+                    '{}.tmp'.format(self._get_snapshot_filename()))
+            else:
+                self.logger.log_info('Would remove: {}.tmp'.format(self._get_snapshot_filename()))
+        return errors
+
     def _compose_base_archive_command(self, use_shell):
         # Compose tar command.
         if use_shell is False:
@@ -470,15 +964,26 @@ class ArchiveFiles(ArchiveStuff):
                 self.config['source-directory'])
             exclude_list = ["--exclude='{}'".format(excluded.replace(
                 "'", "\\'")) for excluded in self.config['excludes']]
+        if self._is_incremental():
+            incremental_list = [
+                '--listed-incremental={}'.format(self._get_source_snapshot_filename()),
+                *(['--level=0'] if self.level == 0 else [])
+            ]
+        else:
+            incremental_list = []
         tar_cmd = [
             'tar',
             *([directory]),
             *(exclude_list),
             '--create',
+            *(incremental_list),
             '--numeric-owner',
             *(['--acls', '--xattrs'] if not self.config['minimalistic-tar'] else []),
             *(['--one-file-system'] if self.config['one-file-system'] else []),
             *(['--sort=name'] if not self.config['minimalistic-tar'] else []),
+            # Leave out access and change times, so the chunks of an unchanged source can be reused.
+            *(['--pax-option=delete=atime,delete=ctime'] if self.chunk_size is not None
+              and not self.config['minimalistic-tar'] else []),
             *(['--dereference'] if self.config['follow-symlinks']
               and not self.config['minimalistic-tar'] else []),
             '--file=-',
@@ -486,15 +991,44 @@ class ArchiveFiles(ArchiveStuff):
         ]
         return tar_cmd if use_shell is False else self._convert_command_to_string(tar_cmd)
 
-    def _compose_base_verify_command(self):
+    def _compose_base_verify_command(self, filename):
         """Compose tar archive verification command."""
-        destination_file = self.config['destination-file']
         decompression = self._get_decompression_command()
-
         if decompression:
-            return '{} {} | tar -t > /dev/null'.format(decompression, destination_file)
+            return '{} {} | tar -t > /dev/null'.format(decompression, filename)
         else:
-            return 'tar -tf {} > /dev/null'.format(destination_file)
+            # Read the archive through a pipe, tar skips the contents of members in regular files.
+            return 'cat {} | tar -t > /dev/null'.format(filename)
+
+    def _get_verify_patterns(self):
+        if not self._is_incremental():
+            return super()._get_verify_patterns()
+        return [self.config['destination-file'], self._get_increment_filename('*')]
+
+    def _compose_verify_script(self, mode):
+        """Compose the shell script verifying the backup (the whole chain if incremental)."""
+        destination_file = self.config['destination-file']
+        if not self._is_incremental():
+            return super()._compose_verify_script(mode)
+        # Check the full backup and all consecutive increments, and make sure there are no
+        # increments after a missing one.
+        increment = self._get_increment_filename('$i')
+        return '; '.join([
+            'rc=0',
+            self._compose_file_verify_block(destination_file, mode),
+            'test $rc -eq 0 || exit $rc',
+            'test -f {} || {{ echo "Missing snapshot file {}" >&2; rc=1; }}'.format(
+                self._get_snapshot_filename(), self._get_snapshot_filename()),
+            'i=1',
+            'while test -f {}; do {}; i=$((i+1)); done'.format(
+                increment, self._compose_file_verify_block(increment, mode)),
+            'n=0',
+            # Count the increments (not their checksum files).
+            'for f in {}.incr.*; do case "$f" in *.incr.*.*) ;; *) if test -f "$f"; then n=$((n+1)); fi;; esac; done'.format(
+                destination_file),
+            'test $n -eq $((i-1)) || {{ echo "Incomplete chain: {} missing" >&2; rc=1; }}'.format(increment),
+            'exit $rc'
+        ])
 
 
 class ArchiveMySQL(ArchiveStuff):
@@ -531,17 +1065,16 @@ class ArchiveMySQL(ArchiveStuff):
         ]
         return mysqldump_cmd if use_shell is False else self._convert_command_to_string(mysqldump_cmd)
 
-    def _compose_base_verify_command(self):
+    def _compose_base_verify_command(self, destination_file):
         """Compose SQL dump verification command (decompression test only)."""
-        destination_file = self.config['destination-file']
         decompression = self._get_decompression_command()
 
         if decompression:
             # Decompress and discard output - verifies integrity
             return '{} {} > /dev/null'.format(decompression, destination_file)
         else:
-            # Uncompressed file - just check it's readable
-            return 'test -r {}'.format(destination_file)
+            # Uncompressed file - read it completely
+            return 'cat {} > /dev/null'.format(destination_file)
 
 
 class ArchivePostgreSQL(ArchiveStuff):
@@ -572,14 +1105,13 @@ class ArchivePostgreSQL(ArchiveStuff):
         ]
         return pgdump_cmd if use_shell is False else self._convert_command_to_string(pgdump_cmd)
 
-    def _compose_base_verify_command(self):
+    def _compose_base_verify_command(self, destination_file):
         """Compose SQL dump verification command (decompression test only)."""
-        destination_file = self.config['destination-file']
         decompression = self._get_decompression_command()
 
         if decompression:
             # Decompress and discard output - verifies integrity
             return '{} {} > /dev/null'.format(decompression, destination_file)
         else:
-            # Uncompressed file - just check it's readable
-            return 'test -r {}'.format(destination_file)
+            # Uncompressed file - read it completely
+            return 'cat {} > /dev/null'.format(destination_file)
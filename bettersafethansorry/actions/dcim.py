@@ -1,18 +1,53 @@
+import bettersafethansorry.metadata as bsts_metadata
+import bettersafethansorry.scheduler as bsts_scheduler
+import bettersafethansorry.state as bsts_state
 import bettersafethansorry.utilities as bsts_utils
+import collections
 import datetime
-import exif
 import fnmatch
+import functools
+import hashlib
+import json
 import os
+import posixpath
+import queue
 import re
-import shutil
+import shlex
 import tempfile
+import threading
+import time
 from bettersafethansorry.actions import Action
 from collections import defaultdict
 from pathlib import Path
 
 
 
+class _IngestItem:
+    """Source file passing through the stages of the CopyPhotosVideos pipeline."""
+
+    def __init__(self, sequence, dirpath, filename):
+        self.sequence = sequence
+        self.filename = filename
+        self.source_filepath = os.path.join(dirpath, filename)
+        self.source_stat = None
+        self.imported = False
+        self.timestamp = None
+        self.timestamp_source = None
+        self.destination_dirpath = None
+        self.destination_filepath = None
+        self.exists = False
+        self.copy_method = None
+        self.error = None
+
+
 class CopyPhotosVideos(Action):
+    """Copy photos and videos to a directory based on their capture time.
+
+    Files pass through a staged pipeline: a scanner walks the source directory, metadata
+    workers read the capture time and check the destination, and copy workers copy the
+    files. The decisions and logging happen in the order of the scan, so the result and
+    the log are the same as with a single worker per stage.
+    """
 
     required_keys = [
         'source-directory',
@@ -20,7 +55,12 @@ class CopyPhotosVideos(Action):
         'files'
     ]
 
-    optional_keys = {}
+    optional_keys = {
+        'ingest-index': True,
+        'metadata-workers': 4,
+        'copy-workers': 4,
+        'queue-size': 64
+    }
 
     def __init__(self, action_config, logger):
         super().__init__(action_config, logger,
@@ -29,7 +69,28 @@ class CopyPhotosVideos(Action):
     def has_do(self):
         return True
 
+    def _get_ingest_index_filename(self):
+        """Return the file of the ingest index of this action (one per source and destination)."""
+        key = '\0'.join([self.config['source-directory'], self.config['destination-directory'],
+                         *self.config['files']])
+        return os.path.join(bsts_state.get_state_directory(),
+                            'ingest-{}.sqlite'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
     def do(self, dry_run):
+        # Files imported before (and unchanged since) are skipped without reading them.
+        # Dry runs don't touch the index.
+        index = None
+        if self.config['ingest-index'] and not dry_run:
+            index = bsts_state.IngestIndex(self._get_ingest_index_filename())
+        try:
+            errors = self._copy_files(dry_run, index)
+        finally:
+            if index is not None:
+                index.close()
+        return errors
+
+    def _scan_files(self):
+        """Yield the (directory, filename) of the files to import, in a deterministic order."""
         for dirpath, dirnames, filenames in os.walk(self.config['source-directory']):
             dirnames.sort()
             filenames_filtered = []
@@ -37,44 +98,419 @@ class CopyPhotosVideos(Action):
                 filenames_filtered.extend(fnmatch.filter(filenames, pattern))
             filenames_filtered.sort()
             for filename in filenames_filtered:
-                source_filepath = os.path.join(dirpath, filename)
-                source_stat = os.stat(source_filepath)
+                yield dirpath, filename
+
+    def _read_file_metadata(self, item, index):
+        """Metadata stage: find the timestamp and destination of a file."""
+        item.source_stat = os.stat(item.source_filepath)
+        if index is not None and index.lookup(
+                item.source_filepath, item.source_stat.st_size, item.source_stat.st_mtime_ns) is not None:
+            item.imported = True
+            return
+        try:
+            # Only read the header of the file (if possible).
+            item.timestamp = datetime.datetime.strptime(
+                bsts_metadata.read_datetime_original(item.source_filepath), '%Y:%m:%d %H:%M:%S')
+            item.timestamp_source = 'EXIF data'
+        except:
+            # Use the timestamp of the source file if we're unable to read the EXIF data.
+            item.timestamp = datetime.datetime.fromtimestamp(
+                item.source_stat.st_mtime)
+            item.timestamp_source = 'file modification time'
+        item.destination_dirpath = item.timestamp.strftime(
+            self.config['destination-directory'])
+        item.destination_filepath = os.path.join(
+            item.destination_dirpath, item.filename)
+        item.exists = os.path.exists(item.destination_filepath)
+
+    def _record_file(self, item, index):
+        if index is not None:
+            index.record(item.source_filepath, item.source_stat.st_size, item.source_stat.st_mtime_ns,
+                         item.destination_filepath, item.timestamp.isoformat(), item.timestamp_source)
+
+    def _plan_file(self, item, dry_run, index, claimed_destinations, checked_directories):
+        """Decide (in scan order) whether a file is copied; return True to copy it."""
+        if item.error is not None:
+            return False
+        if item.imported:
+            self.logger.log_debug('Skipping {} (imported before)'.format(item.filename))
+            return False
+        if item.exists or item.destination_filepath in claimed_destinations:
+            self.logger.log_debug('Skipping {}'.format(item.filename))
+            if item.exists and not dry_run:
+                self._record_file(item, index)
+            return False
+        claimed_destinations.add(item.destination_filepath)
+        if dry_run:
+            self.logger.log_info(
+                'Would copy: {} -> {} (based on {})'.format(
+                    item.filename, item.destination_dirpath, item.timestamp_source))
+            return False
+        if item.destination_dirpath not in checked_directories:
+            if not os.path.exists(item.destination_dirpath):
+                self.logger.log_debug(
+                    'Creating directory {}'.format(item.destination_dirpath))
+                os.makedirs(item.destination_dirpath, exist_ok=True)
+            checked_directories.add(item.destination_dirpath)
+        self.logger.log_info('Copying {} to {} (based on {})'.format(
+            item.filename, item.destination_dirpath, item.timestamp_source))
+        return True
+
+    def _copy_file(self, item, index):
+        """Copy stage: copy a file, preserving its timestamps, and record it in the index."""
+        item.copy_method = bsts_utils.copy_file(item.source_filepath, item.destination_filepath)
+        os.utime(item.destination_filepath,
+                 (item.source_stat.st_atime, item.source_stat.st_mtime))
+        self._record_file(item, index)
+
+    def _copy_files(self, dry_run, index):
+        metadata_workers = max(1, int(self.config['metadata-workers']))
+        copy_workers = max(1, int(self.config['copy-workers']))
+        queue_size = max(1, int(self.config['queue-size']))
+        scanned_items = queue.Queue(queue_size)
+        analysed_items = queue.Queue(queue_size)
+        items_to_copy = queue.Queue(queue_size)
+        failed_items = []
+        failed_items_lock = threading.Lock()
+        scan_errors = []
+        copy_methods = collections.Counter()
+
+        # Exceptions are caught per item (and the sentinels always sent): a worker thread
+        # that dies would leave the others waiting forever.
+        def scan():
+            try:
+                for sequence, (dirpath, filename) in enumerate(self._scan_files()):
+                    scanned_items.put(_IngestItem(sequence, dirpath, filename))
+            except Exception as error:
+                scan_errors.append('Unable to scan {}: {}'.format(self.config['source-directory'], error))
+            finally:
+                for _ in range(metadata_workers):
+                    scanned_items.put(None)
+
+        def analyse():
+            try:
+                for item in iter(scanned_items.get, None):
+                    try:
+                        self._read_file_metadata(item, index)
+                    except Exception as error:
+                        item.error = 'Unable to read {}: {}'.format(item.source_filepath, error)
+                    analysed_items.put(item)
+            finally:
+                analysed_items.put(None)
+
+        def copy():
+            for item in iter(items_to_copy.get, None):
                 try:
-                    with open(source_filepath, 'rb') as image_file:
-                        exif_info = exif.Image(image_file)
-                    timestamp = datetime.datetime.strptime(
-                        exif_info.get('datetime_original'), '%Y:%m:%d %H:%M:%S')
-                    timestamp_source = 'EXIF data'
-                except:
-                    # Use the timestamp of the source file if we're unable to read the EXIF data.
-                    timestamp = datetime.datetime.fromtimestamp(
-                        source_stat.st_mtime)
-                    timestamp_source = 'file modification time'
-                destination_dirpath = timestamp.strftime(
-                    self.config['destination-directory'])
-                destination_filepath = os.path.join(
-                    destination_dirpath, filename)
-                if (os.path.exists(destination_filepath)):
-                    self.logger.log_debug('Skipping {}'.format(filename))
-                else:
-                    if not dry_run:
-                        if not os.path.exists(destination_dirpath):
-                            self.logger.log_debug(
-                                'Creating directory {}'.format(destination_dirpath))
-                            os.makedirs(destination_dirpath)
-                        self.logger.log_info('Copying {} to {} (based on {})'.format(
-                            filename, destination_dirpath, timestamp_source))
-                        shutil.copyfile(source_filepath, destination_filepath)
-                        os.utime(destination_filepath,
-                                 (source_stat.st_atime, source_stat.st_mtime))
-                    else:
-                        self.logger.log_info(
-                            'Would copy: {} -> {} (based on {})'.format(
-                                filename, destination_dirpath, timestamp_source))
-        return []
+                    self._copy_file(item, index)
+                    with failed_items_lock:
+                        copy_methods[item.copy_method] += 1
+                except Exception as error:
+                    item.error = 'Unable to copy {} to {}: {}'.format(
+                        item.source_filepath, item.destination_filepath, error)
+                    with failed_items_lock:
+                        failed_items.append(item)
+
+        threads = [threading.Thread(target=scan),
+                   *[threading.Thread(target=analyse) for _ in range(metadata_workers)],
+                   *[threading.Thread(target=copy) for _ in range(copy_workers)]]
+        for thread in threads:
+            thread.start()
+        # Plan the files in scan order, whatever the order the metadata workers finish in.
+        pending_items = {}
+        next_sequence = 0
+        finished_workers = 0
+        claimed_destinations = set()
+        checked_directories = set()
+        try:
+            while finished_workers < metadata_workers:
+                item = analysed_items.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+                pending_items[item.sequence] = item
+                while next_sequence in pending_items:
+                    item = pending_items.pop(next_sequence)
+                    next_sequence += 1
+                    try:
+                        if self._plan_file(item, dry_run, index, claimed_destinations, checked_directories):
+                            items_to_copy.put(item)
+                    except OSError as error:
+                        item.error = 'Unable to create directory {}: {}'.format(item.destination_dirpath, error)
+                    if item.error is not None:
+                        failed_items.append(item)
+        finally:
+            # Let the metadata workers finish if planning stopped early.
+            while finished_workers < metadata_workers:
+                if analysed_items.get() is None:
+                    finished_workers += 1
+            for _ in range(copy_workers):
+                items_to_copy.put(None)
+            for thread in threads:
+                thread.join()
+        if len(copy_methods) > 0:
+            self.logger.log_info('Copied {} file(s) ({})'.format(
+                sum(copy_methods.values()),
+                ', '.join('{}: {}'.format(method, count) for method, count in sorted(copy_methods.items()))))
+        errors = []
+        for error in scan_errors:
+            self.logger.log_error(error)
+            errors.append(error)
+        for item in sorted(failed_items, key=lambda item: item.sequence):
+            self.logger.log_error(item.error)
+            errors.append(item.error)
+        return errors
+
+
+class _VideoGroup:
+    """Group of clips converted (or remuxed) into one video by ConvertAndMergeVideos."""
+
+    def __init__(self, root, files, destination_path, input_size=None):
+        self.root = root
+        self.files = [fname for _, fname in sorted(files)]
+        self.source_files = [os.path.join(root, fname) for fname in self.files]
+        self.destination_path = destination_path
+        if input_size is None:
+            input_size = sum(os.path.getsize(source_file) for source_file in self.source_files)
+        self.input_size = input_size
+        self.probes = []
+        self.duration = None
+        self.plan = 'encode'
+        self.reason = None
+
+    def to_job(self):
+        """Return the group as a (JSON serializable) job of the conversion journal."""
+        return {
+            'destination': str(self.destination_path),
+            'root': self.root,
+            'files': self.files,
+            'input-size': self.input_size,
+            'probes': self.probes,
+            'duration': self.duration,
+            'plan': self.plan,
+            'reason': self.reason
+        }
+
+    @staticmethod
+    def from_job(job):
+        """Return the group of a job of the conversion journal."""
+        group = _VideoGroup(job['root'], list(enumerate(job['files'])), Path(job['destination']), job['input-size'])
+        group.probes = job['probes']
+        group.duration = job['duration']
+        group.plan = job['plan']
+        group.reason = job['reason']
+        return group
+
+
+class _ConversionProgress:
+    """Progress of a batch of conversions, collected from the `-progress` output of ffmpeg.
+
+    Every conversion reports its frames, frames per second, position and speed (relative
+    to real time). The ETA of a conversion and of the whole batch is based on the durations
+    reported by ffprobe; the batch ETA assumes the running conversions keep their speed.
+    Progress is logged at most every `interval` seconds and passed to `report` (a callable
+    taking a dictionary) every time.
+    """
+
+    def __init__(self, groups, logger, interval, report):
+        self.logger = logger
+        self.interval = interval
+        self.report = report
+        self.lock = threading.Lock()
+        self.total_duration = sum(group.duration or 0 for group in groups)
+        self.completed_duration = 0
+        self.running = {}
+        self.last_logged = None
+
+    def create_parser(self, group):
+        """Return a callback parsing the progress lines of the conversion of `group`."""
+        values = {}
+
+        def parse_line(line):
+            key, separator, value = line.partition('=')
+            if separator != '=':
+                return
+            values[key.strip()] = value.strip()
+            if key.strip() == 'progress':
+                self.update(group, dict(values))
+                values.clear()
+
+        return parse_line
+
+    @staticmethod
+    def _get_float(values, key):
+        try:
+            # Speeds have an 'x' suffix (e.g. '1.25x'), missing values are 'N/A'.
+            return float(values[key].rstrip('x'))
+        except (KeyError, ValueError):
+            return None
+
+    def update(self, group, values):
+        """Update the progress of a conversion with a block of ffmpeg progress values."""
+        # out_time_ms is in microseconds too (a long-standing ffmpeg quirk).
+        position = self._get_float(values, 'out_time_us') or self._get_float(values, 'out_time_ms')
+        progress = {
+            'file': group.destination_path.name,
+            'frames': int(self._get_float(values, 'frame') or 0),
+            'fps': self._get_float(values, 'fps'),
+            'speed': self._get_float(values, 'speed'),
+            'position': position / 1000000 if position is not None else None,
+            'duration': group.duration
+        }
+        with self.lock:
+            if values.get('progress', None) == 'end':
+                self.running.pop(group.destination_path, None)
+                self.completed_duration += group.duration or 0
+            else:
+                self.running[group.destination_path] = progress
+            progress['eta'] = self._get_eta(progress['duration'], progress['position'], progress['speed'])
+            progress.update(self._get_batch_progress())
+            now = time.monotonic()
+            log = self.last_logged is None or now - self.last_logged >= self.interval
+            if log:
+                self.last_logged = now
+                running = list(self.running.values())
+        self.report(progress)
+        if log:
+            for file_progress in running:
+                self._log_file_progress(file_progress)
+            self._log_batch_progress(progress)
+
+    @staticmethod
+    def _get_eta(duration, position, speed):
+        if duration is None or position is None or not speed:
+            return None
+        return max(0, duration - position) / speed
+
+    def _get_batch_progress(self):
+        position = self.completed_duration + sum(
+            min(progress['position'] or 0, progress['duration'] or 0) for progress in self.running.values())
+        speed = sum(progress['speed'] or 0 for progress in self.running.values())
+        return {
+            'batch-position': position,
+            'batch-duration': self.total_duration,
+            'batch-speed': speed,
+            'batch-eta': self._get_eta(self.total_duration, position, speed) if self.running else None
+        }
+
+    def _log_file_progress(self, progress):
+        details = []
+        if progress['position'] is not None and progress['duration']:
+            details.append('{} of {} ({:.0f}%)'.format(
+                bsts_utils.format_duration(progress['position']), bsts_utils.format_duration(progress['duration']),
+                min(100, 100 * progress['position'] / progress['duration'])))
+        details.append('{} frames'.format(progress['frames']))
+        if progress['fps'] is not None:
+            details.append('{:.1f} frames/s'.format(progress['fps']))
+        if progress['speed'] is not None:
+            details.append('speed {:.2f}x'.format(progress['speed']))
+        if progress['eta'] is not None:
+            details.append('ETA {}'.format(bsts_utils.format_duration(progress['eta'])))
+        self.logger.log_info('Progress of {}: {}'.format(progress['file'], ', '.join(details)))
+
+    def _log_batch_progress(self, progress):
+        if not progress['batch-duration']:
+            return
+        self.logger.log_info('Batch progress: {} of {} ({:.0f}%), speed {:.2f}x{}'.format(
+            bsts_utils.format_duration(progress['batch-position']),
+            bsts_utils.format_duration(progress['batch-duration']),
+            min(100, 100 * progress['batch-position'] / progress['batch-duration']), progress['batch-speed'],
+            ', ETA {}'.format(bsts_utils.format_duration(progress['batch-eta']))
+            if progress['batch-eta'] is not None else ''))
+
+
+class _Worker:
+    """Host converting videos for ConvertAndMergeVideos: the local host (host None) or an SSH worker."""
+
+    def __init__(self, host, slots, threads=None, path_map={}, scratch_directory='/tmp'):
+        self.host = host
+        self.slots = slots
+        self.threads = threads
+        # Longest prefix first, so nested shared directories are mapped correctly.
+        self.path_map = sorted(path_map.items(), key=lambda item: -len(item[0]))
+        self.scratch_directory = scratch_directory
+        self.running = 0
+        self.healthy = True
+
+    @staticmethod
+    def from_config(worker_config):
+        """Return the worker of a 'workers' entry: a host or a dictionary with a 'host' key."""
+        if not isinstance(worker_config, dict):
+            worker_config = {'host': worker_config}
+        if 'host' not in worker_config:
+            raise ValueError("Worker without 'host'")
+        slots = int(worker_config.get('slots', 1))
+        threads = worker_config.get('threads', None)
+        return _Worker(worker_config['host'], slots,
+                       max(1, int(threads) // max(1, slots)) if threads is not None else None,
+                       worker_config.get('path-map', {}), worker_config.get('scratch-directory', '/tmp'))
+
+    def map_path(self, path):
+        """Return the path of a local file on the (shared storage of the) worker, or None."""
+        path = str(path)
+        for local_prefix, remote_prefix in self.path_map:
+            local_prefix = local_prefix.rstrip('/')
+            if path == local_prefix or path.startswith(local_prefix + '/'):
+                return remote_prefix.rstrip('/') + path[len(local_prefix):]
+        return None
+
+
+class _WorkerPool:
+    """Conversion slots of the workers of ConvertAndMergeVideos.
+
+    A conversion takes a slot of the least busy healthy worker it didn't try yet (the
+    first worker on a tie), waiting for a slot if all of them are busy.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.condition = threading.Condition()
+
+    def get_slots(self):
+        return sum(worker.slots for worker in self.workers if worker.healthy)
+
+    def acquire(self, excluded=()):
+        """Return a worker with a free slot (or None if no eligible worker is left)."""
+        with self.condition:
+            while True:
+                candidates = [worker for worker in self.workers
+                              if worker.healthy and worker.slots > 0 and worker not in excluded]
+                if len(candidates) == 0:
+                    return None
+                free = [worker for worker in candidates if worker.running < worker.slots]
+                if len(free) > 0:
+                    worker = min(free, key=lambda worker: worker.running / worker.slots)
+                    worker.running += 1
+                    return worker
+                self.condition.wait()
+
+    def release(self, worker, healthy=True):
+        with self.condition:
+            worker.running -= 1
+            worker.healthy = worker.healthy and healthy
+            self.condition.notify_all()
 
 
 class ConvertAndMergeVideos(Action):
+    """Convert (and merge) video clips to HEVC using ffmpeg.
+
+    Every group of clips is probed first (using ffprobe); groups whose clips already use
+    a codec of `remux-codecs` at an acceptable resolution and bit rate are remuxed (stream
+    copied) instead of re-encoded. Groups are converted by up to `max-parallel` ffmpeg
+    processes at the same time, longest input first. The `threads` (by default all
+    processors) are divided between the concurrent conversions. Their progress, throughput
+    and ETA are logged every `progress-interval` seconds.
+
+    Conversions are recorded in a journal (in the state directory), so an interrupted batch
+    is resumed by the next run: temporary files left behind are removed and, if the source
+    tree didn't change, the pending conversions are restarted without scanning and probing
+    the source tree again.
+
+    Conversions can be offloaded to SSH `workers`, each with a number of slots. Workers
+    use the files on shared storage if all paths are mapped by their `path-map`; otherwise
+    the clips are uploaded to a scratch directory and the result is downloaded. Workers
+    are health checked before the batch and after a failed conversion, which is retried
+    on another worker if the worker turns out to be unavailable.
+    """
 
     required_keys = [
         'source-directory',
@@ -83,7 +519,21 @@ class ConvertAndMergeVideos(Action):
         'destination-pattern'
     ]
 
-    optional_keys = {}
+    optional_keys = {
+        'max-parallel': 1,
+        'threads': None,
+        'video-codec': 'libx265',
+        'crf': 26,
+        'preset': 'slow',
+        'audio': 'copy',
+        'remux': True,
+        'remux-codecs': ['hevc'],
+        'remux-max-bitrate': None,
+        'remux-max-height': None,
+        'progress-interval': 60,
+        'journal': True,
+        'workers': []
+    }
 
     def __init__(self, action_config, logger):
         super().__init__(action_config, logger,
@@ -92,13 +542,40 @@ class ConvertAndMergeVideos(Action):
     def has_do(self):
         return True
 
-    def do(self, dry_run):
-        errors = []
+    def _get_journal_filename(self):
+        """Return the file of the conversion journal of this action (one per source and destination)."""
+        key = '\0'.join([str(self.config['source-directory']), str(self.config['destination-directory']),
+                         self.config['destination-pattern']])
+        return os.path.join(bsts_state.get_state_directory(),
+                            'convert-{}.sqlite'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+    def _get_scan_settings(self):
+        """Return the settings the groups and their plans depend on (a rescan is needed if they change)."""
+        keys = ['source-directory', 'source-pattern', 'destination-directory', 'destination-pattern',
+                'remux', 'remux-codecs', 'remux-max-bitrate', 'remux-max-height']
+        return json.loads(json.dumps({key: self.config[key] for key in keys}, default=str))
+
+    @staticmethod
+    def _is_tree_unchanged(directories):
+        """Return True if no files or directories were added to, removed from or renamed in the directories."""
+        try:
+            return len(directories) > 0 and all(
+                os.stat(directory).st_mtime_ns == mtime for directory, mtime in directories.items())
+        except OSError:
+            return False
+
+    def _find_video_groups(self, directories=None):
+        """Return the video files grouped by (directory, movie ID), as a sorted list.
+
+        The mtime of every directory of the source tree is added to `directories` (if given).
+        """
         source_pattern = re.compile(self.config['source-pattern'], re.IGNORECASE)
         # Dictionary to collect video files by their movie ID.
         video_groups = defaultdict(list)
         # Traverse the source directory tree.
         for root, dirs, files in os.walk(self.config['source-directory']):
+            if directories is not None:
+                directories[root] = os.stat(root).st_mtime_ns
             for file in sorted(files):
                 match = source_pattern.match(file)
                 if match:
@@ -108,81 +585,315 @@ class ConvertAndMergeVideos(Action):
                     except IndexError:
                         part = '000'
                     video_groups[key].append((part, file))
-        # Process the grouped video files.
-        for (root, video_id), files in sorted(video_groups.items()):
-            source_files = [os.path.join(root, fname) for _, fname in sorted(files)]
-            source_stat = Path(source_files[-1]).stat()
-            source_isotime = datetime.datetime.fromtimestamp(source_stat.st_mtime).isoformat()
+        return sorted(video_groups.items())
+
+    def _plan_group(self, group):
+        """Probe the clips of a group and decide whether to remux or re-encode them."""
+        group.probes = [bsts_metadata.probe_video(source_file) for source_file in group.source_files]
+        if all(probe is not None and probe['duration'] is not None for probe in group.probes):
+            group.duration = sum(probe['duration'] for probe in group.probes)
+        group.plan, group.reason = 'encode', None
+        if not self.config['remux']:
+            group.reason = 'remuxing disabled'
+        elif any(probe is None for probe in group.probes):
+            group.reason = 'unable to probe clips'
+        elif any(probe['codec'] not in self.config['remux-codecs'] for probe in group.probes):
+            group.reason = 'codec {}'.format(', '.join(sorted(set(str(probe['codec']) for probe in group.probes))))
+        elif len(set((probe['codec'], probe['width'], probe['height'], probe['pixel-format'], probe['audio-codec'])
+                     for probe in group.probes)) > 1:
+            # Clips can only be concatenated without re-encoding if their streams match.
+            group.reason = 'clips differ in codec, resolution or audio'
+        elif self.config['remux-max-height'] is not None and \
+                group.probes[0]['height'] > int(self.config['remux-max-height']):
+            group.reason = 'height {} above {}'.format(group.probes[0]['height'], self.config['remux-max-height'])
+        elif self.config['remux-max-bitrate'] is not None and any(
+                probe['bit-rate'] is None or probe['bit-rate'] > int(self.config['remux-max-bitrate']) * 1000
+                for probe in group.probes):
+            group.reason = 'bit rate above {} kbit/s'.format(self.config['remux-max-bitrate'])
+        else:
+            probe = group.probes[0]
+            group.plan = 'remux'
+            group.reason = '{} {}x{}{}'.format(
+                probe['codec'], probe['width'], probe['height'],
+                ' at {} kbit/s'.format(max(probe['bit-rate'] or 0 for probe in group.probes) // 1000)
+                if all(probe['bit-rate'] is not None for probe in group.probes) else '')
+
+    def _get_thread_budget(self, concurrent_jobs):
+        """Return the number of threads of every conversion if `concurrent_jobs` run at once."""
+        threads = int(self.config['threads'] or os.cpu_count() or 1)
+        return max(1, threads // max(1, concurrent_jobs))
+
+    def _compose_audio_arguments(self):
+        """Return the ffmpeg arguments of the audio setting: 'copy', 'none' or 'codec[:bitrate]'."""
+        audio = str(self.config['audio'])
+        if audio == 'copy':
+            return ['-c:a', 'copy']
+        if audio == 'none':
+            return ['-an']
+        codec, _, bitrate = audio.partition(':')
+        return ['-c:a', codec, *(['-b:a', bitrate] if bitrate else [])]
+
+    def _compose_convert_command(self, group, source_isotime, list_file_path, threads,
+                                 source_files=None, destination_path_tmp=None):
+        """Return the ffmpeg command converting a group (by default from and to its local files)."""
+        source_files = source_files or group.source_files
+        destination_path_tmp = destination_path_tmp or str(group.destination_path.with_suffix('.tmp'))
+        if len(source_files) == 1:
+            input_arguments = ['-i', source_files[0]]
+        else:
+            input_arguments = ['-safe', '0', '-f', 'concat', '-i', list_file_path]
+        if group.plan == 'remux':
+            video_arguments = ['-c:v', 'copy', *(['-tag:v', 'hvc1'] if group.probes[0]['codec'] == 'hevc' else [])]
+        else:
+            video_arguments = ['-c:v', self.config['video-codec'],
+                               '-crf', str(self.config['crf']), '-preset', self.config['preset']]
+            # Without a thread count (for workers), ffmpeg uses all processors of the host.
+            if threads is not None:
+                video_arguments.extend(['-threads', str(threads)])
+            if threads is not None and self.config['video-codec'] == 'libx265':
+                video_arguments.extend(['-x265-params', 'pools={}'.format(threads)])
+        metadata_arguments = ['-metadata', f'creation_time="{source_isotime}'] if len(group.source_files) == 1 else []
+        return ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-progress', 'pipe:1', '-nostats',
+                *input_arguments, *video_arguments, *self._compose_audio_arguments(),
+                '-f', 'mp4', *metadata_arguments,
+                destination_path_tmp]
+
+    def _check_worker(self, worker):
+        """Return True if ffmpeg can be started on a worker."""
+        exit_codes, _, _ = self._run_processes([['ssh', worker.host, 'ffmpeg -version > /dev/null']])
+        return exit_codes == [0]
+
+    def _convert_group_on_pool(self, group, pool, progress=None, journal=None):
+        """Convert one group of clips on a worker of the pool, retrying on another worker if it's unavailable."""
+        tried = []
+        while True:
+            worker = pool.acquire(tried)
+            if worker is None:
+                error = 'No worker available to convert {}'.format(group.destination_path.name)
+                self.logger.log_error(error)
+                return [error]
+            tried.append(worker)
+            healthy = True
+            try:
+                errors = self._convert_group(group, worker, progress, journal)
+                if len(errors) > 0 and worker.host is not None:
+                    healthy = self._check_worker(worker)
+            finally:
+                pool.release(worker, healthy)
+            if healthy:
+                return errors
+            self.logger.log_warning('Worker {} is unavailable, retrying {} on another worker'.format(
+                worker.host, group.destination_path.name))
+
+    @staticmethod
+    def _get_scratch_directory(group, worker):
+        """Return the scratch directory of the conversion of a group on an SSH worker."""
+        return posixpath.join(worker.scratch_directory, 'bsts-{}'.format(
+            hashlib.sha1(str(group.destination_path).encode('utf-8')).hexdigest()[:16]))
+
+    def _run_remote_conversion(self, group, worker, source_isotime, progress):
+        """Convert a group on an SSH worker to the local temporary file of its destination."""
+        destination_path_tmp = group.destination_path.with_suffix('.tmp')
+        directory = self._get_scratch_directory(group, worker)
+        source_files = [worker.map_path(source_file) for source_file in group.source_files]
+        output = worker.map_path(destination_path_tmp)
+        shared = output is not None and all(source_file is not None for source_file in source_files)
+        steps = [([['ssh', worker.host, 'rm -rf {0} && mkdir -p {0}'.format(shlex.quote(directory))]], {})]
+        if not shared:
+            # Upload the clips to the scratch directory and download the result afterwards.
+            source_files = [posixpath.join(directory, '{}{}'.format(index, os.path.splitext(source_file)[1]))
+                            for index, source_file in enumerate(group.source_files)]
+            output = posixpath.join(directory, 'output.tmp')
+            steps.extend(([['cat', local_file], ['ssh', worker.host, 'cat > {}'.format(shlex.quote(remote_file))]], {})
+                         for local_file, remote_file in zip(group.source_files, source_files))
+        list_file_path = posixpath.join(directory, 'list.txt')
+        if len(source_files) > 1:
+            steps.append(([['printf', '%s', '\n'.join([f"file '{f}'" for f in source_files])],
+                           ['ssh', worker.host, 'cat > {}'.format(shlex.quote(list_file_path))]], {}))
+        convert_command = self._compose_convert_command(
+            group, source_isotime, list_file_path, worker.threads, source_files, output)
+        steps.append(([['ssh', worker.host, ' '.join(shlex.quote(argument) for argument in convert_command)]],
+                      {'stdout_callback': progress.create_parser(group) if progress is not None else None}))
+        if not shared:
+            steps.append(([['ssh', worker.host, 'cat {}'.format(shlex.quote(output))]],
+                          {'stdout_filename': str(destination_path_tmp)}))
+        errors = []
+        for commands, arguments in steps:
+            exit_codes, stdouts, stderrs = self._run_processes(commands, **arguments)
+            errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
+            if len(errors) > 0:
+                break
+        self._run_processes([['ssh', worker.host, 'rm -rf {}'.format(shlex.quote(directory))]])
+        return errors
+
+    def _run_local_conversion(self, group, source_isotime, threads, progress, journal):
+        """Convert a group on the local host to the temporary file of its destination."""
+        destination_path_tmp = group.destination_path.with_suffix('.tmp')
+        temp_file_path = None
+        if len(group.source_files) > 1:
+            # Create a temporary file with the input video files.
+            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as temp_file:
+                temp_file.write('\n'.join([f"file '{f}'" for f in group.source_files]))
+                temp_file_path = temp_file.name
+        if journal is not None:
+            journal.set_status(str(group.destination_path), 'running',
+                               [destination_path_tmp, *([temp_file_path] if temp_file_path is not None else [])])
+        # Convert the video files using ffmpeg.
+        commands = [self._compose_convert_command(group, source_isotime, temp_file_path, threads)]
+        exit_codes, stdouts, stderrs = self._run_processes(
+            commands, stdout_callback=progress.create_parser(group) if progress is not None else None)
+        # Process the output of the command.
+        cmd_errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
+        if temp_file_path is not None:
+            # Remove the temporary file.
+            bsts_utils.remove_file(None, temp_file_path)
+        return cmd_errors
+
+    def _convert_group(self, group, worker, progress=None, journal=None):
+        """Convert one group of clips (on a worker) to a temporary file and rename it if successful."""
+        errors = []
+        source_stat = Path(group.source_files[-1]).stat()
+        source_isotime = datetime.datetime.fromtimestamp(source_stat.st_mtime).isoformat()
+        destination_path = group.destination_path
+        destination_directory = destination_path.parent
+        destination_path_tmp = destination_path.with_suffix('.tmp')
+        if not os.path.exists(destination_directory):
+            self.logger.log_debug(
+                'Creating directory {}'.format(destination_directory))
+            os.makedirs(destination_directory, exist_ok=True)
+        self.logger.log_info('{} {} to {} ({}){}'.format(
+            'Remuxing' if group.plan == 'remux' else 'Converting',
+            ' + '.join(group.files), destination_path.name, group.reason,
+            ' on {}'.format(worker.host) if worker.host is not None else ''))
+        if worker.host is None:
+            cmd_errors = self._run_local_conversion(group, source_isotime, worker.threads, progress, journal)
+        else:
+            if journal is not None:
+                journal.set_status(str(destination_path), 'running',
+                                   [destination_path_tmp, [worker.host, self._get_scratch_directory(group, worker)]])
+            cmd_errors = self._run_remote_conversion(group, worker, source_isotime, progress)
+        errors.extend(cmd_errors)
+        if len(cmd_errors) > 0:
+            bsts_utils.remove_file(None, destination_path_tmp)
+        else:
+            bsts_utils.rename_file(None, destination_path_tmp, destination_path)
+            os.utime(destination_path, (source_stat.st_atime, source_stat.st_mtime))
+        if journal is not None:
+            journal.set_status(str(destination_path), 'failed' if len(cmd_errors) > 0 else 'done')
+        return errors
+
+    def _log_plan(self, groups):
+        remuxed = [group for group in groups if group.plan == 'remux']
+        saved_duration = sum(group.duration or 0 for group in remuxed)
+        self.logger.log_info('Plan: remux {} and re-encode {} video(s); remuxing avoids re-encoding {} '
+                             'of video and keeps {} of clips as they are'.format(
+                                 len(remuxed), len(groups) - len(remuxed), bsts_utils.format_duration(saved_duration),
+                                 bsts_utils.format_size(sum(group.input_size for group in remuxed))))
+
+    def _scan_video_groups(self, directories=None):
+        """Scan the source tree and return the (planned) groups that weren't converted yet."""
+        groups = []
+        for (root, video_id), files in self._find_video_groups(directories):
             # Determine common output path.
             relative_path = Path(root).relative_to(self.config['source-directory'])
             destination_directory = self.config['destination-directory'] / relative_path
             destination_filename = self.config['destination-pattern'].format(video_id=video_id)
             destination_path = destination_directory / destination_filename
-            destination_path_tmp = destination_path.with_suffix('.tmp')
-            # Generate the output file.
             if not os.path.isfile(destination_path):
-                if not dry_run:
-                    if not os.path.exists(destination_directory):
-                        self.logger.log_debug(
-                            'Creating directory {}'.format(destination_directory))
-                        os.makedirs(destination_directory)
-                    self.logger.log_info('Converting {} to {}'.format(
-                        ' + '.join([fname for _, fname in sorted(files)]), destination_filename))
-                    if len(source_files) == 1:
-                        # Convert the video files using ffmpeg.
-                        convert_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
-                                       '-i', source_files[0],
-                                       '-c:v', 'libx265', '-crf', '26', '-preset', 'slow', '-c:a', 'copy',
-                                       '-f', 'mp4', '-metadata', f'creation_time="{source_isotime}',
-                                       destination_path_tmp]
-                        commands = [convert_cmd]
-                        exit_codes, stdouts, stderrs = bsts_utils.run_processes(commands, None, self.logger)
-                        # Process the output of the command.
-                        cmd_errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
-                        errors.extend(cmd_errors)
-                        if len(cmd_errors) > 0:
-                            bsts_utils.remove_file(None, destination_path_tmp)
-                        else:
-                            bsts_utils.rename_file(None, destination_path_tmp, destination_path)
-                            os.utime(destination_path, (source_stat.st_atime, source_stat.st_mtime))
-                    else:
-                        # Create a temporary file with the input video files.
-                        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as temp_file:
-                            temp_file.write('\n'.join([f"file '{f}'" for f in source_files]))
-                            temp_file_path = temp_file.name
-                        # Convert the video files using ffmpeg.
-                        convert_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
-                                       '-safe', '0', '-f', 'concat', '-i', temp_file_path,
-                                       '-c:v', 'libx265', '-crf', '26', '-preset', 'slow', '-c:a', 'copy',
-                                       '-f', 'mp4',
-                                       destination_path_tmp]
-                        commands = [convert_cmd]
-                        exit_codes, stdouts, stderrs = bsts_utils.run_processes(commands, None, self.logger)
-                        # Process the output of the command.
-                        cmd_errors = bsts_utils.log_subprocess_errors(commands, exit_codes, stdouts, stderrs, self.logger)
-                        errors.extend(cmd_errors)
-                        if len(cmd_errors) > 0:
-                            bsts_utils.remove_file(None, destination_path_tmp)
-                        else:
-                            bsts_utils.rename_file(None, destination_path_tmp, destination_path)
-                            os.utime(destination_path, (source_stat.st_atime, source_stat.st_mtime))
-                        # Remove the temporary file.
-                        bsts_utils.remove_file(None, temp_file_path)
-                else:
-                    # Show what would be converted
-                    if len(source_files) == 1:
-                        convert_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
-                                       '-i', source_files[0],
-                                       '-c:v', 'libx265', '-crf', '26', '-preset', 'slow', '-c:a', 'copy',
-                                       '-f', 'mp4', '-metadata', f'creation_time="{source_isotime}',
-                                       destination_path_tmp]
-                    else:
-                        convert_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
-                                       '-safe', '0', '-f', 'concat', '-i', '<temp_file>',
-                                       '-c:v', 'libx265', '-crf', '26', '-preset', 'slow', '-c:a', 'copy',
-                                       '-f', 'mp4',
-                                       destination_path_tmp]
-                    self.logger.log_info('Would run: {}'.format(' '.join(str(arg) for arg in convert_cmd)))
+                group = _VideoGroup(root, files, destination_path)
+                self._plan_group(group)
+                groups.append(group)
             else:
                 self.logger.log_debug('Skipping {}'.format(destination_filename))
-        return errors
\ No newline at end of file
+        return groups
+
+    def _remove_scratch_directory(self, host, directory):
+        """Remove the scratch directory of an interrupted conversion on an SSH worker."""
+        self.logger.log_info('Removing orphaned scratch directory {}:{}'.format(host, directory))
+        exit_codes, _, _ = self._run_processes([['ssh', host, 'rm -rf {}'.format(shlex.quote(directory))]])
+        if exit_codes != [0]:
+            self.logger.log_warning('Unable to remove scratch directory {}:{}'.format(host, directory))
+
+    def _resume_video_groups(self, journal):
+        """Return the unfinished groups of the journal (or None if the source tree must be scanned again)."""
+        # Remove the temporary files of the conversions that were interrupted.
+        for job in journal.get_jobs(['running']):
+            for filename in job['temporary-files']:
+                if isinstance(filename, list):
+                    # Scratch directory on an SSH worker.
+                    self._remove_scratch_directory(*filename)
+                elif os.path.exists(filename):
+                    self.logger.log_info('Removing orphaned temporary file {}'.format(filename))
+                    bsts_utils.remove_file(None, filename)
+            journal.set_status(job['destination'], 'planned')
+        scan = journal.get_scan()
+        if scan is None or scan[0] != self._get_scan_settings() or not self._is_tree_unchanged(scan[1]):
+            return None
+        groups = []
+        for job in journal.get_jobs():
+            # Converted videos that were removed since are converted again (as a rescan would).
+            group = _VideoGroup.from_job(job)
+            if not os.path.isfile(group.destination_path):
+                groups.append(group)
+            elif job['status'] != 'done':
+                journal.set_status(job['destination'], 'done')
+        self.logger.log_info('Source tree unchanged, resuming {} pending conversion(s)'.format(len(groups)))
+        return groups
+
+    def do(self, dry_run):
+        # Dry runs don't touch the journal.
+        journal = None
+        if self.config['journal'] and not dry_run:
+            journal = bsts_state.ConversionJournal(self._get_journal_filename())
+        try:
+            errors = self._do(dry_run, journal)
+        finally:
+            if journal is not None:
+                journal.close()
+        return errors
+
+    def _do(self, dry_run, journal):
+        errors = []
+        groups = self._resume_video_groups(journal) if journal is not None else None
+        if groups is None:
+            directories = {}
+            groups = self._scan_video_groups(directories)
+            if journal is not None:
+                journal.start_batch(self._get_scan_settings(), directories, [group.to_job() for group in groups])
+        # Longest input first (by duration if all clips could be probed, by size otherwise),
+        # so the last conversions are short.
+        if all(group.duration is not None for group in groups):
+            groups.sort(key=lambda group: -group.duration)
+        else:
+            groups.sort(key=lambda group: -group.input_size)
+        workers = [_Worker.from_config(worker_config) for worker_config in self.config['workers']]
+        # With workers, the local host may be left out (max-parallel 0).
+        max_parallel = max(0 if len(workers) > 0 else 1, int(self.config['max-parallel']))
+        threads = self._get_thread_budget(min(max_parallel, len(groups)))
+        if len(groups) > 0:
+            self._log_plan(groups)
+        if not dry_run and len(groups) > 0:
+            for worker in workers:
+                worker.healthy = self._check_worker(worker)
+                if not worker.healthy:
+                    self.logger.log_warning('Worker {} is unavailable'.format(worker.host))
+            pool = _WorkerPool([_Worker(None, max_parallel, threads), *workers])
+            progress = _ConversionProgress(
+                groups, self.logger, float(self.config['progress-interval']), self._report_progress)
+            scheduler = bsts_scheduler.JobScheduler(max(1, pool.get_slots()))
+            results = scheduler.run([
+                (functools.partial(self._convert_group_on_pool, group, pool, progress, journal), ())
+                for group in groups])
+            for job_errors in results:
+                errors.extend(job_errors)
+        elif dry_run:
+            for group in groups:
+                # Show what would be converted
+                source_isotime = datetime.datetime.fromtimestamp(
+                    Path(group.source_files[-1]).stat().st_mtime).isoformat()
+                self.logger.log_info('Would {}: {} -> {} ({})'.format(
+                    'remux' if group.plan == 'remux' else 're-encode',
+                    ' + '.join(group.files), group.destination_path.name, group.reason))
+                convert_cmd = self._compose_convert_command(group, source_isotime, '<temp_file>', threads)
+                self.logger.log_info('Would run: {}'.format(' '.join(str(arg) for arg in convert_cmd)))
+        return errors
@@ -71,16 +71,16 @@ class UpdateGitAnnex(Action):
             command, cwd = self._compose_sync_command()
             commands = [command]
             try:
-                exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                    commands, None, self.logger, cwd=cwd)
+                exit_codes, stdouts, stderrs = self._run_processes(
+                    commands, cwd=cwd)
                 errors.extend(bsts_utils.log_subprocess_errors(
                     commands, exit_codes, stdouts, stderrs, self.logger))
                 if exit_codes[0] == 0:
                     # git annex get
                     command, cwd = self._compose_get_command()
                     commands = [command]
-                    exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                        commands, None, self.logger, cwd=cwd)
+                    exit_codes, stdouts, stderrs = self._run_processes(
+                        commands, cwd=cwd)
                     errors.extend(bsts_utils.log_subprocess_errors(
                         commands, exit_codes, stdouts, stderrs, self.logger))
             except FileNotFoundError as e:
@@ -111,7 +111,22 @@ class UpdateGitAnnex(Action):
         ]
         return self._wrap_command_with_ssh(git_annex_command)
 
-    def verify(self, dry_run):
+    def get_verify_identity(self):
+        return '{}:{}'.format(self.config['destination-host'] or 'localhost',
+                              self.config['destination-directory'])
+
+    def get_verify_fingerprint(self):
+        """Return the commits of the current and the git-annex branch."""
+        command, cwd = self._wrap_command_with_ssh(['git', 'rev-parse', 'HEAD', 'git-annex'])
+        try:
+            exit_code, output = bsts_utils.capture_output(command, cwd)
+        except OSError:
+            return None
+        if exit_code != 0:
+            return None
+        return {'commits': output.split()}
+
+    def verify(self, dry_run, mode='deep'):
         self.logger.log_debug(
             "Verifying '{}' action".format(self.__class__.__name__))
         errors = []
@@ -120,8 +135,8 @@ class UpdateGitAnnex(Action):
             command, cwd = self._compose_fsck_command()
             commands = [command]
             try:
-                exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                    commands, None, self.logger, cwd=cwd)
+                exit_codes, stdouts, stderrs = self._run_processes(
+                    commands, cwd=cwd)
                 errors.extend(bsts_utils.log_subprocess_errors(
                     commands, exit_codes, stdouts, stderrs, self.logger))
             except FileNotFoundError as e:
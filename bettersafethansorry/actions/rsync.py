@@ -39,6 +39,8 @@ class RsyncFiles(Action):
         else:
             exclude_list = ["--exclude='{}'".format(excluded.replace(
                 "'", "\\'")) for excluded in self.config['excludes']]
+        # Rsync sends the data itself, so it's limited by rsync instead of a token bucket.
+        bandwidth_limit = self.resource_limits.get_bandwidth_limit()
         rsync_command = [
             'rsync',
             '--archive',
@@ -49,6 +51,7 @@ class RsyncFiles(Action):
             *(['--copy-links'] if self.config['follow-symlinks'] else []),
             *(['--fuzzy', '--delete-delay', '--delay-updates']
               if self.config['optimize-renames'] else []),
+            *(['--bwlimit={}'.format(max(1, bandwidth_limit // 1024))] if bandwidth_limit is not None else []),
             source,
             destination
         ]
@@ -74,8 +77,8 @@ class RsyncFiles(Action):
             "Executing '{}' action".format(self.__class__.__name__))
         errors = []
         if not dry_run:
-            exit_codes, stdouts, stderrs = bsts_utils.run_processes(
-                commands, None, self.logger)
+            exit_codes, stdouts, stderrs = self._run_processes(
+                commands)
             errors.extend(bsts_utils.log_subprocess_errors(
                 commands, exit_codes, stdouts, stderrs, self.logger))
         else:
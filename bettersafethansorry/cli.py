@@ -2,8 +2,16 @@ import argparse
 import bettersafethansorry.configuration as bsts_configuration
 import bettersafethansorry.operation as bsts_operation
 import bettersafethansorry.logging as bsts_logging
+import bettersafethansorry.resources as bsts_resources
+import bettersafethansorry.scheduler as bsts_scheduler
+import bettersafethansorry.ssh as bsts_ssh
+import bettersafethansorry.state as bsts_state
+import bettersafethansorry.utilities as bsts_utils
+import copy
 import errno
+import fnmatch
 import os
+import sqlite3
 import sys
 import yaml
 
@@ -20,6 +28,8 @@ def main():
         command_line_arguments = parse_command_line_arguments()
         get_configuration(command_line_arguments)
         configure_additional_loggers()
+        bsts_ssh.configure(configuration.get_ssh_config())
+        bsts_resources.configure(configuration.get_resources_config())
     except Exception as exception:
         logger.log_error(f'Unkown command "{command}"')
         raise
@@ -36,18 +46,37 @@ def main():
             else:
                 return_value = 127
         elif command == 'show':
-            selected_backup = command_line_arguments.backup
+            selected_backup = get_single_backup(command_line_arguments)
             print_configuration_of_backup(selected_backup)
             return_value = 0
         elif command == 'do':
-            selected_backup = command_line_arguments.backup
-            run_only_when_outdated = True if command_line_arguments.auto else False
+            run_only_when_outdated = True if command_line_arguments.auto or command_line_arguments.outdated else False
             dry_run = True if command_line_arguments.dry_run else False
-            return_value = do_backup(selected_backup, run_only_when_outdated, dry_run)
+            if selects_multiple_backups(command_line_arguments):
+                selected_backups = select_backups(command_line_arguments)
+                return_value = do_backups(
+                    selected_backups, run_only_when_outdated, dry_run, get_max_parallel(command_line_arguments))
+            else:
+                selected_backup = get_single_backup(command_line_arguments)
+                return_value = do_backup(selected_backup, run_only_when_outdated, dry_run)
         elif command == 'verify':
-            selected_backup = command_line_arguments.backup
             dry_run = True if command_line_arguments.dry_run else False
-            return_value = verify_backup(selected_backup, dry_run)
+            mode = 'quick' if command_line_arguments.quick else 'deep'
+            if command_line_arguments.outdated:
+                logger.log_error("'--outdated' can't be used with 'verify'")
+                raise Exception("'--outdated' can't be used with 'verify'")
+            verify_options = get_verify_options(command_line_arguments, dry_run)
+            try:
+                if selects_multiple_backups(command_line_arguments) or verify_options['budget'] is not None:
+                    selected_backups = select_backups(command_line_arguments)
+                    return_value = verify_backups(
+                        selected_backups, dry_run, mode, get_max_parallel(command_line_arguments), verify_options)
+                else:
+                    selected_backup = get_single_backup(command_line_arguments)
+                    return_value = verify_backup(selected_backup, dry_run, mode, verify_options)
+            finally:
+                if verify_options['index'] is not None:
+                    verify_options['index'].close()
         else:
             logger.log_error(f'Unkown command "{command}"')
             raise Exception(f'Unkown command "{command}"')
@@ -57,6 +86,8 @@ def main():
         #     f'An error occured during command "{command}": "{exception}"')
         # raise
         return_value = 1
+    finally:
+        bsts_ssh.close_sessions(logger)
 
     return return_value
 
@@ -66,13 +97,38 @@ def parse_command_line_arguments():
         description='Better Safe Than Sorry. Custom backups made easy.')
     parser.add_argument('command',
                         help="Command ('list', 'status', 'show', 'do' or 'verify')")
-    parser.add_argument('backup', nargs='?',
-                        help="Select backup (for 'show', 'do' or 'verify')")
+    parser.add_argument('backup', nargs='*',
+                        help="Select backup (for 'show', 'do' or 'verify'); 'do' and 'verify' accept several backups and glob patterns")
     parser.add_argument('-c', '--config',
                         help='Select config file')
     parser.add_argument('-a', '--auto',
                         help="Only perform backup if it's outdated",
                         action='store_true')
+    parser.add_argument('--all',
+                        help="Select all backups (for 'do' or 'verify')",
+                        action='store_true')
+    parser.add_argument('--outdated',
+                        help="Select all outdated backups (for 'do')",
+                        action='store_true')
+    parser.add_argument('-t', '--tag', action='append', default=[],
+                        help="Select backups with this tag (for 'do' or 'verify'; can be repeated)")
+    parser.add_argument('-j', '--max-parallel', type=int, default=None,
+                        help="Maximum number of actions running at the same time when running or verifying several backups "
+                             "(default: 'max-parallel' of the configuration file, or 1)")
+    verify_mode = parser.add_mutually_exclusive_group()
+    verify_mode.add_argument('--quick',
+                             help="Only compare checksums of archives with their checksum files (for 'verify')",
+                             action='store_true')
+    verify_mode.add_argument('--deep',
+                             help="Decompress and check all archives (for 'verify', default)",
+                             action='store_true')
+    parser.add_argument('-f', '--force',
+                        help="Verify artifacts that didn't change since their last verification too (for 'verify')",
+                        action='store_true')
+    parser.add_argument('--max-age',
+                        help="Verify unchanged artifacts again if their last verification is older than MAX_AGE, e.g. '30d' (for 'verify')")
+    parser.add_argument('--budget',
+                        help="Only verify what fits in this time budget, e.g. '4h', longest unverified first (for 'verify')")
     parser.add_argument('-n', '--dry-run',
                         help='Only display actions',
                         action='store_true')
@@ -122,8 +178,10 @@ def print_status_of_configured_backups():
     status_strings = {None: ('No information available', '?'),
                       False: ('Up to date', '+'),
                       True: ('Outdated', '-')}
-    for backup, description in configuration.list_backups_and_descriptions().items():
-        status = logger.is_backup_outdated(backup)
+    backups_and_descriptions = configuration.list_backups_and_descriptions()
+    outdated = query_outdated_backups(backups_and_descriptions.keys())
+    for backup, description in backups_and_descriptions.items():
+        status = outdated[backup]
         statuses[status].append((backup, description))
     for category in (None, False, True):
         if len(statuses[category]) > 0:
@@ -144,9 +202,11 @@ def get_postprocessed_backup_configuration(backup):
         logger.log_error('No backup specified')
         raise Exception('No backup specified')
     try:
-        backup_configuration = configuration.get_backup_config(backup)
+        # Process a copy, includes and variables are popped from the configuration.
+        full_configuration = copy.deepcopy(configuration.get_full_config())
+        backup_configuration = full_configuration['backups'][backup]
         backup_configuration = bsts_configuration.process_includes(
-            backup_configuration, configuration.get_full_config())
+            backup_configuration, full_configuration)
         backup_configuration = bsts_configuration.process_variables(
             backup_configuration)
         return backup_configuration
@@ -160,6 +220,93 @@ def print_configuration_of_backup(backup):
     print(yaml.dump({backup: get_postprocessed_backup_configuration(backup)}))
 
 
+def get_single_backup(command_line_arguments):
+    backups = command_line_arguments.backup
+    if len(backups) > 1:
+        logger.log_error('Only one backup can be selected for this command')
+        raise Exception('Only one backup can be selected for this command')
+    return backups[0] if len(backups) == 1 else None
+
+
+def selects_multiple_backups(command_line_arguments):
+    return command_line_arguments.all or command_line_arguments.outdated \
+        or len(command_line_arguments.tag) > 0 or len(command_line_arguments.backup) > 1 \
+        or any(character in backup for backup in command_line_arguments.backup for character in '*?[')
+
+
+def get_max_parallel(command_line_arguments):
+    """Return the global limit of a multi-backup run: '--max-parallel', the configured limit or 1."""
+    global configuration
+    if command_line_arguments.max_parallel is not None:
+        return max(1, command_line_arguments.max_parallel)
+    return configuration.get_max_parallel()
+
+
+def select_backups(command_line_arguments):
+    """Select backups by name or glob pattern and filter them by tag.
+
+    Without names or patterns, all backups are selected (if '--all', '--outdated' or
+    '--tag' is used).
+    """
+    global configuration
+    available_backups = list(configuration.list_backups())
+    patterns = command_line_arguments.backup
+    if command_line_arguments.all or len(patterns) == 0:
+        selected_backups = available_backups
+    else:
+        selected_backups = []
+        for pattern in patterns:
+            matches = fnmatch.filter(available_backups, pattern)
+            if len(matches) == 0:
+                logger.log_error(f'No backup matching "{pattern}" found in configuration file')
+                raise Exception(f'No backup matching "{pattern}" found in configuration file')
+            selected_backups.extend(
+                backup for backup in matches if backup not in selected_backups)
+    tags = set(command_line_arguments.tag)
+    if len(tags) > 0:
+        selected_backups = [
+            backup for backup in selected_backups
+            if tags & set(get_postprocessed_backup_configuration(backup).get('tags', []))]
+    return selected_backups
+
+
+def query_outdated_backups(backups):
+    """Query the loggers concurrently whether the backups are outdated."""
+    global logger
+    scheduler = bsts_scheduler.JobScheduler(8)
+    backups = list(backups)
+    statuses = scheduler.run(
+        [(lambda backup=backup: logger.is_backup_outdated(backup), ()) for backup in backups])
+    return dict(zip(backups, statuses))
+
+
+def do_backups(backups, run_only_when_outdated, dry_run, max_parallel):
+    global configuration, logger
+    skipped_backups = []
+    if run_only_when_outdated:
+        outdated = query_outdated_backups(backups)
+        skipped_backups = [backup for backup in backups if outdated[backup] is False]
+        backups = [backup for backup in backups if outdated[backup] is not False]
+    results = bsts_operation.run_backups(
+        [(backup, get_postprocessed_backup_configuration(backup)) for backup in backups],
+        dry_run, logger, max_parallel)
+    # Log a summary of all backups.
+    logger.log_info('Summary:')
+    failed_backups = 0
+    for backup, errors in results:
+        if errors is not None and len(errors) > 0:
+            logger.log_info(f'- {backup}: failed with {len(errors)} error(s)')
+            failed_backups += 1
+        else:
+            logger.log_info(f'+ {backup}: completed')
+    for backup in skipped_backups:
+        logger.log_info(f'= {backup}: up to date, skipped')
+    if failed_backups > 0:
+        logger.log_error(f'{failed_backups} of {len(results)} backup(s) failed')
+        return 1
+    return 0
+
+
 def do_backup(backup, run_only_when_outdated, dry_run):
     global configuration, logger
     if run_only_when_outdated is False or logger.is_backup_outdated(backup) is not False:
@@ -171,10 +318,55 @@ def do_backup(backup, run_only_when_outdated, dry_run):
     return 0
 
 
-def verify_backup(backup, dry_run):
+def get_verify_options(command_line_arguments, dry_run):
+    """Return the verification index and the force, maximum age and budget options.
+
+    Dry runs don't use (or create) the verification index; otherwise the caller closes it.
+    """
+    try:
+        max_age = bsts_utils.parse_duration(command_line_arguments.max_age) \
+            if command_line_arguments.max_age is not None else None
+        budget = bsts_utils.parse_duration(command_line_arguments.budget) \
+            if command_line_arguments.budget is not None else None
+    except ValueError as error:
+        logger.log_error(str(error))
+        raise
+    index = None
+    if not dry_run:
+        try:
+            index = bsts_state.VerificationIndex()
+        except (OSError, sqlite3.Error) as error:
+            logger.log_warning(f'Unable to open verification index, verifying everything: {error}')
+    return {'index': index, 'force': command_line_arguments.force, 'max_age': max_age, 'budget': budget}
+
+
+def verify_backups(backups, dry_run, mode, max_parallel, verify_options):
+    global configuration, logger
+    results = bsts_operation.run_verifies(
+        [(backup, get_postprocessed_backup_configuration(backup)) for backup in backups],
+        dry_run, logger, mode, max_parallel, **verify_options)
+    # Log a summary of all verifications.
+    logger.log_info('Summary:')
+    failed_backups = 0
+    for backup, errors, deferred in results:
+        if errors is not None and len(errors) > 0:
+            logger.log_info(f'- {backup}: failed with {len(errors)} error(s)')
+            failed_backups += 1
+        elif deferred > 0:
+            logger.log_info(f'= {backup}: {deferred} action(s) deferred')
+        else:
+            logger.log_info(f'+ {backup}: verified')
+    if failed_backups > 0:
+        logger.log_error(f'Verification of {failed_backups} of {len(results)} backup(s) failed')
+        return 1
+    return 0
+
+
+def verify_backup(backup, dry_run, mode, verify_options):
     global configuration, logger
     errors = bsts_operation.run_verify(
-        backup, get_postprocessed_backup_configuration(backup), dry_run, logger)
+        backup, get_postprocessed_backup_configuration(backup), dry_run, logger, mode,
+        index=verify_options['index'], force=verify_options['force'], max_age=verify_options['max_age'])
     if errors is not None and len(errors) > 0:
         logger.log_error(f'Verification failed with {len(errors)} error(s)')
         return 1
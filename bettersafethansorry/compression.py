@@ -0,0 +1,135 @@
+import os.path
+import re
+import bettersafethansorry.utilities as bsts_utils
+
+
+# Compression programs and the codec (file format) they implement.
+PROGRAMS = {
+    'gzip': 'gzip',
+    'pigz': 'gzip',
+    'bzip2': 'bzip2',
+    'lbzip2': 'bzip2',
+    'pbzip2': 'bzip2',
+    'xz': 'xz',
+    'zstd': 'zstd',
+    'lz4': 'lz4'
+}
+
+# Other names of the codecs.
+ALIASES = {
+    'gz': 'gzip',
+    'gunzip': 'gzip',
+    'bz2': 'bzip2',
+    'bunzip2': 'bzip2',
+    'unxz': 'xz',
+    'zst': 'zstd',
+    'unzstd': 'zstd'
+}
+
+# Multithreaded implementations of codecs whose reference program is single threaded,
+# in order of preference.
+PARALLEL_PROGRAMS = {
+    'gzip': ['pigz'],
+    'bzip2': ['lbzip2', 'pbzip2']
+}
+
+OPTIONS = ['level', 'threads']
+
+
+def _compose_thread_arguments(program, threads):
+    if threads is None or program not in ('pigz', 'lbzip2', 'pbzip2', 'xz', 'zstd'):
+        return []
+    if threads == 'auto':
+        # pigz, lbzip2 and pbzip2 use all processors by default.
+        return ['-T0'] if program in ('xz', 'zstd') else []
+    return {
+        'pigz': ['-p', threads],
+        'lbzip2': ['-n', threads],
+        'pbzip2': ['-p{}'.format(threads)],
+        'xz': ['-T{}'.format(threads)],
+        'zstd': ['-T{}'.format(threads)]
+    }[program]
+
+
+class CompressionProfile:
+    """Compression setting of an action, expanded to compress and decompress commands.
+
+    A profile is either a codec or program name with options, e.g. 'zstd',
+    'zstd:level=9,threads=auto', 'pigz' or 'bzip2:threads=4', or a free-form command,
+    e.g. '/usr/bin/bzip2 -9' or 'xz -T0', which is used as is. Profiles with a `threads`
+    option use a multithreaded implementation (pigz, lbzip2, pbzip2) if one is available
+    on the host executing the command. Decompression falls back to the reference program
+    of the codec if the host doesn't have the (parallel) program of the profile.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec.strip()
+        self.command = None
+        self.program = None
+        self.codec = None
+        self.options = {}
+        name, _, options = self.spec.partition(':')
+        name = ALIASES.get(name, name)
+        if re.search(r'[\s/]', self.spec) or (name not in PROGRAMS and options == ''):
+            # Free-form command; recognise the codec by the name of the program.
+            self.command = self.spec
+            program = os.path.basename(self.spec.split()[0])
+            program = ALIASES.get(program, program)
+            if program in PROGRAMS:
+                self.program = program
+                self.codec = PROGRAMS[program]
+            return
+        if name not in PROGRAMS:
+            raise ValueError("Unknown compression '{}' in profile '{}'".format(name, self.spec))
+        self.codec = PROGRAMS[name]
+        # The name of a codec selects the reference program, unless threads are requested.
+        self.program = name if name != self.codec else None
+        for option in filter(None, options.split(',')):
+            key, _, value = option.partition('=')
+            if key not in OPTIONS or value == '':
+                raise ValueError("Invalid option '{}' in compression profile '{}'".format(option, self.spec))
+            if key == 'level' and not value.isdigit():
+                raise ValueError("Invalid level '{}' in compression profile '{}'".format(value, self.spec))
+            if key == 'threads' and not (value.isdigit() or value == 'auto'):
+                raise ValueError("Invalid threads '{}' in compression profile '{}'".format(value, self.spec))
+            self.options[key] = value
+
+    def _select_program(self, host):
+        if self.program is not None:
+            return self.program
+        if 'threads' in self.options:
+            for program in PARALLEL_PROGRAMS.get(self.codec, []):
+                if bsts_utils.is_program_available(host, program):
+                    return program
+        return self.codec
+
+    def compress_command(self, host=None):
+        """Return the compress command (a string) to execute on host (None for localhost)."""
+        if self.command is not None:
+            return self.command
+        program = self._select_program(host)
+        level = self.options.get('level', None)
+        command = [program]
+        if level is not None:
+            if program == 'zstd' and int(level) > 19:
+                command.append('--ultra')
+            command.append('-{}'.format(level))
+        command.extend(_compose_thread_arguments(program, self.options.get('threads', None)))
+        return ' '.join(command)
+
+    def decompress_command(self, host=None):
+        """Return the command decompressing to stdout on host, or None if the codec is unknown."""
+        if self.codec is None:
+            return None
+        if self.command is not None:
+            program = self.program
+        else:
+            program = self._select_program(host)
+        # Parallel implementations are often only installed where the backup is written:
+        # use the reference program of the codec if the host doesn't have them.
+        if program != self.codec and not bsts_utils.is_program_available(host, program):
+            program = self.codec
+        command = [program, '-dc']
+        if program == 'xz' and 'threads' in self.options:
+            command.extend(_compose_thread_arguments(program, self.options['threads']))
+        return ' '.join(command)
@@ -35,6 +35,16 @@ class Configuration:
     def get_backup_config(self, backup):
         return self.config['backups'][backup]
 
+    def get_ssh_config(self):
+        return self.config.get('ssh', None) or {}
+
+    def get_max_parallel(self):
+        """Return the maximum number of actions running at the same time in a multi-backup run."""
+        return int(self.config.get('max-parallel', None) or 1)
+
+    def get_resources_config(self):
+        return self.config.get('resources', None) or {}
+
     def get_loggers_config(self):
         if 'loggers' in self.config:
             return self.config['loggers']
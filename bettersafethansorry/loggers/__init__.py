@@ -12,12 +12,15 @@ class Logger:
     def start_action(self, timestamp, id, description):
         pass
 
-    def finish_action(self, timestamp, id, errors):
+    def finish_action(self, timestamp, id, errors, statistics=None):
         pass
 
     def log_message(self, timestamp, level, message):
         pass
 
+    def report_progress(self, timestamp, progress):
+        pass
+
     def is_backup_outdated(self, timestamp, name):
         return None
 
@@ -26,3 +29,6 @@ class Logger:
 
     def finish_verify(self, timestamp, id, errors):
         pass
+
+    def defer_verify(self, timestamp, id, deferred):
+        pass
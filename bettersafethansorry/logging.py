@@ -1,6 +1,7 @@
 import datetime
 import logging
 import sys
+import threading
 from bettersafethansorry.loggers import Logger
 from bettersafethansorry.loggers.api import ApiRegistrar
 
@@ -8,6 +9,8 @@ from bettersafethansorry.loggers.api import ApiRegistrar
 class MasterLogger:
 
     def __init__(self):
+        # Serialise calls to the loggers; actions can run in parallel threads.
+        self.lock = threading.RLock()
         # Configure and add a Python logging logger.
         self.loggers = [PythonLogger(logging.getLogger('BSTS'))]
         logging.basicConfig(level=logging.DEBUG, handlers=[])
@@ -52,9 +55,19 @@ class MasterLogger:
 
     def _call_all_loggers(self, function_name, *args):
         timestamp = datetime.datetime.now(datetime.timezone.utc)
-        for logger in self.loggers:
-            function = getattr(logger, function_name)
-            function(timestamp, *args)
+        self._call_all_loggers_at(timestamp, function_name, *args)
+
+    def _call_all_loggers_at(self, timestamp, function_name, *args):
+        with self.lock:
+            for logger in self.loggers:
+                function = getattr(logger, function_name)
+                function(timestamp, *args)
+
+    def replay(self, records):
+        """Send buffered (timestamp, function_name, args) records to all loggers as one group."""
+        with self.lock:
+            for timestamp, function_name, args in records:
+                self._call_all_loggers_at(timestamp, function_name, *args)
 
     def start_backup(self, id, name, description):
         self._call_all_loggers('start_backup', id, name, description)
@@ -68,15 +81,21 @@ class MasterLogger:
     def finish_verify(self, id, errors):
         self._call_all_loggers('finish_verify', id, errors)
 
+    def defer_verify(self, id, deferred):
+        self._call_all_loggers('defer_verify', id, deferred)
+
     def start_action(self, id, description):
         self._call_all_loggers('start_action', id, description)
 
-    def finish_action(self, id, errors):
-        self._call_all_loggers('finish_action', id, errors)
+    def finish_action(self, id, errors, statistics=None):
+        self._call_all_loggers('finish_action', id, errors, statistics)
 
     def log_message(self, level, message):
         self._call_all_loggers('log_message', level, message)
 
+    def report_progress(self, progress):
+        self._call_all_loggers('report_progress', progress)
+
     def log_error(self, message):
         self.log_message(logging.ERROR, message)
 
@@ -97,6 +116,81 @@ class MasterLogger:
         return outdated
 
 
+class ActionLogger:
+    """Logger proxy that groups the log records of one action running in parallel.
+
+    Records are buffered with their original timestamp and passed to the master logger
+    in one go when the action finishes, so the logs of concurrent actions don't
+    interleave. Messages are prefixed with a label to attribute them to their action.
+    If the buffer grows beyond `max_records`, it's flushed early to bound memory usage.
+    """
+
+    def __init__(self, master_logger, label, max_records=10000):
+        self.master_logger = master_logger
+        self.label = label
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.records = []
+
+    def _record(self, function_name, *args):
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            self.records.append((timestamp, function_name, args))
+            flush = len(self.records) >= self.max_records
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, []
+        self.master_logger.replay(records)
+
+    def start_backup(self, id, name, description):
+        self._record('start_backup', id, name, description)
+
+    def finish_backup(self, id, errors):
+        self._record('finish_backup', id, errors)
+
+    def start_verify(self, id, name, description):
+        self._record('start_verify', id, name, description)
+
+    def finish_verify(self, id, errors):
+        self._record('finish_verify', id, errors)
+
+    def defer_verify(self, id, deferred):
+        self._record('defer_verify', id, deferred)
+
+    def start_action(self, id, description):
+        self._record('start_action', id, description)
+
+    def finish_action(self, id, errors, statistics=None):
+        self._record('finish_action', id, errors, statistics)
+
+    def log_message(self, level, message):
+        if self.label:
+            message = '[{}] {}'.format(self.label, message)
+        self._record('log_message', level, message)
+
+    def report_progress(self, progress):
+        # Progress is only useful while the action runs, don't buffer it.
+        self.master_logger.report_progress(dict(progress, action=self.label))
+
+    def log_error(self, message):
+        self.log_message(logging.ERROR, message)
+
+    def log_warning(self, message):
+        self.log_message(logging.WARNING, message)
+
+    def log_info(self, message):
+        self.log_message(logging.INFO, message)
+
+    def log_debug(self, message):
+        self.log_message(logging.DEBUG, message)
+
+    def is_backup_outdated(self, name):
+        return self.master_logger.is_backup_outdated(name)
+
+
 class PythonLogger(Logger):
 
     def __log_info(self, timestamp, message):
@@ -131,6 +225,10 @@ class PythonLogger(Logger):
         else:
             self.__log_info(timestamp, 'Error(s) encountered during verification')
 
+    def defer_verify(self, timestamp, id, deferred):
+        self.__log_info(
+            timestamp, 'Verification incomplete, {} action(s) deferred'.format(deferred))
+
     def start_action(self, timestamp, id, description):
         if description is not None and len(description) > 0:
             self.__log_info(
@@ -138,7 +236,7 @@ class PythonLogger(Logger):
         else:
             self.__log_info(timestamp, 'Starting action')
 
-    def finish_action(self, timestamp, id, errors):
+    def finish_action(self, timestamp, id, errors, statistics=None):
         if errors is None or len(errors) == 0:
             self.__log_info(timestamp, 'Action completed without errors')
         else:
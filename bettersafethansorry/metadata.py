@@ -0,0 +1,256 @@
+import bettersafethansorry.utilities as bsts_utils
+import exif
+import json
+import mmap
+import os
+import struct
+
+
+# Number of bytes searched for the metadata if the file can't be memory-mapped, and for the
+# EXIF segment of JPEG files (it's one of the first segments).
+MAX_HEADER_SIZE = 256 * 1024
+
+EXIF_IFD_POINTER_TAG = 0x8769
+DATETIME_ORIGINAL_TAG = 0x9003
+
+# Magic numbers of TIFF-based formats: TIFF (and most RAW formats), ORF and RW2.
+TIFF_MAGIC_NUMBERS = (42, 0x4f52, 0x5352, 0x55)
+
+# Sizes of the TIFF field types.
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+
+class MetadataError(Exception):
+    """The header of a file is truncated or invalid."""
+
+
+def _read_ifd(data, start, endian, offset):
+    """Return the entries of a TIFF IFD as a {tag: (type, count, value offset)} dictionary."""
+    entries = {}
+    (count,) = struct.unpack_from(endian + 'H', data, start + offset)
+    for index in range(count):
+        position = start + offset + 2 + 12 * index
+        tag, field_type, value_count = struct.unpack_from(endian + 'HHI', data, position)
+        if TIFF_TYPE_SIZES.get(field_type, 1) * value_count <= 4:
+            value_offset = position + 8
+        else:
+            value_offset = start + struct.unpack_from(endian + 'I', data, position + 8)[0]
+        entries[tag] = (field_type, value_count, value_offset)
+    return entries
+
+
+def _read_tiff_datetime_original(data, start):
+    """Return the DateTimeOriginal tag of the TIFF structure at `start` (or None)."""
+    byte_order = bytes(data[start:start + 2])
+    if byte_order == b'II':
+        endian = '<'
+    elif byte_order == b'MM':
+        endian = '>'
+    else:
+        raise MetadataError('Invalid TIFF byte order')
+    magic, ifd_offset = struct.unpack_from(endian + 'HI', data, start + 2)
+    if magic not in TIFF_MAGIC_NUMBERS:
+        raise MetadataError('Invalid TIFF magic number')
+    ifd = _read_ifd(data, start, endian, ifd_offset)
+    if EXIF_IFD_POINTER_TAG not in ifd:
+        return None
+    (exif_ifd_offset,) = struct.unpack_from(endian + 'I', data, ifd[EXIF_IFD_POINTER_TAG][2])
+    exif_ifd = _read_ifd(data, start, endian, exif_ifd_offset)
+    if DATETIME_ORIGINAL_TAG not in exif_ifd:
+        return None
+    _, count, value_offset = exif_ifd[DATETIME_ORIGINAL_TAG]
+    value = bytes(data[value_offset:value_offset + count])
+    if len(value) < count:
+        raise MetadataError('Truncated DateTimeOriginal tag')
+    return value.split(b'\0', 1)[0].decode('ascii').strip() or None
+
+
+def _read_jpeg_datetime_original(data):
+    """Return the DateTimeOriginal tag of a JPEG file, searching the segments before the image data."""
+    position = 2
+    while position < min(len(data), MAX_HEADER_SIZE):
+        if data[position] != 0xff:
+            raise MetadataError('Invalid JPEG marker')
+        marker = data[position + 1]
+        if marker == 0xff:
+            # Fill byte.
+            position += 1
+        elif marker in (0xd9, 0xda):
+            # End of image or start of scan: there's no EXIF segment.
+            return None
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            position += 2
+        else:
+            (length,) = struct.unpack_from('>H', data, position + 2)
+            if marker == 0xe1 and bytes(data[position + 4:position + 10]) == b'Exif\0\0':
+                return _read_tiff_datetime_original(data, position + 10)
+            position += 2 + length
+    raise MetadataError('No EXIF segment in the header of the JPEG file')
+
+
+def _iterate_boxes(data, start, end):
+    """Yield the (type, payload start, payload end) of the ISO BMFF boxes between start and end."""
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, position)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from('>Q', data, position + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise MetadataError('Invalid box size')
+        yield box_type, position + header_size, min(position + size, end)
+        position += size
+
+
+def _read_uint(data, position, size):
+    if size == 0:
+        return 0
+    return int.from_bytes(bytes(data[position:position + size]), 'big')
+
+
+def _find_heif_exif_offset(meta, data):
+    """Return the file offset of the Exif item of a HEIF 'meta' box (or None)."""
+    exif_item = None
+    locations = {}
+    for box_type, start, end in _iterate_boxes(data, meta[0] + 4, meta[1]):
+        if box_type == b'iinf':
+            version = data[start]
+            entries_start = start + (6 if version == 0 else 8)
+            for entry_type, entry_start, entry_end in _iterate_boxes(data, entries_start, end):
+                if entry_type != b'infe' or data[entry_start] < 2:
+                    continue
+                if data[entry_start] == 2:
+                    (item,) = struct.unpack_from('>H', data, entry_start + 4)
+                    item_type = bytes(data[entry_start + 8:entry_start + 12])
+                else:
+                    (item,) = struct.unpack_from('>I', data, entry_start + 4)
+                    item_type = bytes(data[entry_start + 10:entry_start + 14])
+                if item_type == b'Exif':
+                    exif_item = item
+        elif box_type == b'iloc':
+            version = data[start]
+            offset_size, length_size = data[start + 4] >> 4, data[start + 4] & 0x0f
+            base_offset_size = data[start + 5] >> 4
+            index_size = data[start + 5] & 0x0f if version in (1, 2) else 0
+            position = start + 6
+            if version < 2:
+                (item_count,) = struct.unpack_from('>H', data, position)
+                position += 2
+            else:
+                (item_count,) = struct.unpack_from('>I', data, position)
+                position += 4
+            for _ in range(item_count):
+                item_size = 2 if version < 2 else 4
+                item = _read_uint(data, position, item_size)
+                position += item_size
+                construction_method = 0
+                if version in (1, 2):
+                    construction_method = _read_uint(data, position, 2) & 0x0f
+                    position += 2
+                position += 2  # data reference index
+                base_offset = _read_uint(data, position, base_offset_size)
+                position += base_offset_size
+                (extent_count,) = struct.unpack_from('>H', data, position)
+                position += 2
+                extents = []
+                for _ in range(extent_count):
+                    position += index_size
+                    extents.append(_read_uint(data, position, offset_size))
+                    position += offset_size + length_size
+                if construction_method == 0 and len(extents) > 0:
+                    locations[item] = base_offset + extents[0]
+    if exif_item is None:
+        return None
+    if exif_item not in locations:
+        raise MetadataError('No location of the Exif item')
+    return locations[exif_item]
+
+
+def _read_heif_datetime_original(data):
+    """Return the DateTimeOriginal tag of a HEIF (HEIC, AVIF...) file."""
+    for box_type, start, end in _iterate_boxes(data, 0, len(data)):
+        if box_type == b'meta':
+            offset = _find_heif_exif_offset((start, end), data)
+            if offset is None:
+                return None
+            # The Exif item starts with the offset of the TIFF header (after an 'Exif\0\0' prefix).
+            (tiff_header_offset,) = struct.unpack_from('>I', data, offset)
+            return _read_tiff_datetime_original(data, offset + 4 + tiff_header_offset)
+    raise MetadataError("No 'meta' box in the header of the HEIF file")
+
+
+def _read_datetime_original(data):
+    """Return the DateTimeOriginal tag of a JPEG, TIFF-based or HEIF file (None for other files)."""
+    if bytes(data[0:2]) == b'\xff\xd8':
+        return _read_jpeg_datetime_original(data)
+    if bytes(data[0:2]) in (b'II', b'MM'):
+        return _read_tiff_datetime_original(data, 0)
+    if bytes(data[4:8]) == b'ftyp' and bytes(data[8:12]) in (b'heic', b'heix', b'mif1', b'msf1', b'avif'):
+        return _read_heif_datetime_original(data)
+    return None
+
+
+def read_datetime_original(filename):
+    """Return the DateTimeOriginal EXIF tag of a photo ('YYYY:MM:DD HH:MM:SS') or None.
+
+    Only the header of JPEG, TIFF-based (most RAW formats) and HEIF files is read, using a
+    memory map so only the pages holding the metadata are read from disk (or the first
+    MAX_HEADER_SIZE bytes if the file can't be mapped). The full EXIF parser, which reads
+    the whole file, is only used if the header can't be parsed.
+    """
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data = file.read(MAX_HEADER_SIZE)
+        try:
+            return _read_datetime_original(data)
+        except (MetadataError, struct.error, IndexError, UnicodeDecodeError):
+            pass
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        file.seek(0)
+        return exif.Image(file).get('datetime_original')
+
+
+def _to_number(value, convert):
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_video(filename):
+    """Return the properties of a video file reported by ffprobe (or None).
+
+    The result is a dictionary with the codec, width, height and pixel format of the first
+    video stream, the bit rate (bit/s) and duration (s) of the file and the codec of the
+    first audio stream (None if there's no audio).
+    """
+    try:
+        returncode, output = bsts_utils.capture_output([
+            'ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', str(filename)])
+        info = json.loads(output) if returncode == 0 else {}
+    except (OSError, ValueError):
+        return None
+    streams = info.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        return None
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    file_format = info.get('format', {})
+    return {
+        'codec': video.get('codec_name', None),
+        'width': video.get('width', None),
+        'height': video.get('height', None),
+        'pixel-format': video.get('pix_fmt', None),
+        'bit-rate': _to_number(file_format.get('bit_rate', None) or video.get('bit_rate', None), int),
+        'duration': _to_number(file_format.get('duration', None) or video.get('duration', None), float),
+        'audio-codec': audio.get('codec_name', None) if audio is not None else None
+    }
@@ -1,4 +1,10 @@
+import threading
+import time
 import uuid
+import bettersafethansorry.logging as bsts_logging
+import bettersafethansorry.resources as bsts_resources
+import bettersafethansorry.utilities as bsts_utils
+from bettersafethansorry.scheduler import JobScheduler
 from bettersafethansorry.actions.archive import ArchiveFiles, ArchivePostgreSQL, ArchiveMySQL
 from bettersafethansorry.actions.dcim import CopyPhotosVideos, ConvertAndMergeVideos
 from bettersafethansorry.actions.rsync import RsyncFiles
@@ -6,7 +12,11 @@ from bettersafethansorry.actions.repositories import UpdateGitAnnex
 from bettersafethansorry.actions.minecraft import ArchiveMinecraftServerJavaEdition
 
 
-def run_backup(backup_name, backup_config, dry_run, logger):
+# Verification results older than this are not trusted (unless configured otherwise).
+DEFAULT_VERIFY_MAX_AGE = '30d'
+
+
+def run_backup(backup_name, backup_config, dry_run, logger, scheduler=None):
     description = backup_config.pop('description', '')
     id = uuid.uuid4()
     logger.start_backup(id, backup_name, description)
@@ -23,21 +33,82 @@ def run_backup(backup_name, backup_config, dry_run, logger):
         else:
             regular_actions.append(action_config)
 
+    host_limits = {
+        'source-host': backup_config.get('max-parallel-per-source-host', None),
+        'destination-host': backup_config.get('max-parallel-per-destination-host', None),
+        # Rsync transfers sharing the global bandwidth limit run one at a time.
+        'bandwidth': 1
+    }
+
     # Process regular actions (call do() directly)
-    for action_config in regular_actions:
-        action_errors = run_backup_action(action_config, dry_run, logger)
-        errors.extend(action_errors)
+    max_parallel = int(backup_config.get('max-parallel', 1))
+    if scheduler is not None:
+        # Shared scheduler of a multi-backup run: apply the limits of this backup to the
+        # hosts it uses and limit the number of parallel actions of the backup itself.
+        for action_config in backup_config['actions']:
+            for resource in get_action_resources(action_config):
+                scheduler.restrict(resource, host_limits[resource[0]])
+        backup_resource = ('backup', backup_name)
+        scheduler.restrict(backup_resource, max_parallel)
+        errors.extend(run_parallel_backup_actions(
+            regular_actions, scheduler, dry_run, logger, [backup_resource], backup_name))
+    elif max_parallel > 1 and len(regular_actions) > 1:
+        backup_scheduler = JobScheduler(max_parallel, host_limits)
+        errors.extend(run_parallel_backup_actions(
+            regular_actions, backup_scheduler, dry_run, logger))
+    else:
+        for action_config in regular_actions:
+            action_errors = run_backup_action(action_config, dry_run, logger)
+            errors.extend(action_errors)
 
     # Process all-or-nothing actions (prepare/commit/rollback)
     if len(all_or_nothing_actions) > 0:
-        aon_errors = run_all_or_nothing_actions(
-            all_or_nothing_actions, dry_run, logger)
+        if scheduler is not None:
+            aon_errors = run_all_or_nothing_actions(
+                all_or_nothing_actions, dry_run, logger, scheduler, backup_name)
+        else:
+            aon_errors = run_all_or_nothing_actions(
+                all_or_nothing_actions, dry_run, logger, JobScheduler(None, host_limits))
         errors.extend(aon_errors)
 
     logger.finish_backup(id, errors)
     return errors
 
 
+def run_backups(backups, dry_run, logger, max_parallel=1):
+    """Run several backups concurrently, sharing one job scheduler.
+
+    Args:
+        backups: List of (backup_name, backup_config) tuples
+        dry_run: If True, show what would be done without executing
+        logger: Logger instance for logging messages
+        max_parallel: Maximum number of actions running at the same time (over all backups)
+
+    Returns:
+        list: List of (backup_name, errors) tuples, in the order of the backups
+    """
+    scheduler = JobScheduler(max_parallel)
+    results = {}
+
+    def run_one_backup(backup_name, backup_config):
+        try:
+            results[backup_name] = run_backup(
+                backup_name, backup_config, dry_run, logger, scheduler)
+        except Exception as exception:
+            logger.log_error("Backup '{}' aborted: {}".format(backup_name, exception))
+            results[backup_name] = [str(exception)]
+
+    # Every backup is coordinated by its own thread; only the actions count as jobs.
+    threads = []
+    for backup_name, backup_config in backups:
+        thread = threading.Thread(target=run_one_backup, args=(backup_name, backup_config))
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [(backup_name, results[backup_name]) for backup_name, _ in backups]
+
+
 def run_backup_action(action_config, dry_run, logger):
     description = action_config.pop('description', '')
     id = uuid.uuid4()
@@ -51,43 +122,97 @@ def run_backup_action(action_config, dry_run, logger):
     action_instance = action_class(action_config, logger)
     errors = action_instance.do(dry_run)
 
-    logger.finish_action(id, errors)
+    logger.finish_action(id, errors, action_instance.get_statistics())
     return errors
 
 
-def run_all_or_nothing_actions(action_configs, dry_run, logger):
+def get_action_resources(action_config):
+    """Return the scheduler resources (source and destination hosts) used by an action.
+
+    Rsync enforces its bandwidth limit itself (`--bwlimit`) and can't share the global
+    limit with other transfers, so rsync actions claim the global bandwidth too.
+    """
+    resources = []
+    for key in ('source-host', 'destination-host'):
+        user_at_host = action_config.get(key, None)
+        if user_at_host is not None:
+            (_, host) = bsts_utils.split_user_host(user_at_host, True, False)
+            resources.append((key, host))
+    if action_config.get('action', None) == 'RsyncFiles' \
+            and bsts_resources.global_limits.get_bandwidth_limit() is not None:
+        resources.append(('bandwidth', 'global'))
+    return resources
+
+
+def get_verify_resources(action_config):
+    """Return the scheduler resources used when verifying an action (its destination host)."""
+    user_at_host = action_config.get('destination-host', None)
+    if user_at_host is not None:
+        (_, host) = bsts_utils.split_user_host(user_at_host, True, False)
+    else:
+        host = 'localhost'
+    return [('destination-host', host)]
+
+
+def get_action_label(action_config, backup_name=None):
+    label = action_config.get('description', None) or action_config.get('action', '')
+    return '{}: {}'.format(backup_name, label) if backup_name is not None else label
+
+
+def run_parallel_backup_actions(action_configs, scheduler, dry_run, logger, resources=[], backup_name=None):
+    """Execute regular actions concurrently using a job scheduler.
+
+    The log records of each action are buffered and logged as one group when the
+    action finishes. Errors are returned in the order of the actions in the
+    configuration, like the sequential execution does.
+    """
+    jobs = []
+    for action_config in action_configs:
+        action_logger = bsts_logging.ActionLogger(
+            logger, get_action_label(action_config, backup_name))
+
+        def run_action(action_config=action_config, action_logger=action_logger):
+            try:
+                return run_backup_action(action_config, dry_run, action_logger)
+            finally:
+                action_logger.flush()
+
+        jobs.append((run_action, [*resources, *get_action_resources(action_config)]))
+    errors = []
+    for action_errors in scheduler.run(jobs):
+        errors.extend(action_errors)
+    return errors
+
+
+def run_all_or_nothing_actions(action_configs, dry_run, logger, scheduler=None, backup_name=None):
     """Execute a group of actions with all-or-nothing semantics.
 
-    All actions are prepared first. If all preparations succeed, all are committed.
-    If any preparation fails, all are rolled back.
+    All actions are prepared concurrently first. If all preparations succeed, all are
+    committed. As soon as a preparation fails, the subprocesses of the other running
+    preparations are terminated, preparations that didn't start yet are skipped, and
+    all actions that were (being) prepared are rolled back.
     """
     errors = []
-    action_data = []  # Store (action_instance, description) tuples
+    action_data = []  # Store (action_instance, description, action_logger, resources) tuples
 
     # Phase 1: Prepare all actions
     logger.log_info('Starting prepare phase of all-or-nothing action group')
     prepare_errors = []
-    prepare_failed = False
 
+    # Configure all actions before preparing any of them.
     for action_config in action_configs:
+        resources = get_action_resources(action_config)
+        action_logger = bsts_logging.ActionLogger(
+            logger, get_action_label(action_config, backup_name))
         description = action_config.pop('description', '')
 
-        # If a previous action failed, skip remaining preparations
-        if prepare_failed:
-            logger.log_info("Skipping action '{}' (previous action failed)".format(
-                description) if description else "Skipping action (previous action failed)")
-            continue
-
-        # Custom logging for prepare phase
-        logger.log_info("Preparing action '{}'".format(
-            description) if description else "Preparing action")
-
         try:
             action_class = globals()[action_config.pop('action')]
         except KeyError as error:
             raise RuntimeError("Unknown action {}".format(error)) from error
 
-        action_instance = action_class(action_config, logger)
+        action_instance = action_class(action_config, action_logger)
+        action_logger.flush()
 
         # Check if action supports all-or-nothing
         if not (action_instance.has_prepare() and action_instance.has_commit() and action_instance.has_rollback()):
@@ -95,30 +220,70 @@ def run_all_or_nothing_actions(action_configs, dry_run, logger):
                 action_instance.__class__.__name__)
             logger.log_error(error_msg)
             prepare_errors.append(error_msg)
-            prepare_failed = True
             continue
 
-        # Execute prepare phase
-        action_prepare_errors = action_instance.prepare(dry_run)
-        prepare_errors.extend(action_prepare_errors)
-
-        # Always add to action_data so it gets rolled back if needed
-        action_data.append((action_instance, description))
+        action_data.append((action_instance, description, action_logger, resources))
 
-        # Log completion of prepare phase
-        if len(action_prepare_errors) == 0:
-            logger.log_info('Action prepared without errors')
-        else:
-            logger.log_error('Error(s) encountered during action preparation')
-            prepare_failed = True
+    # Execute prepare phase concurrently, unless an action can't be used in the group.
+    prepared_actions = []
+    if len(prepare_errors) == 0:
+        if scheduler is None:
+            scheduler = JobScheduler()
+        cancellation = bsts_utils.Cancellation()
+        cancellation_lock = threading.Lock()
+        jobs = []
+        for action_instance, description, action_logger, resources in action_data:
+
+            def prepare_action(action_instance=action_instance, description=description,
+                               action_logger=action_logger):
+                try:
+                    # If a previous action failed, skip remaining preparations
+                    if cancellation.is_cancelled():
+                        action_logger.log_info("Skipping action '{}' (previous action failed)".format(
+                            description) if description else "Skipping action (previous action failed)")
+                        return (False, [])
+
+                    # Custom logging for prepare phase
+                    action_logger.log_info("Preparing action '{}'".format(
+                        description) if description else "Preparing action")
+                    action_instance.set_cancellation(cancellation)
+                    action_prepare_errors = action_instance.prepare(dry_run)
+                    action_instance.set_cancellation(None)
+
+                    # Cancel the other preparations if this is the first one that failed
+                    with cancellation_lock:
+                        was_cancelled = cancellation.is_cancelled()
+                        if len(action_prepare_errors) > 0 and not was_cancelled:
+                            cancellation.cancel()
+
+                    # Log completion of prepare phase
+                    if len(action_prepare_errors) == 0:
+                        action_logger.log_info('Action prepared without errors')
+                    elif was_cancelled:
+                        action_logger.log_info('Action preparation cancelled (other action failed)')
+                        action_prepare_errors = []
+                    else:
+                        action_logger.log_error('Error(s) encountered during action preparation')
+                    # Always return True so the action gets rolled back if needed
+                    return (True, action_prepare_errors)
+                finally:
+                    action_logger.flush()
+
+            jobs.append((prepare_action, resources))
+
+        for (started, action_prepare_errors), (action_instance, description, action_logger, _) \
+                in zip(scheduler.run(jobs), action_data):
+            prepare_errors.extend(action_prepare_errors)
+            if started:
+                prepared_actions.append((action_instance, description, action_logger))
 
     # Phase 2: Commit or rollback based on prepare results
     if len(prepare_errors) == 0:
         # All preparations succeeded - commit all
         logger.log_info('All preparations succeeded, committing all actions')
-        for action_instance, description in action_data:
+        for action_instance, description, action_logger in prepared_actions:
             # Custom logging for commit phase
-            logger.log_info("Committing action '{}'".format(
+            action_logger.log_info("Committing action '{}'".format(
                 description) if description else "Committing action")
 
             commit_errors = action_instance.commit(dry_run)
@@ -126,39 +291,53 @@ def run_all_or_nothing_actions(action_configs, dry_run, logger):
 
             # Log completion of commit phase
             if len(commit_errors) == 0:
-                logger.log_info('Action committed without errors')
+                action_logger.log_info('Action committed without errors')
             else:
-                logger.log_error('Error(s) encountered during action commit')
+                action_logger.log_error('Error(s) encountered during action commit')
+            action_logger.flush()
     else:
         # At least one preparation failed - rollback all
         logger.log_error(
             'One or more preparations failed, rolling back all actions')
         errors.extend(prepare_errors)
-        for action_instance, description in action_data:
+        for action_instance, description, action_logger in prepared_actions:
             # Custom logging for rollback phase
-            logger.log_info("Rolling back action '{}'".format(
+            action_logger.log_info("Rolling back action '{}'".format(
                 description) if description else "Rolling back action")
 
             rollback_errors = action_instance.rollback(dry_run)
 
             # Log completion of rollback phase
             if len(rollback_errors) == 0:
-                logger.log_info('Action rolled back without errors')
+                action_logger.log_info('Action rolled back without errors')
             else:
-                logger.log_error('Error(s) encountered during action rollback')
+                action_logger.log_error('Error(s) encountered during action rollback')
+            action_logger.flush()
             # Don't add rollback errors to main error list to avoid double-counting
 
     return errors
 
 
-def run_verify(backup_name, backup_config, dry_run, logger):
+def run_verify(backup_name, backup_config, dry_run, logger, mode='deep', scheduler=None,
+               index=None, force=False, max_age=None):
     """Verify a backup configuration by running verify() on all actions that support it.
 
+    The actions are verified concurrently, but only one action at a time (or
+    `max-parallel-per-destination-host`) reads from the same destination host. If a
+    verification index is given, artifacts that didn't change since their last successful
+    verification (less than `max_age` seconds ago) are skipped, unless `force` is set.
+
     Args:
         backup_name: Name of the backup configuration
         backup_config: Configuration dictionary containing actions
         dry_run: If True, show what would be verified without executing
         logger: Logger instance for logging messages
+        mode: 'deep' (check all data) or 'quick' (compare checksums, if available)
+        scheduler: Job scheduler shared with other backups (None to use one of its own)
+        index: VerificationIndex recording the results (None to always verify)
+        force: If True, verify unchanged artifacts too
+        max_age: Maximum age (in seconds) of verification results (None to use the
+            `verify-max-age` of the backup, 30 days by default)
 
     Returns:
         list: List of error messages (empty if no errors)
@@ -169,29 +348,251 @@ def run_verify(backup_name, backup_config, dry_run, logger):
 
     errors = []
 
+    # Only prefix the log records with the backup name if other backups are verified too.
+    label_prefix = backup_name if scheduler is not None else None
+    if scheduler is None:
+        scheduler = JobScheduler()
+    jobs = configure_verify_jobs(
+        backup_config, dry_run, logger, mode, scheduler, label_prefix, index, force, max_age)
+    for action_errors in scheduler.run([(function, resources) for function, resources, _ in jobs]):
+        errors.extend(action_errors)
+
+    logger.finish_verify(id, errors)
+    return errors
+
+
+def configure_verify_jobs(backup_config, dry_run, logger, mode, scheduler, label_prefix=None,
+                          index=None, force=False, max_age=None, deadline=None):
+    """Configure the actions of a backup and return a verify job for those that support it.
+
+    Returns:
+        list: List of (function, resources, action_instance) tuples; the functions return
+            the errors of the verification. Jobs started after the `deadline` (a
+            time.monotonic() value) don't verify anything and return None.
+    """
+    if max_age is None:
+        max_age = bsts_utils.parse_duration(backup_config.get('verify-max-age', DEFAULT_VERIFY_MAX_AGE))
+    # Verification reads all data from the destination, don't thrash its disks.
+    destination_host_limit = backup_config.get('max-parallel-per-destination-host', None) or 1
+
     # Process all actions that support verification
+    jobs = []
     for action_config in backup_config['actions']:
+        action_logger = bsts_logging.ActionLogger(
+            logger, get_action_label(action_config, label_prefix))
+        resources = get_verify_resources(action_config)
         action_description = action_config.pop('description', '')
-        action_id = uuid.uuid4()
 
         try:
             action_class = globals()[action_config.pop('action')]
         except KeyError as error:
             raise RuntimeError("Unknown action {}".format(error)) from error
 
-        action_instance = action_class(action_config, logger)
+        try:
+            action_instance = action_class(action_config, action_logger)
+        finally:
+            action_logger.flush()
 
         # Only verify actions that implement verification
         if action_instance.has_verify():
-            logger.start_action(action_id, action_description)
-            action_errors = action_instance.verify(dry_run)
-            errors.extend(action_errors)
-            logger.finish_action(action_id, action_errors)
+
+            def verify_action(action_instance=action_instance, action_logger=action_logger,
+                              action_description=action_description):
+                if deadline is not None and time.monotonic() > deadline:
+                    action_logger.log_info('Verification budget exhausted, deferring verification')
+                    action_logger.flush()
+                    return None
+                action_id = uuid.uuid4()
+                try:
+                    action_logger.start_action(action_id, action_description)
+                    if index is not None and not dry_run:
+                        action_errors = verify_action_using_index(
+                            action_instance, mode, index, force, max_age, action_logger)
+                    else:
+                        action_errors = action_instance.verify(dry_run, mode)
+                    action_logger.finish_action(action_id, action_errors)
+                    return action_errors
+                finally:
+                    action_logger.flush()
+
+            for resource in resources:
+                scheduler.restrict(resource, destination_host_limit)
+            jobs.append((verify_action, resources, action_instance))
         else:
             # Skip actions that don't support verification
             logger.log_debug(
                 "Skipping verification for action '{}' (not implemented)".format(
                     action_description) if action_description else "Skipping verification for action (not implemented)")
-
-    logger.finish_verify(id, errors)
+    return jobs
+
+
+def verify_action_using_index(action_instance, mode, index, force, max_age, logger):
+    """Verify an action unless its artifact didn't change since its last verification."""
+    identity = action_instance.get_verify_identity()
+    if identity is None:
+        return action_instance.verify(False, mode)
+    fingerprint = action_instance.get_verify_fingerprint()
+    entry = index.is_verified(identity, fingerprint, mode, max_age)
+    if entry is not None and not force:
+        logger.log_info("Skipping verification of '{}': unchanged since its {} verification on {}".format(
+            identity, entry['mode'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['verified_at']))))
+        return []
+    start_time = time.monotonic()
+    errors = action_instance.verify(False, mode)
+    index.record(identity, fingerprint, mode, len(errors) == 0, time.monotonic() - start_time)
     return errors
+
+
+def plan_rolling_verification(candidates, index, budget, max_parallel=None):
+    """Select the verify jobs that fit in a time budget, longest unverified first.
+
+    Artifacts that were never (successfully) verified come first, followed by the ones
+    whose last successful verification is the oldest. The duration of a verification is
+    predicted by the duration of the previous one (unknown durations count as zero; the
+    deadline stops them if they take too long). Every destination host is verified one
+    artifact at a time and gets at most the full budget, while all hosts together get
+    the budget times the number of verifications that can run at the same time.
+
+    Args:
+        candidates: List of (key, function, resources, action_instance) tuples
+        index: VerificationIndex with the history of the artifacts (or None)
+        budget: Time budget in seconds
+        max_parallel: Maximum number of verifications running at the same time (None
+            for no limit besides one per destination host)
+
+    Returns:
+        tuple: The selected candidates (in order of priority) and the deferred candidates
+    """
+    history = []
+    for candidate in candidates:
+        identity = candidate[3].get_verify_identity()
+        entry = index.lookup(identity) if index is not None and identity is not None else None
+        last_success_at = entry['last_success_at'] if entry is not None else None
+        duration = entry['duration'] if entry is not None else None
+        history.append((last_success_at, duration or 0.0))
+    order = sorted(range(len(candidates)),
+                   key=lambda number: (history[number][0] is not None, history[number][0] or 0.0))
+    lanes = len(set(tuple(candidate[2]) for candidate in candidates))
+    concurrency = min(lanes, max_parallel) if max_parallel is not None else lanes
+    planned_time = {}
+    total_planned_time = 0.0
+    selected = []
+    deferred = []
+    for number in order:
+        candidate = candidates[number]
+        lane = tuple(candidate[2])
+        duration = history[number][1]
+        if planned_time.get(lane, 0.0) + duration <= budget \
+                and total_planned_time + duration <= budget * concurrency:
+            planned_time[lane] = planned_time.get(lane, 0.0) + duration
+            total_planned_time += duration
+            selected.append(candidate)
+        else:
+            deferred.append(candidate)
+    return selected, deferred
+
+
+def run_verifies(backups, dry_run, logger, mode='deep', max_parallel=None, index=None, force=False,
+                 max_age=None, budget=None):
+    """Verify several backups concurrently, sharing one job scheduler.
+
+    With a time `budget` (in seconds), the artifacts of all backups are verified in order
+    of the time since their last successful verification, as far as they fit in the
+    budget (see plan_rolling_verification()). Successive runs thus cycle through all
+    artifacts.
+
+    Args:
+        backups: List of (backup_name, backup_config) tuples
+        dry_run: If True, show what would be verified without executing
+        logger: Logger instance for logging messages
+        mode: 'deep' (check all data) or 'quick' (compare checksums, if available)
+        max_parallel: Maximum number of actions verified at the same time (over all backups)
+        index, force, max_age: Use of the verification index, see run_verify()
+        budget: Time budget in seconds (None to verify everything)
+
+    Returns:
+        list: List of (backup_name, errors, deferred) tuples, in the order of the backups;
+            `deferred` is the number of actions that weren't verified within the budget
+    """
+    scheduler = JobScheduler(max_parallel)
+    if budget is not None:
+        return run_rolling_verification(
+            backups, dry_run, logger, mode, scheduler, index, force, max_age, budget)
+    results = {}
+
+    def verify_one_backup(backup_name, backup_config):
+        try:
+            results[backup_name] = run_verify(
+                backup_name, backup_config, dry_run, logger, mode, scheduler, index, force, max_age)
+        except Exception as exception:
+            logger.log_error("Verification of '{}' aborted: {}".format(backup_name, exception))
+            results[backup_name] = [str(exception)]
+
+    threads = []
+    for backup_name, backup_config in backups:
+        thread = threading.Thread(target=verify_one_backup, args=(backup_name, backup_config))
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [(backup_name, results[backup_name], 0) for backup_name, _ in backups]
+
+
+def run_rolling_verification(backups, dry_run, logger, mode, scheduler, index, force, max_age, budget):
+    """Verify the artifacts of several backups within a time budget, see run_verifies().
+
+    Backups with deferred actions aren't reported as verified; unless errors were found,
+    they are reported as deferred instead.
+    """
+    deadline = time.monotonic() + budget
+    results = {}
+    deferred_actions = {}
+    ids = {}
+    candidates = []
+    for backup_name, backup_config in backups:
+        description = backup_config.pop('description', '')
+        ids[backup_name] = uuid.uuid4()
+        logger.start_verify(ids[backup_name], backup_name, description)
+        results[backup_name] = []
+        deferred_actions[backup_name] = 0
+        try:
+            jobs = configure_verify_jobs(
+                backup_config, dry_run, logger, mode, scheduler, backup_name, index, force, max_age,
+                deadline)
+        except Exception as exception:
+            logger.log_error("Verification of '{}' aborted: {}".format(backup_name, exception))
+            results[backup_name].append(str(exception))
+            continue
+        candidates.extend((backup_name, *job) for job in jobs)
+
+    selected, deferred = plan_rolling_verification(candidates, index, budget, scheduler.max_parallel)
+    logger.log_info('Verification budget of {}: verifying {} of {} action(s), deferring {}'.format(
+        bsts_utils.format_duration(budget), len(selected), len(candidates), len(deferred)))
+    for backup_name, _, _, action_instance in deferred:
+        deferred_actions[backup_name] += 1
+        logger.log_debug("Deferring verification of '{}' ({})".format(
+            action_instance.get_verify_identity(), backup_name))
+
+    def guard(function, backup_name):
+        # Don't let an exception in one backup cancel the verification of the others.
+        def guarded_function():
+            try:
+                return function()
+            except Exception as exception:
+                logger.log_error("Verification of '{}' aborted: {}".format(backup_name, exception))
+                return [str(exception)]
+        return guarded_function
+
+    jobs = [(guard(function, backup_name), resources) for backup_name, function, resources, _ in selected]
+    for (backup_name, _, _, _), action_errors in zip(selected, scheduler.run(jobs)):
+        if action_errors is None:
+            # Started after the deadline.
+            deferred_actions[backup_name] += 1
+        else:
+            results[backup_name].extend(action_errors)
+    for backup_name, _ in backups:
+        if deferred_actions[backup_name] > 0 and len(results[backup_name]) == 0:
+            logger.defer_verify(ids[backup_name], deferred_actions[backup_name])
+        else:
+            logger.finish_verify(ids[backup_name], results[backup_name])
+    return [(backup_name, results[backup_name], deferred_actions[backup_name]) for backup_name, _ in backups]
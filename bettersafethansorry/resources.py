@@ -0,0 +1,128 @@
+import re
+import shlex
+import threading
+import time
+import bettersafethansorry.ssh as bsts_ssh
+import bettersafethansorry.utilities as bsts_utils
+
+
+# I/O scheduling classes (of ionice) backups may use.
+IONICE_CLASSES = {
+    'best-effort': '2',
+    'idle': '3'
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the throughput (in bytes per second) of its users.
+
+    The bucket holds at most one second worth of tokens, so short bursts are smoothed too.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Take `size` tokens, waiting until they're available."""
+        while size > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                taken = min(size, self.tokens) if self.tokens > 0 else 0
+                self.tokens -= taken
+                size -= taken
+                delay = min(size, self.rate) / self.rate
+            if size > 0:
+                time.sleep(delay)
+
+
+def _parse_ionice(ionice):
+    """Parse an I/O scheduling setting like 'idle', 'best-effort' or 'best-effort:7'."""
+    match = re.fullmatch(r'(idle|best-effort)(?::([0-7]))?', str(ionice))
+    if match is None or (match.group(1) == 'idle' and match.group(2) is not None):
+        raise ValueError("Invalid ionice '{}' (expected 'idle', 'best-effort' or 'best-effort:0-7')".format(ionice))
+    arguments = ['-c', IONICE_CLASSES[match.group(1)]]
+    if match.group(2) is not None:
+        arguments.extend(['-n', match.group(2)])
+    return arguments
+
+
+class ResourceLimits:
+    """CPU priority, I/O scheduling class and bandwidth of the subprocesses of an action.
+
+    Commands are started with `nice` and `ionice`; the remote command of an ssh command
+    and the remote rsync of an rsync command are wrapped too. The data sent to or received
+    from ssh subprocesses is throttled by all token buckets of the limits (e.g. the bucket
+    of the action and the bucket shared by all actions).
+    """
+
+    def __init__(self, nice=None, ionice=None, buckets=[]):
+        if nice is not None and not re.fullmatch(r'-?\d+', str(nice)):
+            raise ValueError("Invalid nice '{}' (expected a number)".format(nice))
+        self.nice = nice
+        self.ionice = ionice
+        self.ionice_arguments = _parse_ionice(ionice) if ionice is not None else []
+        self.buckets = list(buckets)
+
+    def get_prefix(self):
+        """Return the command prefix applying the CPU priority and I/O scheduling class."""
+        prefix = []
+        if self.nice is not None:
+            prefix.extend(['nice', '-n', str(self.nice)])
+        if self.ionice is not None:
+            prefix.extend(['ionice', *self.ionice_arguments])
+        return prefix
+
+    def get_bandwidth_limit(self):
+        """Return the lowest bandwidth limit (in bytes per second) or None."""
+        return min((bucket.rate for bucket in self.buckets), default=None)
+
+    def throttles(self):
+        return len(self.buckets) > 0
+
+    def throttle(self, size):
+        """Wait until `size` bytes may be sent over the network."""
+        for bucket in self.buckets:
+            bucket.consume(size)
+
+    def wrap_command(self, command):
+        """Return the command with its priorities applied, using a shared SSH connection if possible."""
+        prefix = self.get_prefix()
+        if len(prefix) == 0:
+            return bsts_ssh.wrap_command(command)
+        if command[0] == 'ssh' and len(command) == 3:
+            command = ['ssh', command[1], '{} sh -c {}'.format(' '.join(prefix), shlex.quote(command[2]))]
+        elif command[0] == 'rsync' and bsts_ssh.get_rsync_remote_host(command) is not None:
+            command = ['rsync', '--rsync-path={} rsync'.format(' '.join(prefix)), *command[1:]]
+        return [*prefix, *bsts_ssh.wrap_command(command)]
+
+
+# Limits of all actions, configured in the 'resources' section of the configuration.
+global_limits = ResourceLimits()
+
+
+def configure(resources_config):
+    """Configure the global limits using the 'resources' section of the configuration."""
+    global global_limits
+    bandwidth_limit = resources_config.get('bandwidth-limit', None)
+    global_limits = ResourceLimits(
+        resources_config.get('nice', None),
+        resources_config.get('ionice', None),
+        [TokenBucket(bsts_utils.parse_size(bandwidth_limit))] if bandwidth_limit is not None else [])
+
+
+def get_limits(nice=None, ionice=None, bandwidth_limit=None):
+    """Return the limits of an action, combined with the global limits.
+
+    The niceness and I/O scheduling class of the action replace the global ones; the
+    bandwidth of the action is limited by its own limit and by the global (shared) limit.
+    """
+    buckets = [TokenBucket(bsts_utils.parse_size(bandwidth_limit))] if bandwidth_limit is not None else []
+    return ResourceLimits(
+        nice if nice is not None else global_limits.nice,
+        ionice if ionice is not None else global_limits.ionice,
+        [*buckets, *global_limits.buckets])
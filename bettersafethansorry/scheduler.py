@@ -0,0 +1,132 @@
+import collections
+import threading
+
+
+class Job:
+
+    def __init__(self, function, resources):
+        self.function = function
+        self.resources = tuple(resources)
+        self.result = None
+        self.exception = None
+        self.state = 'pending'
+        self.finished = threading.Event()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self):
+        """Wait for the job to finish and return its result (or raise its exception)."""
+        self.finished.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class JobScheduler:
+    """Run jobs concurrently within a global and per-resource concurrency limit.
+
+    Every job claims a number of resources, e.g. ('source-host', 'root@wormwood'). A job is
+    only started if the number of running jobs is below `max_parallel` and none of its
+    resources is already used by as many running jobs as its limit allows. Limits are
+    looked up by the full resource tuple first and by the resource kind (the first element)
+    next; resources without a limit are unlimited. Pending jobs are started in submission
+    order, but a job that cannot start doesn't block the jobs behind it.
+    """
+
+    def __init__(self, max_parallel=None, limits=None):
+        self.max_parallel = max_parallel
+        self.limits = dict(limits or {})
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = 0
+        self.usage = collections.Counter()
+
+    def restrict(self, resource, limit):
+        """Set the limit of a resource (or resource kind) unless a stricter limit exists."""
+        if limit is None:
+            return
+        with self.condition:
+            current_limit = self.limits.get(resource)
+            if current_limit is None or int(limit) < current_limit:
+                self.limits[resource] = int(limit)
+
+    def _get_limit(self, resource):
+        limit = self.limits.get(resource)
+        if limit is None and isinstance(resource, tuple):
+            limit = self.limits.get(resource[0])
+        return limit
+
+    def _can_start(self, job):
+        if self.max_parallel is not None and self.running >= self.max_parallel:
+            return False
+        for resource in job.resources:
+            limit = self._get_limit(resource)
+            if limit is not None and self.usage[resource] >= limit:
+                return False
+        return True
+
+    def _dispatch(self):
+        # Must be called with the condition lock held.
+        for job in list(self.pending):
+            if self._can_start(job):
+                self.pending.remove(job)
+                job.state = 'running'
+                self.running += 1
+                for resource in job.resources:
+                    self.usage[resource] += 1
+                thread = threading.Thread(target=self._run_job, args=(job,), daemon=True)
+                thread.start()
+
+    def _run_job(self, job):
+        try:
+            job.result = job.function()
+        except BaseException as exception:
+            job.exception = exception
+        with self.condition:
+            self.running -= 1
+            for resource in job.resources:
+                self.usage[resource] -= 1
+            job.state = 'finished'
+            job.finished.set()
+            self._dispatch()
+            self.condition.notify_all()
+
+    def submit(self, function, resources=()):
+        """Queue a function for execution and return its Job."""
+        job = Job(function, resources)
+        with self.condition:
+            self.pending.append(job)
+            self._dispatch()
+        return job
+
+    def cancel(self, job):
+        """Remove a job that didn't start yet; return True if it was removed."""
+        with self.condition:
+            if job.state != 'pending':
+                return False
+            self.pending.remove(job)
+            job.state = 'cancelled'
+            job.finished.set()
+            self.condition.notify_all()
+            return True
+
+    def run(self, jobs):
+        """Run (function, resources) tuples and return their results in the same order.
+
+        If a job raises an exception, jobs that didn't start yet are cancelled and the
+        first exception is raised once the running jobs have finished.
+        """
+        submitted = [self.submit(function, resources) for function, resources in jobs]
+        results = []
+        exception = None
+        for job in submitted:
+            job.finished.wait()
+            if job.exception is not None and exception is None:
+                exception = job.exception
+                for other_job in submitted:
+                    self.cancel(other_job)
+            results.append(job.result)
+        if exception is not None:
+            raise exception
+        return results
@@ -0,0 +1,140 @@
+import atexit
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+class SshSessionManager:
+    """Share one SSH master connection per host between all ssh invocations of a run.
+
+    The master connections (OpenSSH ControlMaster) are started lazily, the first time a
+    command for a host is executed, and are closed by close(). Commands for a host for
+    which no master can be started fall back to a connection of their own.
+    """
+
+    def __init__(self, enabled=True, persist=300):
+        self.enabled = enabled
+        # Idle timeout of the masters; only a safety net, masters are closed explicitly.
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.control_paths = {}
+        self.masters = {}
+        self.control_directory = None
+        self.opened = 0
+        self.reused = 0
+
+    def _get_control_path(self, host):
+        # Must be called with the host lock held.
+        with self.lock:
+            if self.control_directory is None:
+                # Keep the path short, unix socket paths are limited to about 100 characters.
+                self.control_directory = tempfile.mkdtemp(prefix='bsts-ssh-')
+            if host not in self.control_paths:
+                self.control_paths[host] = os.path.join(
+                    self.control_directory, str(len(self.control_paths)))
+            return self.control_paths[host]
+
+    def _get_host_lock(self, host):
+        with self.lock:
+            return self.host_locks.setdefault(host, threading.Lock())
+
+    def _count(self, reused):
+        with self.lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += 1
+
+    def _ensure_master(self, host):
+        """Return the control path of the master connection to host (or None if unavailable)."""
+        with self._get_host_lock(host):
+            control_path = self._get_control_path(host)
+            if self.masters.get(host) is False:
+                # Unable to start a master before, don't retry.
+                self._count(False)
+                return None
+            if self.masters.get(host) is True and os.path.exists(control_path):
+                self._count(True)
+                return control_path
+            returncode = subprocess.run(
+                ['ssh', '-o', 'ControlMaster=yes', '-o', 'ControlPath={}'.format(control_path),
+                 '-o', 'ControlPersist={}'.format(self.persist), '-f', '-N', host],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL).returncode
+            self.masters[host] = returncode == 0
+            self._count(False)
+            return control_path if self.masters[host] else None
+
+    def wrap_command(self, command):
+        """Return the command, using a shared master connection if it's an ssh or rsync command."""
+        if not self.enabled or len(command) < 2:
+            return command
+        if command[0] == 'ssh' and not str(command[1]).startswith('-'):
+            control_path = self._ensure_master(command[1])
+            if control_path is not None:
+                return ['ssh', '-o', 'ControlPath={}'.format(control_path),
+                        '-o', 'ControlMaster=no', *command[1:]]
+        elif command[0] == 'rsync':
+            host = get_rsync_remote_host(command)
+            if host is not None:
+                control_path = self._ensure_master(host)
+                if control_path is not None:
+                    return ['rsync', '--rsh=ssh -o ControlPath={} -o ControlMaster=no'.format(control_path),
+                            *command[1:]]
+        return command
+
+    def close(self, logger=None):
+        """Close all master connections and log the connection counters."""
+        with self.lock:
+            masters = [(host, self.control_paths[host])
+                       for host, running in self.masters.items() if running]
+            self.masters = {}
+            control_directory, self.control_directory = self.control_directory, None
+            self.control_paths = {}
+        for host, control_path in masters:
+            subprocess.run(
+                ['ssh', '-o', 'ControlPath={}'.format(control_path), '-O', 'exit', host],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if control_directory is not None:
+            shutil.rmtree(control_directory, ignore_errors=True)
+        if logger is not None and (self.opened > 0 or self.reused > 0):
+            logger.log_debug('SSH connections: {} opened, {} reused'.format(
+                self.opened, self.reused))
+
+
+def get_rsync_remote_host(command):
+    """Return the remote host of an rsync command using a remote shell (or None)."""
+    for argument in command[1:]:
+        argument = str(argument)
+        if argument.startswith('-'):
+            if argument.startswith('--rsh') or argument == '-e':
+                # A remote shell is configured explicitly, leave it alone.
+                return None
+            continue
+        match = re.match('(?P<host>[^/:]+):(?!:)', argument)
+        if match is not None:
+            return match.group('host')
+    return None
+
+
+session_manager = SshSessionManager()
+atexit.register(lambda: session_manager.close())
+
+
+def configure(ssh_config):
+    """Configure the shared session manager using the 'ssh' section of the configuration."""
+    session_manager.enabled = ssh_config.get('multiplexing', True)
+    session_manager.persist = ssh_config.get('persist', 300)
+
+
+def wrap_command(command):
+    return session_manager.wrap_command(command)
+
+
+def close_sessions(logger=None):
+    session_manager.close(logger)
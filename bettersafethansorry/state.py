@@ -0,0 +1,191 @@
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+def get_state_directory():
+    """Return (and create) the directory storing the state of Better Safe Than Sorry."""
+    state_home = os.environ.get('XDG_STATE_HOME', None) or os.path.expanduser('~/.local/state')
+    directory = os.path.join(state_home, 'bettersafethansorry')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class VerificationIndex:
+    """Local index of verification results, keyed on the identity of the verified artifact.
+
+    Every entry records the fingerprint of the artifact when it was verified (size, mtime,
+    inode and device of the archive files, or the commits of a repository), the outcome,
+    mode, time and duration of the last verification and the time of the last successful
+    verification. The index is shared by all threads (and processes) verifying backups.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_state_directory(), 'verification.sqlite')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS verifications ('
+                'identity TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, device INTEGER, '
+                'fingerprint TEXT, mode TEXT, outcome TEXT, verified_at REAL, duration REAL, '
+                'last_success_at REAL)')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, identity):
+        """Return the entry of an artifact as a dictionary (or None if it was never verified)."""
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT identity, size, mtime, inode, device, fingerprint, mode, outcome, verified_at, '
+                'duration, last_success_at FROM verifications WHERE identity = ?', (identity,))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, row)) if row is not None else None
+
+    def is_verified(self, identity, fingerprint, mode, max_age=None):
+        """Return the entry if the artifact was successfully verified and didn't change since.
+
+        A deep verification also counts for a quick one, not the other way around. If
+        `max_age` (in seconds) is given, older verifications don't count.
+        """
+        entry = self.lookup(identity)
+        if entry is None or fingerprint is None or entry['outcome'] != 'success':
+            return None
+        if entry['fingerprint'] != json.dumps(fingerprint, sort_keys=True):
+            return None
+        if entry['mode'] != 'deep' and mode == 'deep':
+            return None
+        if max_age is not None and time.time() - entry['verified_at'] > max_age:
+            return None
+        return entry
+
+    def record(self, identity, fingerprint, mode, success, duration):
+        """Record the outcome of a verification of an artifact."""
+        now = time.time()
+        fingerprint = fingerprint or {}
+        with self.lock, self.connection:
+            # Read and write in one transaction (no UPSERT, which needs SQLite 3.24).
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute(
+                'SELECT last_success_at FROM verifications WHERE identity = ?', (identity,)).fetchone()
+            last_success_at = now if success else (row[0] if row is not None else None)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO verifications (identity, size, mtime, inode, device, fingerprint, mode, '
+                'outcome, verified_at, duration, last_success_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (identity, fingerprint.get('size', None), fingerprint.get('mtime', None),
+                 fingerprint.get('inode', None), fingerprint.get('device', None),
+                 json.dumps(fingerprint, sort_keys=True), mode, 'success' if success else 'failure',
+                 now, duration, last_success_at))
+
+
+class IngestIndex:
+    """Local index of the files imported by an action, keyed on the path of the source file.
+
+    Every entry records the size and mtime (in nanoseconds) of the source file when it was
+    imported, its destination and the timestamp (and the source of the timestamp) used to
+    choose the destination. Unchanged source files can be skipped without reading them.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'source TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, destination TEXT, '
+                'timestamp TEXT, timestamp_source TEXT, imported_at REAL)')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, source, size, mtime):
+        """Return the entry of a source file if it didn't change since it was imported (or None)."""
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT source, size, mtime, destination, timestamp, timestamp_source, imported_at '
+                'FROM files WHERE source = ? AND size = ? AND mtime = ?', (source, size, mtime))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, row)) if row is not None else None
+
+    def record(self, source, size, mtime, destination, timestamp, timestamp_source):
+        """Record the import of a source file (in its own transaction)."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (source, size, mtime, destination, timestamp, '
+                'timestamp_source, imported_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (source, size, mtime, destination, timestamp, timestamp_source, time.time()))
+
+
+class ConversionJournal:
+    """Persistent journal of the conversions planned, running and completed by an action.
+
+    The journal records the settings and the directories (with their mtime, in nanoseconds)
+    of the last scan of the source tree, and every planned conversion with its status
+    ('planned', 'running', 'done' or 'failed') and the temporary files it creates (local
+    paths, or [host, path] pairs for files on other hosts). After an
+    interruption, a new run removes the temporary files of the conversions that were running
+    and resumes the pending ones, without rescanning the source tree if it didn't change.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS scan ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), settings TEXT, directories TEXT, scanned_at REAL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'destination TEXT PRIMARY KEY, sequence INTEGER, job TEXT, status TEXT, '
+                'temporary_files TEXT, updated_at REAL)')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_scan(self):
+        """Return the settings and directories ({path: mtime}) of the last scan (or None)."""
+        with self.lock:
+            row = self.connection.execute('SELECT settings, directories FROM scan WHERE id = 0').fetchone()
+        return (json.loads(row[0]), json.loads(row[1])) if row is not None else None
+
+    def start_batch(self, settings, directories, jobs):
+        """Replace the scan and the jobs by a new scan and its jobs (dictionaries with a 'destination')."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO scan (id, settings, directories, scanned_at) VALUES (0, ?, ?, ?)',
+                (json.dumps(settings, sort_keys=True), json.dumps(directories, sort_keys=True), now))
+            self.connection.execute('DELETE FROM jobs')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO jobs (destination, sequence, job, status, temporary_files, updated_at) '
+                "VALUES (?, ?, ?, 'planned', '[]', ?)",
+                [(job['destination'], sequence, json.dumps(job), now) for sequence, job in enumerate(jobs)])
+
+    def get_jobs(self, statuses=None):
+        """Return the jobs (with their status and temporary files), in the order they were planned."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT job, status, temporary_files FROM jobs ORDER BY sequence').fetchall()
+        jobs = []
+        for job, status, temporary_files in rows:
+            if statuses is None or status in statuses:
+                jobs.append(dict(json.loads(job), status=status, **{'temporary-files': json.loads(temporary_files)}))
+        return jobs
+
+    def set_status(self, destination, status, temporary_files=[]):
+        """Update the status (and the temporary files) of a job, in its own transaction."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE jobs SET status = ?, temporary_files = ?, updated_at = ? WHERE destination = ?',
+                (status, json.dumps([list(filename) if isinstance(filename, (list, tuple)) else str(filename)
+                                     for filename in temporary_files]), time.time(), destination))
@@ -1,8 +1,16 @@
+import collections
+import errno
+import fcntl
+import glob
 import os
 import os.path
 import re
+import shutil
+import signal
 import subprocess
 import threading
+import time
+import bettersafethansorry.ssh as bsts_ssh
 
 
 def signal_first_last(iterable):
@@ -52,7 +60,7 @@ def split_user_password_host(user_password_host, user_is_optional=False, passwor
 def is_file(host, filename):
     if host is not None:
         returncode = subprocess.run(
-            ['ssh', host, 'test -f {}'.format(filename)],
+            bsts_ssh.wrap_command(['ssh', host, 'test -f {}'.format(filename)]),
             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         exists = True if returncode == 0 else False
     else:
@@ -60,10 +68,27 @@ def is_file(host, filename):
     return exists
 
 
+_available_programs = {}
+
+
+def is_program_available(host, program):
+    """Return True if program can be found on host (None for localhost); results are cached."""
+    key = (host, program)
+    if key not in _available_programs:
+        if host is not None:
+            returncode = subprocess.run(
+                bsts_ssh.wrap_command(['ssh', host, 'command -v {}'.format(program)]),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+            _available_programs[key] = returncode == 0
+        else:
+            _available_programs[key] = shutil.which(program) is not None
+    return _available_programs[key]
+
+
 def remove_file(host, filename):
     if host is not None:
         returncode = subprocess.run(
-            ['ssh', host, 'rm {}'.format(filename)],
+            bsts_ssh.wrap_command(['ssh', host, 'rm {}'.format(filename)]),
             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         success = True if returncode == 0 else False
     else:
@@ -78,44 +103,249 @@ def remove_file(host, filename):
 def rename_file(host, filename_old, filename_new):
     if host is not None:
         returncode = subprocess.run(
-            ['ssh', host, 'mv {} {}'.format(filename_old, filename_new)],
+            bsts_ssh.wrap_command(['ssh', host, 'mv {} {}'.format(filename_old, filename_new)]),
             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
         success = True if returncode == 0 else False
     else:
         try:
-            os.replace(filename_old, filename_new)
+            try:
+                os.replace(filename_old, filename_new)
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                # Different filesystems: copy (to a temporary file, to replace atomically).
+                copy_file(filename_old, '{}.part'.format(filename_new))
+                shutil.copystat(filename_old, '{}.part'.format(filename_new))
+                os.replace('{}.part'.format(filename_new), filename_new)
+                os.remove(filename_old)
             success = True
         except:
             success = False
     return success
 
 
-def rotate_file(host, filename, tmp_suffix, keep, logger):
+# Buffer size of buffered file copies.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# ioctl request cloning a file on a copy-on-write filesystem (Linux FICLONE).
+FICLONE = 0x40049409
+# Errors of in-kernel copies that aren't supported for the files.
+COPY_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+                           errno.EBADF, errno.EPERM)
+
+
+def _copy_in_kernel(copy_function, source_fd, destination_fd, size):
+    offset = 0
+    while offset < size:
+        copied = copy_function(source_fd, destination_fd, offset, min(size - offset, 1024 * 1024 * 1024))
+        if copied == 0:
+            break
+        offset += copied
+
+
+def copy_file(source, destination):
+    """Copy the contents of a local file, using the cheapest method the filesystems support.
+
+    Tries a reflink clone (copy-on-write filesystems like btrfs and XFS), copy_file_range
+    and sendfile (copies in the kernel) and finally a buffered copy. Returns the method
+    used: 'reflink', 'copy_file_range', 'sendfile' or 'buffered'. Timestamps aren't copied.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        try:
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            return 'reflink'
+        except OSError:
+            pass
+        size = os.fstat(source_fd).st_size
+        copy_functions = []
+        if hasattr(os, 'copy_file_range'):
+            copy_functions.append(('copy_file_range', lambda source_fd, destination_fd, offset, count:
+                                   os.copy_file_range(source_fd, destination_fd, count, offset, offset)))
+        if hasattr(os, 'sendfile'):
+            copy_functions.append(('sendfile', lambda source_fd, destination_fd, offset, count:
+                                   os.sendfile(destination_fd, source_fd, offset, count)))
+        for method, copy_function in copy_functions:
+            try:
+                _copy_in_kernel(copy_function, source_fd, destination_fd, size)
+                return method
+            except OSError as error:
+                if error.errno not in COPY_UNSUPPORTED_ERRORS:
+                    raise
+                # Start over with the next method.
+                os.ftruncate(destination_fd, 0)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
+        shutil.copyfileobj(source_file, destination_file, COPY_BUFFER_SIZE)
+        return 'buffered'
+
+
+def _compose_rotation_steps(filename, keep, companions=[]):
+    """Return the (old, new) steps to make room for a new filename; new is None to remove old.
+
+    Companion files (filename + suffix, e.g. the members of an incremental chain) follow
+    their file. Every step only touches files that aren't affected by the previous steps,
+    so the existence of all files can be checked up front.
+    """
+    # Delete last files.
+    steps = [(filename + '.{}'.format(keep), None)]
+    # Move old files.
+    for number in range(keep, 0, -1):
+        filename_old = filename + \
+            ('.{}'.format(number - 1) if (number - 1) > 0 else '')
+        filename_new = filename + '.{}'.format(number)
+        steps.append((filename_old, filename_new))
+    return [(filename_old + suffix, filename_new + suffix if filename_new is not None else None)
+            for filename_old, filename_new in steps for suffix in ['', *companions]]
+
+
+def _compose_rotation_script(filename, tmp_suffix, keep, companions=[]):
+    """Compose a shell script rotating files in one go, reporting every step on stdout."""
+    lines = [
+        'rc=0',
+        'test -f {} || exit 3'.format(filename + tmp_suffix)
+    ]
+    for filename_old, filename_new in _compose_rotation_steps(filename, keep, companions):
+        if filename_new is None:
+            lines.append("if test -f {0}; then printf 'remove\\t%s\\n' {0}; rm {0} || rc=1; fi".format(
+                filename_old))
+        else:
+            lines.append("if test -f {0}; then printf 'rename\\t%s\\t%s\\n' {0} {1}; mv {0} {1} || rc=1; fi".format(
+                filename_old, filename_new))
+    # Replace companions of the destination file by those of the temporary file.
+    for suffix in companions:
+        lines.append(
+            "if test -f {0}; then printf 'rename\\t%s\\t%s\\n' {0} {1}; mv {0} {1} || rc=1; "
+            "elif test -f {1}; then printf 'remove\\t%s\\n' {1}; rm {1} || rc=1; fi".format(
+                filename + suffix + tmp_suffix, filename + suffix))
+    # Replace destination file by temporary file.
+    lines.append("printf 'rename\\t%s\\t%s\\n' {0} {1}; mv {0} {1} || rc=1".format(
+        filename + tmp_suffix, filename))
+    lines.append('exit $rc')
+    return '\n'.join(lines)
+
+
+def _list_files(directory):
+    """Return the names of the files in a directory (or an empty set if it can't be read)."""
+    try:
+        with os.scandir(directory or '.') as entries:
+            return set(entry.name for entry in entries if entry.is_file())
+    except OSError:
+        return set()
+
+
+def capture_output(command, cwd=None):
+    """Run a (short) command and return its exit code and stdout (as a string)."""
+    result = subprocess.run(
+        bsts_ssh.wrap_command(command), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd)
+    return result.returncode, result.stdout.decode('utf-8', errors='replace')
+
+
+def stat_files(host, filenames):
+    """Return the size, mtime, inode and device of files on host (None for localhost).
+
+    Filenames may contain shell wildcards. The result maps every existing file to a
+    (size, mtime, inode, device) tuple; missing files are left out.
+    """
+    result = {}
+    if host is not None:
+        _, output = capture_output(
+            ['ssh', host, "stat -c '%s %Y %i %d %n' -- {}".format(' '.join(filenames))])
+        for line in output.splitlines():
+            fields = line.split(' ', 4)
+            if len(fields) == 5:
+                result[fields[4]] = tuple(int(field) for field in fields[:4])
+    else:
+        for pattern in filenames:
+            for filename in glob.glob(pattern) if glob.escape(pattern) != pattern else [pattern]:
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                result[filename] = (stat.st_size, int(stat.st_mtime), stat.st_ino, stat.st_dev)
+    return result
+
+
+def parse_duration(duration):
+    """Parse a duration like '90s', '30m', '4h', '7d' or '2w' (or a number of seconds)."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*', str(duration))
+    if match is None:
+        raise ValueError("Invalid duration '{}'".format(duration))
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def parse_size(size):
+    """Parse a size like '512K', '64M', '1G' or '1GiB' (binary units, or a number of bytes)."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*(?:([KMGT])(?:i?B)?|B?)\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size '{}'".format(size))
+    exponent = 'KMGT'.index(match.group(2).upper()) + 1 if match.group(2) else 0
+    return int(float(match.group(1)) * 1024 ** exponent)
+
+
+def list_files(host, directory):
+    """Return the names of the files in a directory on host (None for localhost)."""
+    if host is not None:
+        result = subprocess.run(
+            bsts_ssh.wrap_command(['ssh', host, "find {} -mindepth 1 -maxdepth 1 -type f -printf '%f\\n'".format(
+                directory or '.')]),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return set(result.stdout.decode('utf-8', errors='replace').splitlines())
+    else:
+        return _list_files(directory)
+
+
+def rotate_file(host, filename, tmp_suffix, keep, logger, companions=[]):
     errors = []
     keep = int(keep)
     logger.log_debug("Rotating archives")
-    if is_file(host, filename + tmp_suffix):
-        success = True
-        # Delete last files.
-        if is_file(host, filename + '.{}'.format(keep)):
-            filename_old = filename + '.{}'.format(keep)
-            logger.log_debug("Removing {}".format(filename_old))
-            success &= remove_file(host, filename_old)
-        # Move old files.
-        for number in range(keep, 0, -1):
-            filename_old = filename + \
-                ('.{}'.format(number - 1) if (number - 1) > 0 else '')
-            filename_new = filename + '.{}'.format(number)
-            if is_file(host, filename_old):
-                logger.log_debug("Renaming {} to {}".format(
-                    filename_old, filename_new))
-                success &= rename_file(host, filename_old, filename_new)
-        # Replace destination file by temporary file.
-        filename_old = filename + tmp_suffix
-        filename_new = filename
-        logger.log_debug("Renaming {} to {}".format(
-            filename_old, filename_new))
-        success &= rename_file(host, filename_old, filename_new)
+    if host is not None:
+        # Rotate all files using a single remote script (and thus a single connection).
+        result = subprocess.run(
+            bsts_ssh.wrap_command(['ssh', host, _compose_rotation_script(filename, tmp_suffix, keep, companions)]),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+            step = line.split('\t')
+            if step[0] == 'remove' and len(step) == 2:
+                logger.log_debug("Removing {}".format(step[1]))
+            elif step[0] == 'rename' and len(step) == 3:
+                logger.log_debug("Renaming {} to {}".format(step[1], step[2]))
+        tmp_file_exists = result.returncode != 3
+        success = result.returncode == 0
+    else:
+        # List the directory once instead of checking every file separately.
+        directory, basename = os.path.split(filename)
+        existing_files = _list_files(directory)
+        tmp_file_exists = basename + tmp_suffix in existing_files
+        if tmp_file_exists:
+            success = True
+            for filename_old, filename_new in _compose_rotation_steps(filename, keep, companions):
+                if os.path.basename(filename_old) not in existing_files:
+                    continue
+                if filename_new is None:
+                    logger.log_debug("Removing {}".format(filename_old))
+                    success &= remove_file(host, filename_old)
+                else:
+                    logger.log_debug("Renaming {} to {}".format(
+                        filename_old, filename_new))
+                    success &= rename_file(host, filename_old, filename_new)
+            # Replace companions of the destination file by those of the temporary file.
+            for suffix in companions:
+                if basename + suffix + tmp_suffix in existing_files:
+                    logger.log_debug("Renaming {} to {}".format(
+                        filename + suffix + tmp_suffix, filename + suffix))
+                    success &= rename_file(host, filename + suffix + tmp_suffix, filename + suffix)
+                elif is_file(host, filename + suffix):
+                    # Left behind by the previous destination file (if it wasn't rotated).
+                    logger.log_debug("Removing {}".format(filename + suffix))
+                    success &= remove_file(host, filename + suffix)
+            # Replace destination file by temporary file.
+            filename_old = filename + tmp_suffix
+            filename_new = filename
+            logger.log_debug("Renaming {} to {}".format(
+                filename_old, filename_new))
+            success &= rename_file(host, filename_old, filename_new)
+    if tmp_file_exists:
         # Log errors.
         if not success:
             logger.log_error("Unable to rotate file '{}'".format(filename))
@@ -129,18 +359,214 @@ def rotate_file(host, filename, tmp_suffix, keep, logger):
     return errors
 
 
-def run_processes(commands, stdout_filename, logger, cwd=None):
+class Cancellation:
+    """Cancellation token shared by a group of actions.
+
+    Subprocesses started by run_processes are registered with the token; cancelling the
+    token terminates all registered subprocesses (and subprocesses registered afterwards).
+    Registered subprocesses lead their own process group, so their children (shell scripts,
+    the remote command of ssh...) are terminated too; process groups that are still alive
+    after `grace_period` seconds are killed.
+    """
+
+    def __init__(self, grace_period=5.0):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.processes = set()
+        self.grace_period = grace_period
+
+    @staticmethod
+    def _signal_group(process_group, signal_number):
+        try:
+            os.killpg(process_group, signal_number)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _terminate(self, process):
+        # The subprocess was started in a new session: its pid is the id of its process group,
+        # which may outlive the subprocess itself.
+        self._signal_group(process.pid, signal.SIGTERM)
+        timer = threading.Timer(self.grace_period, self._signal_group, args=(process.pid, signal.SIGKILL))
+        timer.daemon = True
+        timer.start()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for process in processes:
+            self._terminate(process)
+
+    def is_cancelled(self):
+        with self.lock:
+            return self.cancelled
+
+    def register(self, process):
+        with self.lock:
+            if not self.cancelled:
+                self.processes.add(process)
+                return
+        self._terminate(process)
+
+    def unregister(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+
+# Default number of stderr lines kept per subprocess (older lines are only logged).
+DEFAULT_STDERR_LINES = 1000
+# Longer stderr lines are split.
+MAX_STDERR_LINE_LENGTH = 64 * 1024
+# Buffer size used when relaying data between subprocesses.
+RELAY_BUFFER_SIZE = 1024 * 1024
+
+
+def _wait_with_rusage(process):
+    """Wait for a subprocess and return its resource usage (or None if unavailable)."""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped (e.g. by Popen.poll while cancelling).
+        process.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def _write_all(file_descriptor, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.write(file_descriptor, view)
+        view = view[written:]
+
+
+def run_processes(commands, stdout_filename, logger, cwd=None, cancellation=None, stderr_lines=None,
+                  statistics=None, digests=None, capture_stdout=False, resource_limits=None,
+                  stdout_callback=None):
+    """Run a pipeline of subprocesses, optionally sending the stdout of the last one to a file.
+
+    If `statistics` is a dictionary, the data flowing out of every subprocess is relayed
+    (and counted) by this process and the dictionary is filled with the elapsed time and,
+    for every subprocess, the number of bytes written to stdout, the throughput and the
+    CPU time and maximum resident set size (of the local process, i.e. ssh for remote
+    commands). `digests` maps the index of a subprocess to a hashlib object, which is
+    updated with the stdout of that subprocess while it's relayed. If `capture_stdout` is
+    set (and there's no output file), the stdout of the last subprocess is returned as a
+    string. `resource_limits` (see resources.py) sets the priorities of the subprocesses
+    and throttles the data sent to and received from ssh subprocesses. If `stdout_callback`
+    is given (and there's no output file), it's called with every line of the stdout of
+    the last subprocess while it runs.
+    """
 
     def catch_stderr(index):
         # Do not use Popen.communicate because it also consumes part of
         # the stdout which should be received by the next subprocess.
-        stderr = bytearray()
-        for stderr_line in iter(processes[index].stderr.readline, b''):
-            stderr.extend(stderr_line)
-        processes[index].wait()
+        # Log stderr lines as they arrive, but only keep the last ones in memory.
+        program = os.path.basename(str(commands[index][0]))
+        stderr = collections.deque(maxlen=max_stderr_lines)
+        suppressed_lines = 0
+        stderr_file = processes[index].stderr
+        for stderr_line in iter(lambda: stderr_file.readline(MAX_STDERR_LINE_LENGTH), b''):
+            line = stderr_line.decode('utf-8', errors='replace').rstrip('\r\n')
+            logger.log_debug('{}: {}'.format(program, line))
+            if len(stderr) == stderr.maxlen:
+                suppressed_lines += 1
+            stderr.append(line)
+        if metering:
+            rusages[index] = _wait_with_rusage(processes[index])
+        else:
+            processes[index].wait()
+        end_times[index] = time.monotonic()
         exit_codes[index] = processes[index].returncode
-        stderrs[index] = stderr.decode('utf-8') if stderr is not None else ''
+        kept_lines = list(stderr)
+        if suppressed_lines > 0:
+            logger.log_debug("Suppressed {} earlier stderr line(s) of subprocess '{}'".format(
+                suppressed_lines, program))
+            kept_lines.insert(0, '({} earlier line(s) suppressed)'.format(suppressed_lines))
+        stderrs[index] = '\n'.join(kept_lines)
+
+    def catch_stdout(index):
+        if stdout_callback is None:
+            stdouts[index] = processes[index].stdout.read().decode('utf-8', errors='replace')
+        else:
+            lines = []
+            for stdout_line in iter(processes[index].stdout.readline, b''):
+                line = stdout_line.decode('utf-8', errors='replace')
+                stdout_callback(line.rstrip('\r\n'))
+                if capture_stdout:
+                    lines.append(line)
+            stdouts[index] = ''.join(lines) if capture_stdout else None
+        processes[index].stdout.close()
+
+    def pass_stdout_lines(data, final=False):
+        # Call the stdout callback for every complete line of relayed data.
+        partial_stdout_line.extend(data)
+        *lines, remainder = bytes(partial_stdout_line).split(b'\n')
+        if final and len(remainder) > 0:
+            lines.append(remainder)
+            remainder = b''
+        partial_stdout_line[:] = remainder
+        for line in lines:
+            stdout_callback(line.decode('utf-8', errors='replace').rstrip('\r'))
 
+    def relay_stdout(index):
+        # Copy the stdout of a subprocess to the stdin of the next subprocess (or to the
+        # output file), counting (and hashing) the bytes.
+        source = processes[index].stdout.fileno()
+        digest = digests.get(index, None) if digests is not None else None
+        if index + 1 < len(processes):
+            destination = processes[index + 1].stdin
+        else:
+            destination = stdout_file
+        try:
+            while True:
+                data = os.read(source, RELAY_BUFFER_SIZE)
+                if len(data) == 0:
+                    break
+                bytes_out[index] += len(data)
+                if index in network_legs:
+                    resource_limits.throttle(len(data))
+                if digest is not None:
+                    digest.update(data)
+                if destination is stdout_file:
+                    if destination is not None:
+                        destination.write(data)
+                    else:
+                        if capture_stdout:
+                            captured_stdout.append(data)
+                        if stdout_callback is not None:
+                            pass_stdout_lines(data)
+                else:
+                    _write_all(destination.fileno(), data)
+        except BrokenPipeError:
+            # The next subprocess exited, let this one receive a SIGPIPE too.
+            pass
+        finally:
+            processes[index].stdout.close()
+            if destination is not stdout_file:
+                destination.close()
+            elif destination is None and stdout_callback is not None:
+                pass_stdout_lines(b'', True)
+
+    metering = statistics is not None
+    capture_stdout = capture_stdout and stdout_filename is None
+    captured_stdout = []
+    stdout_callback = stdout_callback if stdout_filename is None else None
+    partial_stdout_line = bytearray()
+    # Relayed data from or to ssh subprocesses is throttled if a bandwidth limit applies.
+    network_legs = set()
+    if resource_limits is not None and resource_limits.throttles():
+        network_legs = {index for index, command in enumerate(commands)
+                        if command[0] == 'ssh' or (index + 1 < len(commands) and commands[index + 1][0] == 'ssh')}
+    # The data is relayed by this process to meter, hash or throttle it.
+    relaying = metering or bool(digests) or bool(network_legs)
+    max_stderr_lines = int(stderr_lines) if stderr_lines is not None else DEFAULT_STDERR_LINES
     # Open output file if stdout of last process needs to be sent to a file.
     if stdout_filename is not None:
         stdout_file = open(stdout_filename, 'wb')
@@ -152,6 +578,10 @@ def run_processes(commands, stdout_filename, logger, cwd=None):
     stdouts = []
     stderrs = []
     threads = []
+    rusages = []
+    start_times = []
+    end_times = []
+    bytes_out = []
     for command, is_first, is_last in signal_first_last(commands):
         if cwd is None:
             logger.log_debug('Starting subprocess: {}'.format(command))
@@ -159,32 +589,109 @@ def run_processes(commands, stdout_filename, logger, cwd=None):
             logger.log_debug(
                 "Starting subprocess: {} (cwd: '{}')".format(command, cwd))
         process_index = len(processes)
-        processes.append(subprocess.Popen(
-            command,
-            stdin=processes[-1].stdout if not is_first else None,
-            stdout=subprocess.PIPE if is_last is False else (
+        if relaying:
+            stdin = subprocess.PIPE if not is_first else None
+            stdout = subprocess.PIPE
+        else:
+            stdin = processes[-1].stdout if not is_first else None
+            stdout = subprocess.PIPE if is_last is False or capture_stdout or stdout_callback is not None else (
                 stdout_file if stdout_filename is not None else
-                subprocess.DEVNULL),
+                subprocess.DEVNULL)
+        start_times.append(time.monotonic())
+        processes.append(subprocess.Popen(
+            resource_limits.wrap_command(command) if resource_limits is not None else bsts_ssh.wrap_command(command),
+            stdin=stdin,
+            stdout=stdout,
             stderr=subprocess.PIPE,
-            cwd=cwd))
+            cwd=cwd,
+            # Cancellable subprocesses get their own process group, so their children can be terminated too.
+            start_new_session=cancellation is not None))
+        if cancellation is not None:
+            cancellation.register(processes[-1])
         exit_codes.append(None)
         stdouts.append(None)
         stderrs.append(None)
+        rusages.append(None)
+        end_times.append(None)
+        bytes_out.append(0)
         thread = threading.Thread(target=catch_stderr, args=(process_index,))
         threads.append(thread)
         thread.start()
+    if relaying:
+        for process_index in range(len(processes)):
+            thread = threading.Thread(target=relay_stdout, args=(process_index,))
+            threads.append(thread)
+            thread.start()
+    elif (capture_stdout or stdout_callback is not None) and len(processes) > 0:
+        thread = threading.Thread(target=catch_stdout, args=(len(processes) - 1,))
+        threads.append(thread)
+        thread.start()
     # Wait for communicate threads to finish
     logger.log_debug("Waiting for subprocess(es) to finish")
     for thread in threads:
         thread.join()
     logger.log_debug("Subprocess(es) finished")
+    if cancellation is not None:
+        for process in processes:
+            cancellation.unregister(process)
     # Close output file.
     if stdout_filename is not None:
         stdout_file.close()
+    if relaying and capture_stdout and len(processes) > 0:
+        stdouts[-1] = b''.join(captured_stdout).decode('utf-8', errors='replace')
+    # Collect statistics.
+    if metering:
+        statistics['elapsed'] = max(end_times) - min(start_times) if len(processes) > 0 else 0.0
+        statistics['stages'] = []
+        for command, rusage, start_time, end_time, stage_bytes_out in zip(
+                commands, rusages, start_times, end_times, bytes_out):
+            elapsed = end_time - start_time
+            statistics['stages'].append({
+                'command': os.path.basename(str(command[0])),
+                'elapsed': elapsed,
+                'bytes-out': stage_bytes_out,
+                'bytes-per-second': stage_bytes_out / elapsed if elapsed > 0 else None,
+                'user-time': rusage.ru_utime if rusage is not None else None,
+                'system-time': rusage.ru_stime if rusage is not None else None,
+                # Linux reports the maximum resident set size in KiB.
+                'max-rss': rusage.ru_maxrss * 1024 if rusage is not None else None
+            })
     # Return all exit codes and stdout and stderr output.
     return exit_codes, stdouts, stderrs
 
 
+def format_size(size):
+    """Format a number of bytes in a human readable way (e.g. '1.5 GiB')."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(size) < 1024 or unit == 'TiB':
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(int(size))
+        size /= 1024
+
+
+def format_duration(seconds):
+    """Format a duration in a human readable way (e.g. '4h 05m', '12m 30s' or '8s')."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}h {:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{}m {:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}s'.format(seconds)
+
+
+def log_pipeline_statistics(statistics, logger):
+    """Log the statistics collected by run_processes, one line per subprocess."""
+    logger.log_info('Pipeline finished in {:.1f} s'.format(statistics['elapsed']))
+    for number, stage in enumerate(statistics['stages'], 1):
+        details = ['{} out'.format(format_size(stage['bytes-out']))]
+        if stage['bytes-per-second'] is not None:
+            details.append('{}/s'.format(format_size(stage['bytes-per-second'])))
+        if stage['user-time'] is not None:
+            details.append('CPU {:.1f} s user, {:.1f} s system'.format(
+                stage['user-time'], stage['system-time']))
+            details.append('max RSS {}'.format(format_size(stage['max-rss'])))
+        logger.log_info("Stage {} '{}': {}".format(number, stage['command'], ', '.join(details)))
+
+
 def log_subprocess_errors(commands, exit_codes, stdouts, stderrs, logger):
     errors = []
     for command, exit_code, stdout, stderr in zip(commands, exit_codes, stdouts, stderrs):
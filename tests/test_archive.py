@@ -0,0 +1,189 @@
+import hashlib
+import os
+import subprocess
+import bettersafethansorry.ssh as bsts_ssh
+from bettersafethansorry.actions.archive import ArchiveFiles
+
+
+class _Logger:
+
+    def __init__(self):
+        self.errors = []
+        self.infos = []
+
+    def log_debug(self, message):
+        pass
+
+    def log_info(self, message):
+        self.infos.append(message)
+
+    def log_warning(self, message):
+        pass
+
+    def log_error(self, message):
+        self.errors.append(message)
+
+
+def _list_archive(filename):
+    return subprocess.run(['tar', '-tzf', filename], stdout=subprocess.PIPE,
+                          check=True).stdout.decode('utf-8').split()
+
+
+def test_incremental_chain(tmp_path):
+    source = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    source.mkdir()
+    destination.mkdir()
+    config = {
+        'source-directory': str(source),
+        'destination-file': str(destination / 'files.tar.gz'),
+        'compression': 'gzip',
+        'incremental': 'incremental',
+        'full-every': 3,
+        'keep': 1
+    }
+    for number in range(1, 5):
+        (source / 'file{}'.format(number)).write_text(str(number))
+        logger = _Logger()
+        assert ArchiveFiles(dict(config), logger).do(False) == []
+        assert ArchiveFiles(dict(config), logger).verify(False) == []
+    assert sorted(path.name for path in destination.iterdir()) == [
+        'files.tar.gz', 'files.tar.gz.1', 'files.tar.gz.1.incr.1', 'files.tar.gz.1.incr.2',
+        'files.tar.gz.1.snar', 'files.tar.gz.snar']
+    assert './file3' in _list_archive(str(destination / 'files.tar.gz.1.incr.2'))
+    assert './file2' not in _list_archive(str(destination / 'files.tar.gz.1.incr.2'))
+    assert './file2' in _list_archive(str(destination / 'files.tar.gz'))
+    # A gap in the chain is reported by verify.
+    (destination / 'files.tar.gz.1.incr.1').rename(destination / 'files.tar.gz.incr.2')
+    assert ArchiveFiles(dict(config), _Logger()).verify(False) != []
+
+
+def test_checksum_file_and_quick_verify(tmp_path):
+    (tmp_path / 'file').write_text('data')
+    archive = tmp_path / 'files.tar.gz'
+    config = {
+        'source-directory': str(tmp_path),
+        'excludes': ['./files.tar.gz*'],
+        'destination-file': str(archive),
+        'compression': 'gzip',
+        'checksum': 'sha256',
+        'keep': 1
+    }
+    for _ in range(2):
+        assert ArchiveFiles(dict(config), _Logger()).do(False) == []
+    for filename in (archive, tmp_path / 'files.tar.gz.1'):
+        checksum = (tmp_path / (filename.name + '.sha256')).read_text().strip()
+        assert checksum == hashlib.sha256(filename.read_bytes()).hexdigest()
+    assert ArchiveFiles(dict(config), _Logger()).verify(False, 'quick') == []
+    with open(archive, 'ab') as archive_file:
+        archive_file.write(b'\0')
+    # Trailing garbage goes unnoticed by a deep verify, but not by a quick verify.
+    assert ArchiveFiles(dict(config), _Logger()).verify(False, 'quick') != []
+
+
+def test_verify_reports_existence_and_reads_uncompressed_archives(tmp_path):
+    (tmp_path / 'file').write_text('data')
+    archive = tmp_path / 'files.tar'
+    config = {
+        'source-directory': str(tmp_path),
+        'excludes': ['./files.tar*'],
+        'destination-file': str(archive),
+        'keep': 1
+    }
+    assert ArchiveFiles(dict(config), _Logger()).verify(False) == [
+        'Backup file does not exist: {}'.format(archive)]
+    assert ArchiveFiles(dict(config), _Logger()).do(False) == []
+    action = ArchiveFiles(dict(config), _Logger())
+    exit_codes, stdouts, stderrs = action._run_processes(
+        action._compose_verify_commands(), capture_stdout=True)
+    report = ArchiveFiles._parse_verify_report(stdouts[0])
+    assert exit_codes == [0]
+    assert report[str(archive)]['exists'] and report[str(archive)]['integrity'] == 'ok'
+    assert report[str(archive)]['size'] == archive.stat().st_size
+    # A truncated uncompressed archive is detected.
+    with open(archive, 'r+b') as archive_file:
+        archive_file.truncate(600)
+    assert ArchiveFiles(dict(config), _Logger()).verify(False) != []
+
+
+def test_chunked_transfer_resumes_after_failure(tmp_path, monkeypatch):
+    # Fake ssh executing the remote command locally, failing the first concatenation.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ssh').write_text(
+        '#!/bin/sh\nshift\n'
+        'case "$*" in *"&& rm -r "*) if [ -e {0} ]; then rm {0}; exit 1; fi;; esac\n'
+        'exec sh -c "$*"\n'.format(tmp_path / 'fail'))
+    (bin_directory / 'ssh').chmod(0o755)
+    (tmp_path / 'fail').write_text('')
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    monkeypatch.setattr(bsts_ssh, 'session_manager', bsts_ssh.SshSessionManager(enabled=False))
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'file').write_bytes(os.urandom(20000))
+    archive = tmp_path / 'files.tar'
+    config = {
+        'source-directory': str(source),
+        'destination-host': 'localhost',
+        'destination-file': str(archive),
+        'chunk-size': '4K',
+        'spool-directory': str(tmp_path / 'spool'),
+        'checksum': 'sha256',
+        'retry': 2
+    }
+    logger = _Logger()
+    assert ArchiveFiles(dict(config), logger).do(False) == []
+    assert len([info for info in logger.infos if info.startswith('Spooling archive')]) == 1
+    assert any(info.startswith('Resuming transfer at chunk') for info in logger.infos)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'bin', 'files.tar', 'files.tar.sha256', 'source', 'spool']
+    assert list((tmp_path / 'spool').iterdir()) == []
+    assert (tmp_path / 'files.tar.sha256').read_text().strip() == hashlib.sha256(archive.read_bytes()).hexdigest()
+    assert ArchiveFiles(dict(config), _Logger()).verify(False) == []
+
+
+def test_chunked_transfer_resumes_in_next_run(tmp_path, monkeypatch):
+    # Fake ssh executing the remote command locally, failing the concatenation while 'fail' exists.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ssh').write_text(
+        '#!/bin/sh\nshift\n'
+        'case "$*" in *"&& rm -r "*) if [ -e {0} ]; then exit 1; fi;; esac\n'
+        'exec sh -c "$*"\n'.format(tmp_path / 'fail'))
+    (bin_directory / 'ssh').chmod(0o755)
+    (tmp_path / 'fail').write_text('')
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    monkeypatch.setattr(bsts_ssh, 'session_manager', bsts_ssh.SshSessionManager(enabled=False))
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'file').write_bytes(os.urandom(20000))
+    archive = tmp_path / 'files.tar'
+    config = {
+        'source-directory': str(source),
+        'destination-host': 'localhost',
+        'destination-file': str(archive),
+        'chunk-size': '4K',
+        'spool-directory': str(tmp_path / 'spool')
+    }
+    assert ArchiveFiles(dict(config), _Logger()).do(False) != []
+    manifest = (tmp_path / 'files.tar.chunks' / 'manifest').read_text().splitlines()
+    assert manifest[0] == 'chunk-size 4096'
+    # The next run spools the (unchanged) archive again and only sends the last, partial chunk.
+    (tmp_path / 'fail').unlink()
+    logger = _Logger()
+    assert ArchiveFiles(dict(config), logger).do(False) == []
+    full_chunks = archive.stat().st_size // 4096
+    assert 'Resuming transfer at chunk {} ('.format(full_chunks) in ' '.join(logger.infos)
+    assert not (tmp_path / 'files.tar.chunks').exists()
+    assert ArchiveFiles(dict(config), _Logger()).verify(False) == []
+    # Chunks that don't match the spool (the source changed) are sent again.
+    (tmp_path / 'fail').write_text('')
+    assert ArchiveFiles(dict(config), _Logger()).do(False) != []
+    content = os.urandom(20000)
+    (source / 'file').write_bytes(content)
+    (tmp_path / 'fail').unlink()
+    logger = _Logger()
+    assert ArchiveFiles(dict(config), logger).do(False) == []
+    assert not any(info.startswith('Resuming transfer') for info in logger.infos)
+    assert subprocess.run(['tar', '-xOf', str(archive), './file'], stdout=subprocess.PIPE,
+                          check=True).stdout == content
@@ -0,0 +1,92 @@
+import argparse
+import threading
+import time
+import bettersafethansorry.cli as bsts_cli
+import bettersafethansorry.operation as bsts_operation
+from bettersafethansorry.configuration import Configuration
+from bettersafethansorry.logging import MasterLogger
+
+
+def _configure(monkeypatch, config):
+    logger = MasterLogger()
+    configuration = Configuration(logger)
+    configuration.config = config
+    monkeypatch.setattr(bsts_cli, 'configuration', configuration)
+    monkeypatch.setattr(bsts_cli, 'logger', logger)
+
+
+def _arguments(backup=[], all=False, outdated=False, tag=[], max_parallel=None):
+    return argparse.Namespace(backup=backup, all=all, outdated=outdated, tag=tag, max_parallel=max_parallel)
+
+
+def test_select_backups(monkeypatch):
+    _configure(monkeypatch, {'backups': {
+        'home': {'tags': ['daily'], 'actions': []},
+        'home-media': {'tags': ['weekly'], 'actions': []},
+        'server': {'tags': ['daily', 'offsite'], 'actions': []}}})
+    assert bsts_cli.select_backups(_arguments(all=True)) == ['home', 'home-media', 'server']
+    assert bsts_cli.select_backups(_arguments(outdated=True)) == ['home', 'home-media', 'server']
+    assert bsts_cli.select_backups(_arguments(['server', 'home*'])) == ['server', 'home', 'home-media']
+    assert bsts_cli.select_backups(_arguments(tag=['daily'])) == ['home', 'server']
+    assert bsts_cli.select_backups(_arguments(['home*'], tag=['daily', 'weekly'])) == ['home', 'home-media']
+    assert bsts_cli.selects_multiple_backups(_arguments(['home*']))
+    assert not bsts_cli.selects_multiple_backups(_arguments(['home']))
+
+
+def test_max_parallel_is_bounded_by_default(monkeypatch):
+    _configure(monkeypatch, {'backups': {}})
+    assert bsts_cli.get_max_parallel(_arguments()) == 1
+    assert bsts_cli.get_max_parallel(_arguments(max_parallel=3)) == 3
+    _configure(monkeypatch, {'backups': {}, 'max-parallel': 4})
+    assert bsts_cli.get_max_parallel(_arguments()) == 4
+    assert bsts_cli.get_max_parallel(_arguments(max_parallel=2)) == 2
+
+
+def test_run_backups_keeps_order_and_limit(monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def run_backup(backup_name, backup_config, dry_run, logger, scheduler):
+        def action():
+            with lock:
+                running.append(backup_name)
+                peak.append(len(running))
+            time.sleep(backup_config['duration'])
+            with lock:
+                running.remove(backup_name)
+            return backup_config['errors']
+        return scheduler.run([(action, ())])[0]
+
+    monkeypatch.setattr(bsts_operation, 'run_backup', run_backup)
+    backups = [('slow', {'duration': 0.2, 'errors': []}),
+               ('failing', {'duration': 0.0, 'errors': ['disk full']}),
+               ('fast', {'duration': 0.0, 'errors': []})]
+    results = bsts_operation.run_backups(backups, False, MasterLogger())
+    assert results == [('slow', []), ('failing', ['disk full']), ('fast', [])]
+    assert max(peak) == 1
+    peak.clear()
+    bsts_operation.run_backups(backups, False, MasterLogger(), max_parallel=3)
+    assert max(peak) > 1
+
+
+def test_do_backups_exit_status(monkeypatch):
+    _configure(monkeypatch, {'backups': {'good': {'actions': []}, 'bad': {'actions': []}}})
+    monkeypatch.setattr(bsts_operation, 'run_backup',
+                        lambda name, config, dry_run, logger, scheduler: ['error'] if name == 'bad' else [])
+    assert bsts_cli.do_backups(['good'], False, False, 1) == 0
+    assert bsts_cli.do_backups(['good', 'bad'], False, False, 1) == 1
+
+
+def test_dry_run_verification_does_not_open_index(tmp_path, monkeypatch):
+    _configure(monkeypatch, {'backups': {}})
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    arguments = argparse.Namespace(max_age=None, budget='1h', force=False)
+    verify_options = bsts_cli.get_verify_options(arguments, True)
+    assert verify_options['index'] is None
+    assert verify_options['budget'] == 3600
+    assert not (tmp_path / 'state').exists()
+    verify_options = bsts_cli.get_verify_options(arguments, False)
+    assert verify_options['index'] is not None
+    verify_options['index'].close()
+    assert (tmp_path / 'state').exists()
@@ -0,0 +1,62 @@
+import pytest
+import bettersafethansorry.utilities as bsts_utils
+from bettersafethansorry.compression import CompressionProfile
+
+
+def test_free_form_commands_are_used_as_is():
+    profile = CompressionProfile('/usr/bin/bzip2 -9')
+    assert profile.compress_command() == '/usr/bin/bzip2 -9'
+    assert profile.decompress_command() == 'bzip2 -dc'
+    profile = CompressionProfile('xz -T0')
+    assert profile.compress_command() == 'xz -T0'
+    assert profile.decompress_command() == 'xz -dc'
+    profile = CompressionProfile('lzop')
+    assert profile.compress_command() == 'lzop'
+    assert profile.decompress_command() is None
+
+
+def test_profiles_with_options(monkeypatch):
+    monkeypatch.setattr(bsts_utils, 'is_program_available', lambda host, program: True)
+    profile = CompressionProfile('zstd:level=9,threads=auto')
+    assert profile.compress_command() == 'zstd -9 -T0'
+    assert profile.decompress_command() == 'zstd -dc'
+    assert CompressionProfile('zstd:level=22').compress_command() == 'zstd --ultra -22'
+    assert CompressionProfile('xz:threads=4').compress_command() == 'xz -T4'
+    assert CompressionProfile('pigz:level=6,threads=8').compress_command() == 'pigz -6 -p 8'
+    assert CompressionProfile('pbzip2').decompress_command() == 'pbzip2 -dc'
+    assert CompressionProfile('gz').compress_command() == 'gzip'
+
+
+def test_parallel_implementation_is_detected(monkeypatch):
+    available = {'lbzip2': False, 'pbzip2': True, 'pigz': False}
+    monkeypatch.setattr(bsts_utils, 'is_program_available',
+                        lambda host, program: available[program])
+    profile = CompressionProfile('bzip2:level=9,threads=auto')
+    assert profile.compress_command('user@host') == 'pbzip2 -9'
+    assert profile.decompress_command('user@host') == 'pbzip2 -dc'
+    profile = CompressionProfile('gzip:threads=auto')
+    assert profile.compress_command() == 'gzip'
+    # The reference program is used if no threads are requested.
+    assert CompressionProfile('bzip2').compress_command() == 'bzip2'
+
+
+def test_invalid_profiles():
+    with pytest.raises(ValueError):
+        CompressionProfile('zstd:speed=fast')
+    with pytest.raises(ValueError):
+        CompressionProfile('zstd:level=high')
+    with pytest.raises(ValueError):
+        CompressionProfile('brotli:level=5')
+
+
+def test_decompression_falls_back_to_reference_program(monkeypatch):
+    # The parallel programs are only installed on the host writing the backups.
+    monkeypatch.setattr(bsts_utils, 'is_program_available',
+                        lambda host, program: host == 'writer' or program in ('gzip', 'bzip2'))
+    for spec, compress, decompress in (('pigz', 'pigz', 'gzip -dc'), ('lbzip2 -9', 'lbzip2 -9', 'bzip2 -dc'),
+                                       ('pbzip2:level=9', 'pbzip2 -9', 'bzip2 -dc'),
+                                       ('bzip2:threads=auto', 'lbzip2', 'bzip2 -dc')):
+        profile = CompressionProfile(spec)
+        assert profile.compress_command('writer') == compress
+        assert profile.decompress_command('writer') == compress.split()[0] + ' -dc'
+        assert profile.decompress_command('verifier') == decompress
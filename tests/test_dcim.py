@@ -0,0 +1,395 @@
+import os
+import random
+import threading
+import time
+import bettersafethansorry.actions.dcim as bsts_dcim
+import bettersafethansorry.ssh as bsts_ssh
+from bettersafethansorry.actions.dcim import ConvertAndMergeVideos, CopyPhotosVideos
+
+
+class _Logger:
+
+    def __init__(self):
+        self.infos = []
+
+    def log_debug(self, message):
+        pass
+
+    def log_info(self, message):
+        self.infos.append(message)
+
+    def log_warning(self, message):
+        self.infos.append(message)
+
+    def log_error(self, message):
+        pass
+
+
+def test_ingest_index_skips_imported_files(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    read_files = []
+    monkeypatch.setattr(bsts_dcim.bsts_metadata, 'read_datetime_original',
+                        lambda filename: read_files.append(os.path.basename(filename)) or '2024:05:17 10:42:01')
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        (source / name).write_bytes(b'photo ' + name.encode('utf-8'))
+    config = {
+        'source-directory': str(source),
+        'destination-directory': str(tmp_path / 'destination' / '%Y' / '%Y-%m-%d'),
+        'files': ['*.jpg']
+    }
+    assert CopyPhotosVideos(dict(config), _Logger()).do(False) == []
+    assert (tmp_path / 'destination' / '2024' / '2024-05-17' / 'a.jpg').read_bytes() == b'photo a.jpg'
+    assert sorted(read_files) == ['a.jpg', 'b.jpg']
+    # Unchanged files are skipped without reading them, changed files are read again.
+    os.utime(source / 'b.jpg', (0, 0))
+    assert CopyPhotosVideos(dict(config), _Logger()).do(False) == []
+    assert sorted(read_files) == ['a.jpg', 'b.jpg', 'b.jpg']
+    assert CopyPhotosVideos(dict(config, **{'ingest-index': False}), _Logger()).do(False) == []
+    assert sorted(read_files) == ['a.jpg', 'a.jpg', 'b.jpg', 'b.jpg', 'b.jpg']
+
+
+def test_pipeline_keeps_scan_order(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+
+    def read_datetime_original(filename):
+        time.sleep(random.random() / 100)
+        return '2024:05:{:02d} 10:42:01'.format(int(os.path.basename(filename)[:2]) % 3 + 1)
+
+    monkeypatch.setattr(bsts_dcim.bsts_metadata, 'read_datetime_original', read_datetime_original)
+    source = tmp_path / 'source'
+    for directory in ('a', 'b'):
+        (source / directory).mkdir(parents=True)
+        for number in range(20):
+            (source / directory / '{:02d}.jpg'.format(number)).write_text(directory)
+    config = {
+        'source-directory': str(source),
+        'destination-directory': str(tmp_path / 'destination' / '%Y-%m-%d'),
+        'files': ['*.jpg'],
+        'metadata-workers': 8,
+        'copy-workers': 3,
+        'queue-size': 4
+    }
+    dry_run_logger = _Logger()
+    assert CopyPhotosVideos(dict(config), dry_run_logger).do(True) == []
+    assert not (tmp_path / 'destination').exists()
+    assert not (tmp_path / 'state').exists()
+    logger = _Logger()
+    assert CopyPhotosVideos(dict(config), logger).do(False) == []
+    # Files of the first directory win, in scan order.
+    assert [info.split()[1] for info in logger.infos if info.startswith('Copying ')] == [
+        '{:02d}.jpg'.format(number) for number in range(20)]
+    assert logger.infos[-1].startswith('Copied 20 file(s) (')
+    assert len(dry_run_logger.infos) == 20
+    assert (tmp_path / 'destination' / '2024-05-01' / '03.jpg').read_text() == 'a'
+
+
+def test_unexpected_errors_fail_items_without_stalling_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+
+    read_file_metadata = CopyPhotosVideos._read_file_metadata
+
+    def read_file_metadata_or_fail(self, item, index):
+        if item.filename == '03.jpg':
+            raise ValueError('unexpected metadata')
+        read_file_metadata(self, item, index)
+
+    def copy_file(self, item, index):
+        raise RuntimeError('copy failed')
+
+    monkeypatch.setattr(CopyPhotosVideos, '_read_file_metadata', read_file_metadata_or_fail)
+    monkeypatch.setattr(CopyPhotosVideos, '_copy_file', copy_file)
+    source = tmp_path / 'source'
+    source.mkdir()
+    for number in range(10):
+        (source / '{:02d}.jpg'.format(number)).write_text('photo')
+    config = {
+        'source-directory': str(source),
+        'destination-directory': str(tmp_path / 'destination'),
+        'files': ['*.jpg'],
+        'metadata-workers': 2,
+        'copy-workers': 2,
+        'queue-size': 1
+    }
+    results = []
+    thread = threading.Thread(target=lambda: results.append(CopyPhotosVideos(config, _Logger()).do(False)))
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    errors = results[0]
+    assert len(errors) == 10
+    assert errors[3] == 'Unable to read {}: unexpected metadata'.format(source / '03.jpg')
+    assert all(error.endswith(': copy failed') for error in errors[:3] + errors[4:])
+
+
+def test_conversions_run_concurrently_longest_first(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    # Fake ffmpeg writing its arguments to the output file, failing for clip 'bad'.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ffmpeg').write_text(
+        '#!/bin/sh\nfor argument; do output="$argument"; done\n'
+        'case "$*" in *bad*) echo "Invalid data" >&2; echo partial > "$output"; exit 1;; esac\n'
+        'echo "$*" > "$output"\n')
+    (bin_directory / 'ffmpeg').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name, size in (('short_1.mts', 10), ('long_1.mts', 300), ('long_2.mts', 300), ('bad_1.mts', 100)):
+        (source / name).write_bytes(bytes(size))
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(tmp_path / 'destination'),
+        'destination-pattern': '{video_id}.mp4',
+        'max-parallel': 2,
+        'threads': 8
+    }
+    logger = _Logger()
+    assert ConvertAndMergeVideos(dict(config), logger).do(True) == []
+    commands = [info for info in logger.infos if info.startswith('Would run: ')]
+    assert [command.split()[-1] for command in commands] == [
+        str(tmp_path / 'destination' / name) for name in ('long.tmp', 'bad.tmp', 'short.tmp')]
+    assert all('-threads 4 -x265-params pools=4' in command for command in commands)
+    assert ConvertAndMergeVideos(dict(config), _Logger()).do(False) == ['Invalid data']
+    assert sorted(path.name for path in (tmp_path / 'destination').iterdir()) == ['long.mp4', 'short.mp4']
+    assert '-f concat' in (tmp_path / 'destination' / 'long.mp4').read_text()
+
+
+def test_clips_that_are_hevc_already_are_remuxed(tmp_path, monkeypatch):
+    # Fake ffprobe: clips named 'hevc...' are HEVC at 8 Mbit/s, others H.264; 'big...' clips are 4K.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ffprobe').write_text(
+        '#!/bin/sh\nfor argument; do input="$argument"; done\n'
+        'case "$(basename "$input")" in hevc*|big*) codec=hevc;; *) codec=h264;; esac\n'
+        'case "$(basename "$input")" in big*) height=2160;; *) height=1080;; esac\n'
+        'echo "{\\"streams\\": [{\\"codec_type\\": \\"video\\", \\"codec_name\\": \\"$codec\\", '
+        '\\"width\\": 1920, \\"height\\": $height, \\"pix_fmt\\": \\"yuv420p\\"}, '
+        '{\\"codec_type\\": \\"audio\\", \\"codec_name\\": \\"aac\\"}], '
+        '\\"format\\": {\\"duration\\": \\"60.0\\", \\"bit_rate\\": \\"8000000\\"}}"\n')
+    (bin_directory / 'ffprobe').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('hevc_1.mts', 'hevc_2.mts', 'avc_1.mts', 'big_1.mts'):
+        (source / name).write_bytes(bytes(10))
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(tmp_path / 'destination'),
+        'destination-pattern': '{video_id}.mp4',
+        'remux-max-height': 1080,
+        'audio': 'aac:128k'
+    }
+    logger = _Logger()
+    assert ConvertAndMergeVideos(dict(config), logger).do(True) == []
+    assert 'Plan: remux 1 and re-encode 2 video(s); remuxing avoids re-encoding 2m 00s of video' in logger.infos[0]
+    assert 'Would remux: hevc_1.mts + hevc_2.mts -> hevc.mp4 (hevc 1920x1080 at 8000 kbit/s)' in logger.infos
+    assert 'Would re-encode: avc_1.mts -> avc.mp4 (codec h264)' in logger.infos
+    assert 'Would re-encode: big_1.mts -> big.mp4 (height 2160 above 1080)' in logger.infos
+    commands = [info for info in logger.infos if info.startswith('Would run: ')]
+    assert '-c:v copy -tag:v hvc1 -c:a aac -b:a 128k' in commands[0]
+    assert '-c:v libx265 -crf 26 -preset slow' in commands[1]
+
+
+def test_conversion_progress_is_logged_and_reported(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    # Fake ffprobe (every clip lasts 60 s) and ffmpeg writing two progress blocks.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ffprobe').write_text(
+        '#!/bin/sh\necho "{\\"streams\\": [{\\"codec_type\\": \\"video\\", \\"codec_name\\": \\"h264\\"}], '
+        '\\"format\\": {\\"duration\\": \\"60.0\\"}}"\n')
+    (bin_directory / 'ffmpeg').write_text(
+        '#!/bin/sh\nfor argument; do output="$argument"; done\n'
+        'printf "frame=900\\nfps=60.0\\nout_time_us=30000000\\nspeed=2.0x\\nprogress=continue\\n"\n'
+        'printf "frame=1800\\nfps=60.0\\nout_time_us=60000000\\nspeed=2.0x\\nprogress=end\\n"\n'
+        'echo converted > "$output"\n')
+    for program in ('ffprobe', 'ffmpeg'):
+        (bin_directory / program).chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('first_1.mts', 'second_1.mts'):
+        (source / name).write_bytes(bytes(10))
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(tmp_path / 'destination'),
+        'destination-pattern': '{video_id}.mp4',
+        'progress-interval': 0
+    }
+    logger = _Logger()
+    reports = []
+    logger.report_progress = reports.append
+    assert ConvertAndMergeVideos(dict(config), logger).do(False) == []
+    assert (tmp_path / 'destination' / 'first.mp4').read_text() == 'converted\n'
+    assert 'Progress of first.mp4: 30s of 1m 00s (50%), 900 frames, 60.0 frames/s, speed 2.00x, ETA 15s' \
+        in logger.infos
+    assert 'Batch progress: 30s of 2m 00s (25%), speed 2.00x, ETA 45s' in logger.infos
+    assert [(report['file'], report['frames'], report['eta'], report['batch-position']) for report in reports] == [
+        ('first.mp4', 900, 15, 30), ('first.mp4', 1800, 0, 60),
+        ('second.mp4', 900, 15, 90), ('second.mp4', 1800, 0, 120)]
+    assert reports[-1]['batch-eta'] is None
+
+
+def test_interrupted_conversions_are_resumed_from_journal(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    # Fake ffprobe logging the probed clips, fake ffmpeg failing for clip 'bad' unless fixed.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    probed = tmp_path / 'probed'
+    (bin_directory / 'ffprobe').write_text(
+        '#!/bin/sh\nfor argument; do input="$argument"; done\n'
+        'basename "$input" >> {}\n'
+        'echo "{{\\"streams\\": [{{\\"codec_type\\": \\"video\\", \\"codec_name\\": \\"h264\\"}}], '
+        '\\"format\\": {{\\"duration\\": \\"60.0\\"}}}}"\n'.format(probed))
+    (bin_directory / 'ffmpeg').write_text(
+        '#!/bin/sh\nfor argument; do output="$argument"; done\n'
+        'case "$*" in *bad*) [ -e {} ] || exit 1;; esac\n'
+        'echo converted > "$output"\n'.format(tmp_path / 'fixed'))
+    for program in ('ffprobe', 'ffmpeg'):
+        (bin_directory / program).chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('good_1.mts', 'bad_1.mts'):
+        (source / name).write_bytes(bytes(10))
+    destination = tmp_path / 'destination'
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(destination),
+        'destination-pattern': '{video_id}.mp4'
+    }
+    assert len(ConvertAndMergeVideos(dict(config), _Logger()).do(False)) == 1
+    assert (destination / 'good.mp4').exists() and not (destination / 'bad.mp4').exists()
+    assert sorted(probed.read_text().split()) == ['bad_1.mts', 'good_1.mts']
+    # Simulate a crash during the conversion of 'bad', leaving its temporary files behind.
+    action = ConvertAndMergeVideos(dict(config), _Logger())
+    journal = bsts_dcim.bsts_state.ConversionJournal(action._get_journal_filename())
+    orphans = [destination / 'bad.tmp', tmp_path / 'list.txt']
+    for orphan in orphans:
+        orphan.write_text('partial')
+    journal.set_status(str(destination / 'bad.mp4'), 'running', orphans)
+    journal.close()
+    (tmp_path / 'fixed').touch()
+    logger = _Logger()
+    assert ConvertAndMergeVideos(dict(config), logger).do(False) == []
+    assert 'Source tree unchanged, resuming 1 pending conversion(s)' in logger.infos
+    assert not any(orphan.exists() for orphan in orphans)
+    assert (destination / 'bad.mp4').read_text() == 'converted\n'
+    # The source tree wasn't scanned (and probed) again.
+    assert len(probed.read_text().split()) == 2
+    # A new clip changes the source tree, so it's scanned again.
+    (source / 'new_1.mts').write_bytes(bytes(10))
+    assert ConvertAndMergeVideos(dict(config), _Logger()).do(False) == []
+    assert probed.read_text().split()[2:] == ['new_1.mts']
+    assert sorted(path.name for path in destination.iterdir()) == ['bad.mp4', 'good.mp4', 'new.mp4']
+
+
+def test_conversions_are_offloaded_to_ssh_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    monkeypatch.setattr(bsts_ssh, 'session_manager', bsts_ssh.SshSessionManager(enabled=False))
+    # Fake ssh running commands locally: host 'down' is unreachable, host 'flaky' drops the
+    # connection during its first conversion and is unreachable afterwards.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    log = tmp_path / 'ssh.log'
+    (bin_directory / 'ssh').write_text(
+        '#!/bin/sh\nhost="$1"; shift\necho "$host $1" >> {0}\n'
+        'case "$host" in down) exit 255;; flaky) [ -e {1} ] && exit 255;; esac\n'
+        'case "$host $1" in "flaky ffmpeg -y"*) touch {1}; exit 255;; esac\n'
+        'exec sh -c "$1"\n'.format(log, tmp_path / 'dropped'))
+    # Fake ffmpeg concatenating its inputs.
+    (bin_directory / 'ffmpeg').write_text(
+        '#!/bin/sh\n[ "$1" = -version ] && exit 0\n'
+        'for argument; do [ "$previous" = -i ] && input="$argument"; previous="$argument"; output="$argument"; done\n'
+        'case "$*" in *concat*) sed "s/^file .\\(.*\\).$/\\1/" "$input" | xargs cat > "$output";; '
+        '*) cat "$input" > "$output";; esac\n')
+    for program in ('ssh', 'ffmpeg'):
+        (bin_directory / program).chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('streamed_1.mts', 'streamed_2.mts', 'shared_1.mts'):
+        (source / name).write_text(name + '\n')
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(tmp_path / 'destination'),
+        'destination-pattern': '{video_id}.mp4',
+        'max-parallel': 0,
+        'workers': ['down', 'flaky', {'host': 'localhost', 'slots': 2, 'scratch-directory': str(tmp_path / 'scratch')}]
+    }
+    logger = _Logger()
+    assert ConvertAndMergeVideos(dict(config), logger).do(False) == []
+    assert 'Worker down is unavailable' in logger.infos
+    assert any(info.startswith('Worker flaky is unavailable, retrying') for info in logger.infos)
+    destination = tmp_path / 'destination'
+    assert (destination / 'streamed.mp4').read_text() == 'streamed_1.mts\nstreamed_2.mts\n'
+    assert (destination / 'shared.mp4').read_text() == 'shared_1.mts\n'
+    # The clips were uploaded to the scratch directory, which is removed afterwards.
+    uploads = [line for line in log.read_text().splitlines() if line.startswith('localhost cat > ')]
+    assert len(uploads) == 4 and all(str(tmp_path / 'scratch') in upload for upload in uploads)
+    assert list((tmp_path / 'scratch').iterdir()) == []
+    # With shared storage, the worker reads and writes the files directly.
+    log.unlink()
+    (destination / 'shared.mp4').unlink()
+    config['workers'] = [{'host': 'localhost', 'path-map': {str(tmp_path): str(tmp_path)}, 'threads': 4}]
+    assert ConvertAndMergeVideos(dict(config), _Logger()).do(False) == []
+    assert (destination / 'shared.mp4').read_text() == 'shared_1.mts\n'
+    commands = log.read_text().splitlines()
+    assert not any(' cat ' in command for command in commands)
+    assert any('-threads 4' in command and str(source / 'shared_1.mts') in command for command in commands)
+
+
+def test_remote_scratch_directory_of_interrupted_conversion_is_removed(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    monkeypatch.setattr(bsts_ssh, 'session_manager', bsts_ssh.SshSessionManager(enabled=False))
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'ssh').write_text('#!/bin/sh\nshift\nexec sh -c "$1"\n')
+    (bin_directory / 'ffmpeg').write_text(
+        '#!/bin/sh\n[ "$1" = -version ] && exit 0\nfor argument; do output="$argument"; done\n'
+        'echo converted > "$output"\n')
+    for program in ('ssh', 'ffmpeg'):
+        (bin_directory / program).chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'clip_1.mts').write_bytes(bytes(10))
+    config = {
+        'source-directory': str(source),
+        'source-pattern': r'(?P<video_id>[a-z]+)_(?P<part>\d+)\.mts',
+        'destination-directory': str(tmp_path / 'destination'),
+        'destination-pattern': '{video_id}.mp4',
+        'max-parallel': 0,
+        'workers': [{'host': 'localhost', 'scratch-directory': str(tmp_path / 'scratch')}]
+    }
+    action = ConvertAndMergeVideos(dict(config), _Logger())
+    journal_entries = []
+
+    def interrupted_conversion(group, worker, source_isotime, progress):
+        # The scratch directory is in the journal before anything is uploaded; crash while uploading.
+        journal = bsts_dcim.bsts_state.ConversionJournal(action._get_journal_filename())
+        journal_entries.extend(journal.get_jobs(['running'])[0]['temporary-files'])
+        journal.close()
+        scratch = tmp_path / 'scratch' / os.path.basename(journal_entries[-1][1])
+        scratch.mkdir(parents=True)
+        (scratch / '0.mts').write_bytes(bytes(5))
+        raise KeyboardInterrupt()
+
+    action._run_remote_conversion = interrupted_conversion
+    try:
+        action.do(False)
+    except KeyboardInterrupt:
+        pass
+    assert journal_entries[-1][0] == 'localhost'
+    logger = _Logger()
+    assert ConvertAndMergeVideos(dict(config), logger).do(False) == []
+    assert any(info.startswith('Removing orphaned scratch directory localhost:') for info in logger.infos)
+    assert list((tmp_path / 'scratch').iterdir()) == []
+    assert (tmp_path / 'destination' / 'clip.mp4').read_text() == 'converted\n'
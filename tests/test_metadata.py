@@ -0,0 +1,55 @@
+import struct
+import exif
+from bettersafethansorry.metadata import read_datetime_original
+
+
+def _compose_tiff(endian, timestamp=b'2024:05:17 10:42:01'):
+    # IFD0 with an Exif IFD pointer, Exif IFD with DateTimeOriginal.
+    value = timestamp + b'\0'
+    header = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', 42, 8)
+    ifd0 = struct.pack(endian + 'HHHII', 1, 0x8769, 4, 1, 26) + struct.pack(endian + 'I', 0)
+    exif_ifd = struct.pack(endian + 'HHHII', 1, 0x9003, 2, len(value), 44) + struct.pack(endian + 'I', 0)
+    return header + ifd0 + exif_ifd + value
+
+
+def _compose_box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def test_jpeg_and_tiff(tmp_path):
+    tiff = _compose_tiff('<')
+    app1 = b'Exif\0\0' + tiff
+    jpeg = b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0' + bytes(9) + \
+        b'\xff\xe1' + struct.pack('>H', 2 + len(app1)) + app1 + b'\xff\xda' + bytes(1000) + b'\xff\xd9'
+    (tmp_path / 'photo.jpg').write_bytes(jpeg)
+    (tmp_path / 'photo.dng').write_bytes(_compose_tiff('>') + bytes(1000))
+    assert read_datetime_original(str(tmp_path / 'photo.jpg')) == '2024:05:17 10:42:01'
+    with open(tmp_path / 'photo.jpg', 'rb') as image_file:
+        assert exif.Image(image_file).get('datetime_original') == '2024:05:17 10:42:01'
+    assert read_datetime_original(str(tmp_path / 'photo.dng')) == '2024:05:17 10:42:01'
+
+
+def test_heic(tmp_path):
+    exif_item = struct.pack('>I', 6) + b'Exif\0\0' + _compose_tiff('>')
+    ftyp = _compose_box(b'ftyp', b'heic' + bytes(4) + b'mif1heic')
+    infe = _compose_box(b'infe', bytes([2, 0, 0, 0]) + struct.pack('>HH', 1, 0) + b'Exif\0')
+    iinf = _compose_box(b'iinf', bytes(4) + struct.pack('>H', 1) + infe)
+
+    def compose_iloc(offset):
+        return _compose_box(b'iloc', bytes(4) + bytes([0x44, 0x00]) + struct.pack(
+            '>HHHHII', 1, 1, 0, 1, offset, len(exif_item)))
+
+    # The Exif item is stored at the start of the 'mdat' box.
+    offset = len(ftyp) + len(_compose_box(b'meta', bytes(4) + iinf + compose_iloc(0))) + 8
+    iloc = compose_iloc(offset)
+    meta = _compose_box(b'meta', bytes(4) + iinf + iloc)
+    (tmp_path / 'photo.heic').write_bytes(ftyp + meta + _compose_box(b'mdat', exif_item + bytes(1000)))
+    assert read_datetime_original(str(tmp_path / 'photo.heic')) == '2024:05:17 10:42:01'
+
+
+def test_files_without_metadata(tmp_path):
+    (tmp_path / 'movie.mp4').write_bytes(_compose_box(b'ftyp', b'isom' + bytes(8)) + bytes(1000))
+    (tmp_path / 'empty.jpg').write_bytes(b'')
+    (tmp_path / 'plain.jpg').write_bytes(b'\xff\xd8\xff\xda' + bytes(100))
+    for filename in ('movie.mp4', 'empty.jpg', 'plain.jpg'):
+        assert read_datetime_original(str(tmp_path / filename)) is None
@@ -0,0 +1,133 @@
+import os
+import time
+import bettersafethansorry.resources as bsts_resources
+from bettersafethansorry.loggers import Logger
+from bettersafethansorry.logging import MasterLogger
+from bettersafethansorry.operation import get_verify_resources, plan_rolling_verification, run_verifies, \
+    run_all_or_nothing_actions, run_backups
+from bettersafethansorry.state import VerificationIndex
+
+
+def test_get_verify_resources():
+    assert get_verify_resources({'destination-host': 'user@host'}) == [('destination-host', 'host')]
+    assert get_verify_resources({'source-host': 'user@host'}) == [('destination-host', 'localhost')]
+
+
+def test_rsync_transfers_share_global_bandwidth_one_at_a_time(tmp_path, monkeypatch):
+    # Fake rsync logging when it starts and stops.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    log_file = tmp_path / 'rsync.log'
+    (bin_directory / 'rsync').write_text(
+        '#!/bin/sh\necho "start $*" >> {0}\nsleep 0.3\necho stop >> {0}\n'.format(log_file))
+    (bin_directory / 'rsync').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    monkeypatch.setattr(bsts_resources, 'global_limits', bsts_resources.ResourceLimits(
+        buckets=[bsts_resources.TokenBucket(1024 * 1024)]))
+    actions = [{'action': 'RsyncFiles', 'source-directory': str(tmp_path / name),
+                'destination-directory': str(tmp_path / 'copy')} for name in ('a', 'b')]
+    results = run_backups([('backup', {'max-parallel': 2, 'actions': actions})], False, MasterLogger(), 2)
+    assert results == [('backup', [])]
+    lines = log_file.read_text().splitlines()
+    assert [line.split()[0] for line in lines] == ['start', 'stop', 'start', 'stop']
+    assert '--bwlimit=1024' in lines[0].split()
+
+
+def test_verify_errors_are_aggregated_per_backup(tmp_path):
+    def archive_config(name):
+        return {'action': 'ArchiveFiles', 'source-directory': str(tmp_path),
+                'destination-file': str(tmp_path / name)}
+
+    backups = [
+        ('first', {'actions': [archive_config('a.tar'), archive_config('b.tar')]}),
+        ('second', {'actions': [archive_config('c.tar')]})
+    ]
+    (tmp_path / 'c.tar').write_bytes(b'\0' * 10240)
+    results = run_verifies(backups, False, MasterLogger(), max_parallel=2)
+    assert [name for name, _, _ in results] == ['first', 'second']
+    assert [error.split(': ')[1] for error in results[0][1]] == [
+        str(tmp_path / 'a.tar'), str(tmp_path / 'b.tar')]
+    assert results[1][1] == []
+
+
+class _Action:
+
+    def __init__(self, identity):
+        self.identity = identity
+
+    def get_verify_identity(self):
+        return self.identity
+
+
+def test_plan_rolling_verification(tmp_path, monkeypatch):
+    index = VerificationIndex(str(tmp_path / 'verification.sqlite'))
+    clock = iter([50.0, 100.0, 200.0, 300.0])
+    monkeypatch.setattr('time.time', lambda: next(clock))
+    # 'e' was verified longest ago, 'c' most recently; 'd' was never verified.
+    index.record('e', {'size': 1}, 'deep', True, 1200.0)
+    index.record('b', {'size': 1}, 'deep', True, 3600.0)
+    index.record('a', {'size': 1}, 'deep', True, 1800.0)
+    index.record('c', {'size': 1}, 'deep', True, 600.0)
+    candidates = [(name, None, [('destination-host', host)], _Action(name))
+                  for name, host in (('a', 'x'), ('b', 'x'), ('c', 'x'), ('d', 'x'), ('e', 'y'))]
+    selected, deferred = plan_rolling_verification(candidates, index, 4200.0)
+    assert [candidate[0] for candidate in selected] == ['d', 'e', 'b', 'c']
+    assert [candidate[0] for candidate in deferred] == ['a']
+    assert plan_rolling_verification(candidates, index, 4200.0, 2) == (selected, deferred)
+    # Verifying one artifact at a time, all hosts share the budget.
+    selected, deferred = plan_rolling_verification(candidates, index, 4200.0, 1)
+    assert [candidate[0] for candidate in selected] == ['d', 'e', 'a', 'c']
+    assert [candidate[0] for candidate in deferred] == ['b']
+
+
+class _RecordingLogger(Logger):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def finish_verify(self, timestamp, id, errors):
+        self.records.append(('finish_verify', errors))
+
+    def defer_verify(self, timestamp, id, deferred):
+        self.records.append(('defer_verify', deferred))
+
+
+def test_deferred_backup_is_not_reported_as_verified(tmp_path):
+    index = VerificationIndex(str(tmp_path / 'verification.sqlite'))
+    index.record('localhost:{}'.format(tmp_path / 'slow.tar'), {'size': 1}, 'deep', True, 3600.0)
+    backups = [
+        ('first', {'actions': [{'action': 'ArchiveFiles', 'source-directory': str(tmp_path),
+                                'destination-file': str(tmp_path / 'missing.tar')}]}),
+        ('second', {'actions': [{'action': 'ArchiveFiles', 'source-directory': str(tmp_path),
+                                 'destination-file': str(tmp_path / 'slow.tar')}]})
+    ]
+    logger = MasterLogger()
+    recording_logger = _RecordingLogger()
+    logger.loggers.append(recording_logger)
+    results = run_verifies(backups, False, logger, max_parallel=1, index=index, budget=60.0)
+    assert [(name, deferred) for name, _, deferred in results] == [('first', 0), ('second', 1)]
+    assert results[1][1] == []
+    assert [record[0] for record in recording_logger.records] == ['finish_verify', 'defer_verify']
+    assert len(recording_logger.records[0][1]) > 0
+    assert recording_logger.records[1][1] == 1
+
+
+def test_failing_prepare_cancels_other_prepares(tmp_path, monkeypatch):
+    # Fake pg_dump: database 'broken' fails, database 'slow' runs a (child) sleep.
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    (bin_directory / 'pg_dump').write_text(
+        '#!/bin/sh\ncase "$1" in broken) sleep 0.5; echo "connection refused" >&2; exit 1;; esac\n'
+        'sleep 20\necho dump\n')
+    (bin_directory / 'pg_dump').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_directory, os.environ['PATH']))
+    action_configs = [
+        {'action': 'ArchivePostgreSQL', 'source-database': database,
+         'destination-file': str(tmp_path / '{}.sql'.format(database))}
+        for database in ('slow', 'broken')]
+    start = time.monotonic()
+    errors = run_all_or_nothing_actions(action_configs, False, MasterLogger())
+    assert time.monotonic() - start < 10
+    assert 'connection refused' in errors
+    assert os.listdir(tmp_path) == ['bin']
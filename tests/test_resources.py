@@ -0,0 +1,43 @@
+import time
+import pytest
+import bettersafethansorry.resources as bsts_resources
+from bettersafethansorry.resources import ResourceLimits, TokenBucket
+from bettersafethansorry.ssh import SshSessionManager
+
+
+@pytest.fixture(autouse=True)
+def _no_ssh_multiplexing(monkeypatch):
+    monkeypatch.setattr(bsts_resources.bsts_ssh, 'session_manager', SshSessionManager(enabled=False))
+
+
+def test_wrap_command():
+    limits = ResourceLimits(nice=10, ionice='best-effort:7')
+    assert limits.wrap_command(['tar', '-c', '.']) == [
+        'nice', '-n', '10', 'ionice', '-c', '2', '-n', '7', 'tar', '-c', '.']
+    assert limits.wrap_command(['ssh', 'host', "tar -c . | gzip"]) == [
+        'nice', '-n', '10', 'ionice', '-c', '2', '-n', '7',
+        'ssh', 'host', "nice -n 10 ionice -c 2 -n 7 sh -c 'tar -c . | gzip'"]
+    assert limits.wrap_command(['rsync', '--archive', '/src/', 'host:/dst'])[8:10] == [
+        'rsync', '--rsync-path=nice -n 10 ionice -c 2 -n 7 rsync']
+    assert ResourceLimits().wrap_command(['tar', '-c', '.']) == ['tar', '-c', '.']
+    with pytest.raises(ValueError):
+        ResourceLimits(ionice='realtime')
+
+
+def test_action_limits_are_combined_with_global_limits(monkeypatch):
+    monkeypatch.setattr(bsts_resources, 'global_limits', bsts_resources.global_limits)
+    bsts_resources.configure({'nice': 19, 'ionice': 'idle', 'bandwidth-limit': '10M'})
+    limits = bsts_resources.get_limits(nice=5, bandwidth_limit='1M')
+    assert limits.get_prefix() == ['nice', '-n', '5', 'ionice', '-c', '3']
+    assert limits.get_bandwidth_limit() == 1024 ** 2
+    # The global bucket is shared by all actions.
+    assert bsts_resources.get_limits().buckets == limits.buckets[1:]
+
+
+def test_token_bucket_limits_throughput():
+    bucket = TokenBucket(100000)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.consume(50000)
+    # The first 100000 bytes are a burst, the next 150000 take 1.5 s.
+    assert 1.3 < time.monotonic() - start < 2.5
@@ -0,0 +1,55 @@
+import threading
+import time
+import pytest
+from bettersafethansorry.scheduler import JobScheduler
+
+
+def _make_job(name, running, peaks, lock, resources=()):
+    def job():
+        with lock:
+            running.append(name)
+            peaks.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(name)
+        return name
+    return (job, resources)
+
+
+def test_results_keep_submission_order():
+    scheduler = JobScheduler(4)
+    lock = threading.Lock()
+    running, peaks = [], []
+    jobs = [_make_job(name, running, peaks, lock) for name in 'abcdef']
+    assert scheduler.run(jobs) == list('abcdef')
+    assert max(peaks) <= 4
+
+
+def test_resource_limits():
+    scheduler = JobScheduler(4, {'destination-host': 1})
+    lock = threading.Lock()
+    running, peaks = [], []
+    jobs = [_make_job(name, running, peaks, lock, [('destination-host', 'calvin')])
+            for name in 'abc']
+    assert scheduler.run(jobs) == list('abc')
+    assert max(peaks) == 1
+
+
+def test_specific_limit_overrides_kind_limit():
+    scheduler = JobScheduler(None, {'source-host': 1})
+    scheduler.restrict(('source-host', 'wormwood'), 0)
+    assert scheduler._get_limit(('source-host', 'wormwood')) == 0
+    assert scheduler._get_limit(('source-host', 'calvin')) == 1
+    # A less strict limit doesn't replace a stricter one.
+    scheduler.restrict('source-host', 3)
+    assert scheduler._get_limit(('source-host', 'calvin')) == 1
+
+
+def test_exception_is_raised():
+    scheduler = JobScheduler(1)
+
+    def failing_job():
+        raise RuntimeError('Unknown action')
+
+    with pytest.raises(RuntimeError):
+        scheduler.run([(failing_job, ()), (lambda: None, ())])
@@ -0,0 +1,23 @@
+from bettersafethansorry.ssh import SshSessionManager, get_rsync_remote_host
+
+
+def test_get_rsync_remote_host():
+    assert get_rsync_remote_host(['rsync', '--archive', 'user@host:/src/', '/dst']) == 'user@host'
+    assert get_rsync_remote_host(['rsync', '--archive', '/src/', 'host:/dst']) == 'host'
+    assert get_rsync_remote_host(['rsync', '--archive', '/src/', '/dst']) is None
+    assert get_rsync_remote_host(['rsync', 'host::module/src', '/dst']) is None
+    assert get_rsync_remote_host(['rsync', '--rsh=ssh -p 2222', 'host:/src', '/dst']) is None
+
+
+def test_wrap_command_when_disabled():
+    session_manager = SshSessionManager(enabled=False)
+    command = ['ssh', 'user@host', 'test -f /file']
+    assert session_manager.wrap_command(command) == command
+    assert session_manager.opened == 0 and session_manager.reused == 0
+
+
+def test_wrap_command_ignores_other_commands():
+    session_manager = SshSessionManager()
+    command = ['tar', '--create', '--file=-', '.']
+    assert session_manager.wrap_command(command) == command
+    assert session_manager.opened == 0 and session_manager.reused == 0
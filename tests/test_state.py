@@ -0,0 +1,35 @@
+import time
+from bettersafethansorry.state import VerificationIndex
+
+
+def test_verification_index(tmp_path):
+    index = VerificationIndex(str(tmp_path / 'verification.sqlite'))
+    fingerprint = {'size': 10, 'mtime': 1000, 'inode': 1, 'device': 2}
+    assert index.is_verified('host:/file', fingerprint, 'quick') is None
+    index.record('host:/file', fingerprint, 'quick', True, 1.5)
+    assert index.is_verified('host:/file', fingerprint, 'quick') is not None
+    # A quick verification doesn't count for a deep one.
+    assert index.is_verified('host:/file', fingerprint, 'deep') is None
+    index.record('host:/file', fingerprint, 'deep', True, 3.0)
+    assert index.is_verified('host:/file', fingerprint, 'quick') is not None
+    assert index.is_verified('host:/file', {**fingerprint, 'inode': 3}, 'deep') is None
+    assert index.is_verified('host:/file', fingerprint, 'deep', max_age=-1) is None
+    last_success_at = index.lookup('host:/file')['last_success_at']
+    index.record('host:/file', fingerprint, 'deep', False, 2.0)
+    entry = index.lookup('host:/file')
+    assert entry['outcome'] == 'failure' and entry['last_success_at'] == last_success_at
+    assert entry['size'] == 10 and entry['verified_at'] <= time.time()
+    assert index.is_verified('host:/file', fingerprint, 'quick') is None
+
+
+def test_verification_index_shared_by_connections(tmp_path):
+    first = VerificationIndex(str(tmp_path / 'verification.sqlite'))
+    second = VerificationIndex(str(tmp_path / 'verification.sqlite'))
+    first.record('host:/file', {'size': 10}, 'deep', False, 1.0)
+    assert second.lookup('host:/file')['last_success_at'] is None
+    second.record('host:/file', {'size': 10}, 'deep', True, 1.0)
+    first.record('host:/file', {'size': 10}, 'deep', False, 1.0)
+    entry = first.lookup('host:/file')
+    assert entry['outcome'] == 'failure' and entry['last_success_at'] is not None
+    first.close()
+    second.close()
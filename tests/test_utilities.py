@@ -1,4 +1,10 @@
-from bettersafethansorry.utilities import split_user_host, split_user_password_host
+import errno
+import os
+import pytest
+import subprocess
+import bettersafethansorry.utilities as bsts_utils
+from bettersafethansorry.utilities import split_user_host, split_user_password_host, rotate_file, run_processes, \
+    stat_files, parse_duration, parse_size, copy_file, rename_file, _compose_rotation_script
 
 
 def test_split_user_host():
@@ -20,3 +26,152 @@ def test_split_user_password_host():
     assert split_user_password_host('user@') == ('user', None, None)
     assert split_user_password_host('@host.domain') == (None, None, 'host.domain')
     assert split_user_password_host('host.domain') == (None, None, 'host.domain')
+
+
+class _Logger:
+
+    def __init__(self):
+        self.messages = []
+
+    def log_debug(self, message):
+        self.messages.append(message)
+
+    def log_error(self, message):
+        self.messages.append(message)
+
+
+def _create_files(directory, names):
+    for name in names:
+        (directory / name).write_text(name)
+
+
+def test_rotate_file_locally(tmp_path):
+    _create_files(tmp_path, ['x.tar.tmp', 'x.tar', 'x.tar.1', 'x.tar.2'])
+    filename = str(tmp_path / 'x.tar')
+    assert rotate_file(None, filename, '.tmp', 2, _Logger()) == []
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['x.tar', 'x.tar.1', 'x.tar.2']
+    assert (tmp_path / 'x.tar').read_text() == 'x.tar.tmp'
+    assert (tmp_path / 'x.tar.1').read_text() == 'x.tar'
+    assert (tmp_path / 'x.tar.2').read_text() == 'x.tar.1'
+
+
+def test_rotate_file_without_temporary_file(tmp_path):
+    _create_files(tmp_path, ['x.tar'])
+    errors = rotate_file(None, str(tmp_path / 'x.tar'), '.tmp', 2, _Logger())
+    assert len(errors) == 1 and "doesn't exist" in errors[0]
+    assert (tmp_path / 'x.tar').read_text() == 'x.tar'
+
+
+def test_rotation_script_matches_local_rotation(tmp_path):
+    _create_files(tmp_path, ['x.tar.tmp', 'x.tar', 'x.tar.2'])
+    script = _compose_rotation_script(str(tmp_path / 'x.tar'), '.tmp', 3)
+    result = subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE)
+    assert result.returncode == 0
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['x.tar', 'x.tar.1', 'x.tar.3']
+    assert (tmp_path / 'x.tar.1').read_text() == 'x.tar'
+    assert (tmp_path / 'x.tar.3').read_text() == 'x.tar.2'
+    assert len(result.stdout.splitlines()) == 3
+
+
+def test_run_processes_keeps_last_stderr_lines():
+    logger = _Logger()
+    command = ['sh', '-c', 'for i in 1 2 3 4 5; do echo line $i >&2; done; exit 1']
+    exit_codes, _, stderrs = run_processes([command], None, logger, stderr_lines=2)
+    assert exit_codes == [1]
+    assert stderrs == ['(3 earlier line(s) suppressed)\nline 4\nline 5']
+    # All lines are logged as they arrive.
+    assert [message for message in logger.messages if message.startswith('sh: ')] == \
+        ['sh: line {}'.format(i) for i in range(1, 6)]
+
+
+def test_run_processes_collects_statistics(tmp_path):
+    statistics = {}
+    output_file = tmp_path / 'output'
+    commands = [['head', '-c', '100000', '/dev/zero'], ['gzip', '-c']]
+    exit_codes, _, _ = run_processes(commands, str(output_file), _Logger(), statistics=statistics)
+    assert exit_codes == [0, 0]
+    assert [stage['command'] for stage in statistics['stages']] == ['head', 'gzip']
+    assert statistics['stages'][0]['bytes-out'] == 100000
+    assert statistics['stages'][1]['bytes-out'] == output_file.stat().st_size
+    assert statistics['stages'][1]['user-time'] is not None
+
+
+def test_run_processes_passes_stdout_lines_to_callback():
+    commands = [['printf', 'a=1\\nb=2\\npartial'], ['cat']]
+    for statistics in (None, {}):
+        lines = []
+        exit_codes, stdouts, _ = run_processes(commands, None, _Logger(), statistics=statistics,
+                                               capture_stdout=True, stdout_callback=lines.append)
+        assert exit_codes == [0, 0]
+        assert lines == ['a=1', 'b=2', 'partial']
+        assert stdouts[-1] == 'a=1\nb=2\npartial'
+
+
+def test_rotate_file_with_companions(tmp_path):
+    _create_files(tmp_path, ['x.tar.tmp', 'x.tar.snar.tmp', 'x.tar', 'x.tar.snar', 'x.tar.incr.1',
+                             'x.tar.1', 'x.tar.1.snar', 'x.tar.1.incr.1', 'x.tar.1.incr.2'])
+    filename = str(tmp_path / 'x.tar')
+    assert rotate_file(None, filename, '.tmp', 1, _Logger(), ['.snar', '.incr.1', '.incr.2']) == []
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'x.tar', 'x.tar.1', 'x.tar.1.incr.1', 'x.tar.1.snar', 'x.tar.snar']
+    assert (tmp_path / 'x.tar.snar').read_text() == 'x.tar.snar.tmp'
+    assert (tmp_path / 'x.tar.1.incr.1').read_text() == 'x.tar.incr.1'
+    # Without rotation, the companions of the replaced file are removed.
+    _create_files(tmp_path, ['x.tar.tmp', 'x.tar.incr.1'])
+    script = _compose_rotation_script(filename, '.tmp', 0, ['.snar', '.incr.1'])
+    assert subprocess.run(['sh', '-c', script], stdout=subprocess.DEVNULL).returncode == 0
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'x.tar', 'x.tar.1', 'x.tar.1.incr.1', 'x.tar.1.snar']
+
+
+def test_stat_files(tmp_path):
+    _create_files(tmp_path, ['x.tar', 'x.tar.incr.1', 'x.tar.incr.2'])
+    files = stat_files(None, [str(tmp_path / 'x.tar'), str(tmp_path / 'x.tar.incr.*'), str(tmp_path / 'y.tar')])
+    assert sorted(files) == [str(tmp_path / name) for name in ('x.tar', 'x.tar.incr.1', 'x.tar.incr.2')]
+    assert files[str(tmp_path / 'x.tar')][0] == len('x.tar')
+
+
+def test_parse_duration():
+    assert parse_duration('90') == 90
+    assert parse_duration('4h') == 4 * 3600
+    assert parse_duration('1.5d') == 1.5 * 86400
+    with pytest.raises(ValueError):
+        parse_duration('4 hours')
+
+
+def test_parse_size():
+    assert parse_size('4096') == 4096
+    assert parse_size('64M') == 64 * 1024 ** 2
+    assert parse_size('1GiB') == 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_size('1 gigabyte')
+
+
+def test_copy_file_falls_back_to_buffered_copy(tmp_path, monkeypatch):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    (tmp_path / 'source').write_bytes(data)
+    assert copy_file(str(tmp_path / 'source'), str(tmp_path / 'copy')) in (
+        'reflink', 'copy_file_range', 'sendfile', 'buffered')
+    assert (tmp_path / 'copy').read_bytes() == data
+
+    def unsupported(*arguments):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(bsts_utils.fcntl, 'ioctl', unsupported)
+    monkeypatch.setattr(os, 'copy_file_range', unsupported)
+    assert copy_file(str(tmp_path / 'source'), str(tmp_path / 'copy')) == 'sendfile'
+    assert (tmp_path / 'copy').read_bytes() == data
+    monkeypatch.setattr(os, 'sendfile', unsupported)
+    assert copy_file(str(tmp_path / 'source'), str(tmp_path / 'copy')) == 'buffered'
+    assert (tmp_path / 'copy').read_bytes() == data
+    # Renames across filesystems copy the file.
+    replace = os.replace
+
+    def replace_on_same_filesystem(old, new):
+        if not old.endswith('.part'):
+            unsupported()
+        replace(old, new)
+
+    monkeypatch.setattr(os, 'replace', replace_on_same_filesystem)
+    assert rename_file(None, str(tmp_path / 'source'), str(tmp_path / 'moved'))
+    assert (tmp_path / 'moved').read_bytes() == data and not (tmp_path / 'source').exists()